@@ -1,6 +1,25 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CabConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cab'
+
+    def ready(self):
+        from cab.dbaccess import cplxaction
+        from cab.dbaccess import database
+        from cab.dbaccess import diff
+        from cab.dbaccess import search
+        from cab.dbaccess import snapshot
+        from cab.dbaccess import workingcopy
+        snapshot.SNAPSHOTS.max_bytes = settings.CAB_SNAPSHOT_MAX_BYTES
+        database.POOL.idle_timeout = settings.CAB_POOL_IDLE_TIMEOUT
+        database.POOL.max_idle = settings.CAB_POOL_MAX_IDLE
+        database.CACHED_STATEMENTS = settings.CAB_CACHED_STATEMENTS
+        search.PAGE_SIZE = settings.CAB_SEARCH_PAGE_SIZE
+        cplxaction.MEMO_SIZE = settings.CAB_CPLX_MEMO_SIZE
+        cplxaction.BATCH_WORKERS = settings.CAB_BATCH_WORKERS
+        diff.DETAIL_LIMIT = settings.CAB_DIFF_DETAIL_LIMIT
+        workingcopy.MODE = settings.CAB_WORKING_COPY
+        workingcopy.SCRATCH_DIR = settings.CAB_WORKING_COPY_DIR
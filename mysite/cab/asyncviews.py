@@ -0,0 +1,302 @@
+''' Async versions of the cab views accessing the databases (served under ASGI, see CAB_ASYNC_VIEWS)
+
+The database access (sqlite3), the upload parsing and writing and the JSON encoding of the responses run in a bounded
+executor (CAB_ASYNC_WORKERS threads), the event loop only waits for them: one process serves many sessions without
+a thread per request. The views share their helpers with the sync views (see views.py).
+'''
+
+
+import json
+import logging
+import functools
+import threading
+import concurrent.futures
+
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+from cab import views
+from cab import upload
+from cab import uploadjobs
+from cab import cacheable
+from cab import resultcache
+from cab.requestlog import RequestLog
+from cab.jsonresponse import CabJsonResponse
+from cab.dbaccess import action as act
+from cab.dbaccess import cplxaction as cplx
+from cab.dbaccess import search
+from cab.dbaccess import diff
+
+
+logger = logging.getLogger(__name__)
+
+
+# executor of the database access (created on first use)
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+
+
+def getExecutor():
+    ''' Get the (process-wide, bounded) executor of the database access '''
+    global EXECUTOR
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=settings.CAB_ASYNC_WORKERS, thread_name_prefix="cab-db")
+        return EXECUTOR
+
+
+async def runDbAccess(function, *args):
+    '''
+    Run a (blocking) function in the executor of the database access, in the context of the request
+    function: function to run
+    args: arguments of the function
+    return result of the function
+    '''
+    return await sync_to_async(functools.partial(function, *args), thread_sensitive=False, executor=getExecutor())()
+
+
+async def iterChunks(chunks):
+    '''
+    Iterate the chunks of a streamed response asynchronously: each chunk is made in the executor of the database access
+    chunks: iterator of chunks (bytes)
+    '''
+    while True:
+        chunk = await runDbAccess(next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def getSessionResult(request, dbfile, name, *args):
+    '''
+    Get the result of a request served before to the session (see resultcache), in the executor of the database access
+    return (session result, cached response body or None)
+    '''
+    session_result = resultcache.SessionResult(request.session.session_key, dbfile, name, *args)
+    return session_result, await runDbAccess(session_result.get)
+
+
+async def uploaddb(request):
+    ''' open and read the database uploaded in the request '''
+    if request.method == 'POST':
+        request_log = RequestLog(logger, "uploaddb")
+
+        # stream the upload straight into its final file (must be set before request.FILES is accessed)
+        upload_handler = upload.DbFileUploadHandler(request)
+        request.upload_handlers = [upload_handler]
+
+        # Retrieve the database file: parsed and written (synced and closed) in the executor
+        dbfile = await runDbAccess(request.FILES.get, "dbfile")
+        if dbfile is None:
+            # Django does not call upload_interrupted() on StopUpload: remove the partial file here
+            await runDbAccess(upload_handler.upload_interrupted)
+            response_data = {"exception": upload_handler.error or "no database uploaded"}
+            logger.error("upload rejected: {}".format(response_data["exception"]))
+            return request_log.done(await runDbAccess(CabJsonResponse, response_data), response_data)
+
+        # the references to the stored databases are kept by session key
+        if request.session.session_key is None:
+            await request.session.asave()
+        session_key = request.session.session_key
+        # the results of the previous database are dropped (a result is keyed by the content of its database)
+        await runDbAccess(resultcache.clearResults, session_key)
+
+        # identical uploads share one file, the previously uploaded database of this session is released
+        # validation and train numbers in the background, in the requested format (see uploadstatus)
+        job = await runDbAccess(uploadjobs.startUpload, dbfile, session_key, await request.session.aget('dbfile'),
+                                await request.session.aget('uploadJob'), request.POST.get("format"))
+        await request.session.aset('dbfile', job.dbfile)
+        await request.session.aset('uploadJob', job.id)
+
+        # Send the job (as JSON) back
+        response_data = job.getStatus()
+        return request_log.done(await runDbAccess(CabJsonResponse, response_data), response_data)
+
+
+async def uploadstatus(request):
+    ''' get the status of the upload job contained in the request: progress, train numbers once done '''
+    if request.method == 'GET':
+        jobId = request.GET.get("jobId")
+
+        request_log = RequestLog(logger, "uploadstatus", jobId=jobId)
+        response_data = uploadjobs.getJobStatus(jobId)
+
+        # Send the job status (as JSON) back
+        return request_log.done(await runDbAccess(CabJsonResponse, response_data), response_data)
+
+
+async def searchtrainnumbers(request):
+    ''' search the train numbers by short name (prefix matches first, then substring matches), one page '''
+    if request.method == 'GET':
+        query = request.GET.get("q", "")
+        after = request.GET.get("after")
+        limit = request.GET.get("limit")
+
+        request_log = RequestLog(logger, "searchtrainnumbers", q=query)
+        response_data = await runDbAccess(search.searchTrainNumbers, await request.session.aget('dbfile'), query, after, limit)
+
+        # Send train numbers (as JSON) back
+        return request_log.done(await runDbAccess(functools.partial(CabJsonResponse, status=search.getStatus(response_data)), response_data), response_data)
+
+
+async def getactions(request):
+    ''' get actions of the train number id contained in the request '''
+    if request.method == 'POST':
+        # Parse the JSON data from the request body
+        data = json.loads(request.body)
+
+        trainNumberId = data["trainNumberId"]
+        # lazy: line sections only (with their number of events and actions), see getlinesection
+        lazy = data.get("lazy", False)
+
+        request_log = RequestLog(logger, "getactions", trainNumberId=trainNumberId, lazy=lazy)
+        dbfile = await request.session.aget('dbfile')
+
+        # served before to this session: sent as cached
+        session_result, content = await getSessionResult(request, dbfile, "getactions", trainNumberId, lazy)
+        if content is not None:
+            request_log.fields["cached"] = True
+            return request_log.done(resultcache.makeResponse(content), None)
+
+        response_data = await runDbAccess(views.getActionsData, dbfile, trainNumberId, lazy)
+
+        # Send actions (as JSON) back: encoded (and cached) in the executor, streamed chunk by chunk from the executor
+        response = await runDbAccess(views.makeActionsResponse, response_data, CabJsonResponse, session_result, iterChunks)
+        return request_log.done(response, response_data)
+
+
+@cacheable.cacheable
+async def dbactions(request, digest, trainNumberId):
+    ''' get actions of the train number id in the url, from the database of the content hash in the url (cacheable) '''
+    if request.method == 'GET':
+        # lazy: line sections only (with their number of events and actions), see getlinesection
+        lazy = request.GET.get("lazy") in ("1", "true")
+
+        request_log = RequestLog(logger, "dbactions", trainNumberId=trainNumberId, lazy=lazy)
+        dbfile = upload.findDbFile(digest)
+        if dbfile is None:
+            response_data = cacheable.unknownDatabase(digest)
+        else:
+            response_data = await runDbAccess(views.getActionsData, dbfile, trainNumberId, lazy)
+
+        # Send actions (as JSON) back
+        response = await runDbAccess(views.makeActionsResponse, response_data, cacheable.makeResponse, None, iterChunks)
+        return request_log.done(response, response_data)
+
+
+async def getlinesection(request):
+    ''' get the events and actions of the line section contained in the request (lazy action tree) '''
+    if request.method == 'POST':
+        # Parse the JSON data from the request body
+        data = json.loads(request.body)
+
+        lineId = data["lineId"]
+        lineSectionId = data["lineSectionId"]
+
+        request_log = RequestLog(logger, "getlinesection", lineId=lineId, lineSectionId=lineSectionId)
+        response_data = await runDbAccess(act.getLineSection, await request.session.aget('dbfile'), lineId, lineSectionId)
+
+        # Send line section (as JSON) back
+        return request_log.done(await runDbAccess(CabJsonResponse, response_data), response_data)
+
+
+async def getcplxaction(request):
+    ''' get the actions tree of the complex action contained in the request '''
+    if request.method == 'POST':
+        # Parse the JSON data from the request body
+        data = json.loads(request.body)
+
+        actionId = data["actionId"]
+        actionListId = data["actionListId"]
+        actionDetailId = data["actionDetailId"]
+        actionType = data["actionType"]
+        mediaType = data["mediaType"]
+
+        request_log = RequestLog(logger, "getcplxaction", actionId=actionId)
+        dbfile = await request.session.aget('dbfile')
+
+        # served before to this session: sent as cached
+        session_result, content = await getSessionResult(request, dbfile, "getcplxaction",
+                                                         actionId, actionListId, actionDetailId, actionType, mediaType)
+        if content is not None:
+            request_log.fields["cached"] = True
+            return request_log.done(resultcache.makeResponse(content), None)
+
+        response_data = await runDbAccess(cplx.getCplxActionTree,
+                                          dbfile,
+                                          actionId,
+                                          actionListId,
+                                          actionDetailId,
+                                          actionType,
+                                          mediaType)
+
+        # Send actions (as JSON) back
+        response = await runDbAccess(views.makeSessionResponse, response_data, session_result)
+        return request_log.done(response, response_data)
+
+
+@cacheable.cacheable
+async def dbcplxaction(request, digest, actionId):
+    ''' get the actions tree of the complex action in the url, from the database of the content hash in the url (cacheable) '''
+    if request.method == 'GET':
+        actionListId = request.GET.get("actionListId")
+        actionDetailId = request.GET.get("actionDetailId")
+        actionType = request.GET.get("actionType")
+        mediaType = request.GET.get("mediaType")
+
+        request_log = RequestLog(logger, "dbcplxaction", actionId=actionId)
+        dbfile = upload.findDbFile(digest)
+        if dbfile is None:
+            response_data = cacheable.unknownDatabase(digest)
+        else:
+            response_data = await runDbAccess(cplx.getCplxActionTree, dbfile, actionId, actionListId, actionDetailId, actionType, mediaType)
+
+        # Send actions (as JSON) back
+        return request_log.done(await runDbAccess(cacheable.makeResponse, response_data), response_data)
+
+
+@cacheable.cacheable
+async def dbdiff(request, base, other):
+    ''' get the differences between the databases of the content hashes in the url (base, other version), cacheable '''
+    if request.method == 'GET':
+        # limit: number of changed train numbers compared subtree by subtree (see diff.DETAIL_LIMIT)
+        limit = request.GET.get("limit")
+
+        request_log = RequestLog(logger, "dbdiff", limit=limit)
+        baseFile = upload.findDbFile(base)
+        otherFile = upload.findDbFile(other)
+        if baseFile is None:
+            response_data = cacheable.unknownDatabase(base)
+        elif otherFile is None:
+            response_data = cacheable.unknownDatabase(other)
+        else:
+            response_data = await runDbAccess(diff.getDiff, baseFile, otherFile, limit)
+
+        # Send differences (as JSON) back
+        return request_log.done(await runDbAccess(cacheable.makeResponse, response_data), response_data)
+
+
+async def getcplxactions(request):
+    ''' get the actions trees of all complex actions of the train number id contained in the request (batch) '''
+    if request.method == 'POST':
+        # Parse the JSON data from the request body
+        data = json.loads(request.body)
+
+        trainNumberId = data["trainNumberId"]
+
+        request_log = RequestLog(logger, "getcplxactions", trainNumberId=trainNumberId)
+        dbfile = await request.session.aget('dbfile')
+
+        # served before to this session: sent as cached
+        session_result, content = await getSessionResult(request, dbfile, "getcplxactions", trainNumberId)
+        if content is not None:
+            request_log.fields["cached"] = True
+            return request_log.done(resultcache.makeResponse(content), None)
+
+        response_data = await runDbAccess(cplx.getCplxActionTrees, dbfile, trainNumberId)
+
+        # Send actions (as JSON) back
+        response = await runDbAccess(views.makeSessionResponse, response_data, session_result)
+        return request_log.done(response, response_data)
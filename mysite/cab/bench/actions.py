@@ -0,0 +1,96 @@
+''' Benchmark: train number actions, per-row (legacy) loader vs set-based loader
+
+Usage (from the mysite directory):
+    python -m cab.bench.actions <dbfile> [--trainnumbers N] [--repeat N]
+'''
+
+
+import sys
+import time
+import argparse
+
+
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+from cab.dbaccess import action as act
+
+
+class LegacyDbAction(act.DbAction):
+    ''' The former loader: one query per line section, line event and action list '''
+
+    def getActions(self):
+        cursor = self.db_conn.execute(db_queries.QUERY_TRAINNUMBER_ID, (self.trainNumberId,))
+        for row in cursor:
+            self.my_line = act.Line(self.trainNumberId, row[1], row[0], row[2], row[8], row[9])
+
+            cursor2 = self.db_conn.execute(db_queries.QUERY_LINESECTIONS, (row[0],))
+            for row2 in cursor2:
+                lineSection = act.LineSection(row2[0], row2[2], row2[3], row2[5], row2[6], row2[7])
+
+                cursor3 = self.db_conn.execute(db_queries.QUERY_LINEEVENTS, (row2[0],))
+                for row3 in cursor3:
+                    lineevent = act.LineEvent(row3[0], row3[1], row3[3])
+
+                    cursor4 = self.db_conn.execute(db_queries.QUERY_ACTIONS, (row3[1],))
+                    for row4 in cursor4:
+                        lineevent.actions.append(act.Action(row4[0], row4[1], row4[2], row4[3]))
+
+                    lineSection.events.append(lineevent)
+
+                self.my_line.line_sections.append(lineSection)
+
+
+class StatementCounter():
+    ''' Counts the statements executed on a connection (sqlite3 trace callback) '''
+
+    def __init__(self, db_conn):
+        self.count = 0
+        db_conn.set_trace_callback(self.trace)
+
+    def trace(self, statement):
+        self.count += 1
+
+
+def run(db_conn, loader, trainNumberIds, repeat):
+    '''
+    Load the actions of all given train numbers with the given loader class.
+    return (number of statements, wall time in seconds, list of action dictionaries)
+    '''
+    counter = StatementCounter(db_conn)
+    results = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = []
+        for trainNumberId in trainNumberIds:
+            db_action = loader(db_conn, trainNumberId)
+            db_action.getActions()
+            results.append(db_action.makeActionsDict())
+    elapsed = time.perf_counter() - start
+    db_conn.set_trace_callback(None)
+    return counter.count // repeat, elapsed / repeat, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the train number actions loader (old vs new)")
+    parser.add_argument("dbfile", help="mobileSQLite database")
+    parser.add_argument("--trainnumbers", type=int, default=20, help="number of train numbers to load")
+    parser.add_argument("--repeat", type=int, default=3, help="number of repetitions (averaged)")
+    args = parser.parse_args(argv)
+
+    my_database = database.Database(args.dbfile)
+    db_conn = my_database.db_conn
+    trainNumberIds = [row[0] for row in db_conn.execute(db_queries.QUERY_TRAINNUMBERS)][:args.trainnumbers]
+
+    old_count, old_time, old_results = run(db_conn, LegacyDbAction, trainNumberIds, args.repeat)
+    new_count, new_time, new_results = run(db_conn, act.DbAction, trainNumberIds, args.repeat)
+    my_database.close()
+
+    print("train numbers: {0}".format(len(trainNumberIds)))
+    print("{0:<8} {1:>12} {2:>12}".format("loader", "statements", "time [ms]"))
+    print("{0:<8} {1:>12} {2:>12.1f}".format("old", old_count, old_time * 1000))
+    print("{0:<8} {1:>12} {2:>12.1f}".format("new", new_count, new_time * 1000))
+    print("identical output: {0}".format(old_results == new_results))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
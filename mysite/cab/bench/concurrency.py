@@ -0,0 +1,188 @@
+''' Benchmark: throughput and latency of concurrent sessions against a running server (WSGI vs ASGI)
+
+Each session uploads the database once (its own session cookie), then requests the actions and the
+complex action trees of its train numbers in a loop until the duration is over.
+
+Start the server to measure (from the mysite directory), e.g.:
+    WSGI (sync views):  python manage.py runserver --noreload 8000
+    ASGI (async views): uvicorn mysite.asgi:application --port 8000
+
+Usage (from the mysite directory):
+    python -m cab.bench.concurrency <dbfile> [--url http://127.0.0.1:8000] [--sessions N] [--duration S]
+'''
+
+
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+import http.client
+import urllib.parse
+
+
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+
+
+class Session():
+    ''' Class to send the requests of one session (own connection and session cookie) '''
+
+    def __init__(self, url):
+        '''
+        Constructor
+        url: base url of the server
+        '''
+        parts = urllib.parse.urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=600)
+        self.cookie = None
+
+    def post(self, path, body, content_type):
+        '''
+        Send a POST request
+        path: path of the endpoint
+        body: request body (bytes)
+        content_type: content type of the body
+        return decoded JSON response
+        '''
+        headers = {"Content-Type": content_type}
+        if self.cookie is not None:
+            headers["Cookie"] = self.cookie
+        self.connection.request("POST", path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        content = response.read()
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        if response.status != 200:
+            raise RuntimeError("{} {}: {}".format(path, response.status, content[:200]))
+        return json.loads(content)
+
+    def postJson(self, path, data):
+        return self.post(path, json.dumps(data).encode("utf-8"), "application/json")
+
+    def upload(self, dbfile_content):
+        ''' Upload the database (multipart) '''
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            "--{}\r\n".format(boundary).encode(),
+            b'Content-Disposition: form-data; name="dbfile"; filename="bench.db"\r\n',
+            b"Content-Type: application/octet-stream\r\n\r\n",
+            dbfile_content,
+            "\r\n--{}--\r\n".format(boundary).encode(),
+        ])
+        return self.post("/cab/uploaddb", body, "multipart/form-data; boundary={}".format(boundary))
+
+
+def getRequests(dbfile, trainnumbers):
+    '''
+    Get the requests of the benchmark: the actions of the first train numbers (their complex actions follow)
+    dbfile: database file
+    trainnumbers: number of train numbers
+    return list of (path, data)
+    '''
+    requests = []
+    with database.Database(dbfile) as my_database:
+        db_conn = my_database.db_conn
+        trainNumberIds = [row[0] for row in db_conn.execute(db_queries.QUERY_TRAINNUMBERS)][:trainnumbers]
+        for trainNumberId in trainNumberIds:
+            requests.append(("/cab/getactions", {"trainNumberId": trainNumberId}))
+    return requests
+
+
+def runSession(url, dbfile_content, requests, barrier, stop, latencies, errors):
+    ''' Upload the database, wait for all sessions, then loop over the requests until stop is set '''
+    session = Session(url)
+    try:
+        session.upload(dbfile_content)
+    except Exception as e:
+        errors.append(str(e))
+        session = None
+    barrier.wait()
+    if session is None:
+        return
+
+    try:
+        index = 0
+        while not stop.is_set():
+            path, data = requests[index % len(requests)]
+            index += 1
+            start = time.perf_counter()
+            response = session.postJson(path, data)
+            latencies.append(time.perf_counter() - start)
+            # follow the first complex actions of the train number (as the browser does)
+            for cplx_data in findCplxActions(response)[:2]:
+                start = time.perf_counter()
+                session.postJson("/cab/getcplxaction", cplx_data)
+                latencies.append(time.perf_counter() - start)
+    except Exception as e:
+        errors.append(str(e))
+
+
+def findCplxActions(tree):
+    ''' Find the complex actions of an action tree: the data of their getcplxaction requests '''
+    found = []
+    stack = [(tree, None)]
+    while stack:
+        node, actionListId = stack.pop()
+        if isinstance(node, dict):
+            actionListId = node.get("actionListId", actionListId)
+            if (node.get("childType") == "action") and (node.get("actionType") in ("CAStatic", "CANonstatic")):
+                found.append({"actionId": node["actionId"],
+                              "actionListId": actionListId,
+                              "actionDetailId": node["actionDetailId"],
+                              "actionType": node["actionType"],
+                              "mediaType": node["mediaType"]})
+            stack.extend((child, actionListId) for child in reversed(node.get("children") or []))
+    return found
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark concurrent sessions against a running cab server")
+    parser.add_argument("dbfile", help="mobileSQLite database")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base url of the server")
+    parser.add_argument("--sessions", type=int, default=200, help="number of concurrent sessions")
+    parser.add_argument("--duration", type=float, default=20.0, help="measured time (seconds)")
+    parser.add_argument("--trainnumbers", type=int, default=20, help="number of train numbers requested by each session")
+    args = parser.parse_args(argv)
+
+    with open(args.dbfile, "rb") as f:
+        dbfile_content = f.read()
+    requests = getRequests(args.dbfile, args.trainnumbers)
+
+    # the sessions upload the database first, the requests are measured once all of them are done
+    barrier = threading.Barrier(args.sessions + 1)
+    stop = threading.Event()
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=runSession, args=(args.url, dbfile_content, requests, barrier, stop, latencies, errors))
+               for _ in range(args.sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    print("{} sessions uploaded in {:.1f} s".format(args.sessions, time.perf_counter() - start))
+
+    measure_start = time.perf_counter()
+    time.sleep(args.duration)
+    stop.set()
+    count = len(latencies)
+    elapsed = time.perf_counter() - measure_start
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        print("{} errors, first: {}".format(len(errors), errors[0]))
+    if latencies:
+        print("requests: {}  throughput: {:.1f} req/s  p50: {:.1f} ms  p99: {:.1f} ms".format(
+            count, count / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
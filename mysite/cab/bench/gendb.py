@@ -0,0 +1,271 @@
+''' Generator of synthetic mobileSQLite databases (schema-compatible with the CAB queries), for the benchmarks
+
+The same knobs and seed always give the same database. Like the customer databases, the tables have no
+indexes besides their integer primary keys.
+
+Usage (from the mysite directory):
+    python -m cab.bench.gendb <dbfile> [--trainnumbers N] [--sections N] [--events N] [--actions N]
+                                       [--depth N] [--fanout N] [--seed N] [--force]
+'''
+
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import argparse
+
+
+SCHEMA = """
+CREATE TABLE line (LineID INTEGER PRIMARY KEY, ShortName TEXT);
+CREATE TABLE timetableperiod (TimetablePeriodID INTEGER PRIMARY KEY, ShortName TEXT);
+CREATE TABLE validcycle (ValidCycleID INTEGER PRIMARY KEY, ValidCycleListID INTEGER, FromDateDate INTEGER, UntilDateDate INTEGER, Weekdays INTEGER, ValidityBitSet BLOB);
+CREATE TABLE circulation (CirculationID INTEGER PRIMARY KEY, ShortName TEXT, FlagLoop INTEGER, TimetablePeriodID INTEGER, ValidCycleListID INTEGER);
+CREATE TABLE trainnumber (TrainNumberID INTEGER PRIMARY KEY, LineID INTEGER, ShortName TEXT, CirculationID INTEGER);
+CREATE TABLE station (StationID INTEGER PRIMARY KEY, ShortName TEXT, Abbreviation TEXT);
+CREATE TABLE linesection (LineSectionID INTEGER PRIMARY KEY, LineID INTEGER, FromStationID INTEGER, ToStationID INTEGER, LineSectionTypeID INTEGER, OrderIndex INTEGER);
+CREATE TABLE eventtrigger (EventTriggerID INTEGER PRIMARY KEY, TriggerType INTEGER, ShortName TEXT, Value INTEGER, FlagValue INTEGER);
+CREATE TABLE lineevent (LineEventID INTEGER PRIMARY KEY, LineSectionID INTEGER, ActionListID INTEGER, EventTriggerID INTEGER, OrderIndex INTEGER);
+CREATE TABLE actiontype (ActionTypeID INTEGER PRIMARY KEY, ShortName TEXT);
+CREATE TABLE mediatype (MediaTypeID INTEGER PRIMARY KEY, ParamIdentifier TEXT);
+CREATE TABLE action (ActionID INTEGER PRIMARY KEY, ActionListID INTEGER, ActionDetailID INTEGER, ActionTypeID INTEGER, MediaTypeID INTEGER, SequenceListID INTEGER);
+CREATE TABLE executionruletype (ExecutionRuleTypeID INTEGER PRIMARY KEY, TypeName TEXT);
+CREATE TABLE executionrule (ExecutionRuleID INTEGER PRIMARY KEY, ExecutionRuleTypeID INTEGER, AttributeListID INTEGER);
+CREATE TABLE complexaction (ComplexActionID INTEGER PRIMARY KEY, ExecutionRuleID INTEGER, AttributeListID INTEGER);
+CREATE TABLE complexactionchildlist (ComplexActionChildListID INTEGER PRIMARY KEY, ComplexActionID INTEGER, ActionID INTEGER, OrderIndex INTEGER);
+CREATE TABLE attributedatatype (AttributeDataTypeID INTEGER PRIMARY KEY, TypeName TEXT);
+CREATE TABLE attributetype (AttributeTypeID INTEGER PRIMARY KEY, TypeName TEXT);
+CREATE TABLE attributeint (AttributeIntID INTEGER PRIMARY KEY, AttributeTypeID INTEGER, Attribute INTEGER);
+CREATE TABLE attributetext (AttributeTextID INTEGER PRIMARY KEY, AttributeTypeID INTEGER, Attribute TEXT);
+CREATE TABLE attribute (AttributeID INTEGER PRIMARY KEY, AttributeListID INTEGER, AttributeDataTypeID INTEGER, AttributeDetailID INTEGER);
+"""
+
+ACTION_TYPES = ["Display", "Announcement", "CAStatic", "CANonstatic", "Screen"]
+MEDIA_TYPES = ["Audio", "Video", "Text"]
+RULE_TYPES = ["Serial", "Parallel", "ExactTime", "Repeat", "MaxTime"]
+INT_ATTRIBUTES = ["CA_Time", "CA_Count"]
+TEXT_ATTRIBUTES = ["CA_ExtSource", "CA_ReportStart", "CA_ReportEnd", "CA_CategoryName"]
+
+
+def packDate(year, month, day):
+    ''' Packs a date into db-format (year << 9 | month << 5 | day) '''
+    return (year << 9) | (month << 5) | day
+
+
+class Generator():
+    ''' Class to generate a synthetic database '''
+
+    def __init__(self, db_conn, trainnumbers=100, sections=10, events=3, actions=4,
+                 depth=3, fanout=3, cplx_pool=50, cplx_ratio=0.25, attr_lists=40, seed=1):
+        '''
+        Constructor
+        db_conn: database connection object (sqlite3), opened read-write
+        trainnumbers: number of train numbers (each with its own line and circulation)
+        sections: number of line sections per line
+        events: number of line events per line section
+        actions: number of actions per action list (line event)
+        depth: depth of the complex action trees
+        fanout: number of children per complex action
+        cplx_pool: number of distinct root complex actions (shared by all train numbers)
+        cplx_ratio: share of line event actions which are complex actions
+        attr_lists: number of distinct attribute lists (shared by all complex actions)
+        seed: random seed (the same knobs and seed always give the same database)
+        '''
+        self.db_conn = db_conn
+        self.trainnumbers = trainnumbers
+        self.sections = sections
+        self.events = events
+        self.actions = actions
+        self.depth = depth
+        self.fanout = fanout
+        self.cplx_pool = cplx_pool
+        self.cplx_ratio = cplx_ratio
+        self.attr_lists = attr_lists
+        self.random = random.Random(seed)
+
+        self.next_action_id = 1
+        self.next_cplx_id = 1
+        self.cplx_roots = []
+        self.subtrees = dict()   # depth -> root action ids of the complex action subtrees of that depth
+
+    def insert(self, table, rows):
+        ''' Insert the given rows (tuples) into the given table '''
+        if rows:
+            marks = ", ".join("?" * len(rows[0]))
+            self.db_conn.executemany("INSERT INTO {0} VALUES ({1})".format(table, marks), rows)
+
+    def newAction(self, act_list_id, act_det_id, act_tp):
+        ''' Create a new action row and return its action id '''
+        act_id = self.next_action_id
+        self.next_action_id += 1
+        self.action_rows.append((act_id, act_list_id, act_det_id, act_tp,
+                                 self.random.randint(1, len(MEDIA_TYPES)), None))
+        return act_id
+
+    def newComplexAction(self, depth):
+        ''' Create a new complex action (sub)tree of the given depth and return its root action id '''
+        cplx_id = self.next_cplx_id
+        self.next_cplx_id += 1
+        rule_tp = self.random.randint(1, len(RULE_TYPES))
+        self.rule_rows.append((cplx_id, rule_tp, self.random.randint(1, self.attr_lists)))
+        self.cplx_rows.append((cplx_id, cplx_id, self.random.choice([None, self.random.randint(1, self.attr_lists)])))
+        act_id = self.newAction(None, cplx_id, self.random.choice([3, 4]))
+
+        for order in range(self.fanout):
+            if depth > 1 and self.random.random() < 0.5:
+                if self.subtrees.get(depth - 1) and self.random.random() < 0.2:
+                    # share an already built subtree (of the same depth: the trees are never deeper than the knob)
+                    child_id = self.random.choice(self.subtrees[depth - 1])
+                else:
+                    child_id = self.newComplexAction(depth - 1)
+            else:
+                child_id = self.newAction(None, self.random.randint(1, 1000), self.random.choice([1, 2, 5]))
+            self.childlist_rows.append((None, cplx_id, child_id, order))
+
+        self.subtrees.setdefault(depth, []).append(act_id)
+        return act_id
+
+    def generate(self):
+        ''' Generate the whole database '''
+        self.db_conn.executescript(SCHEMA)
+        rnd = self.random
+
+        self.insert("actiontype", list(enumerate(ACTION_TYPES, 1)))
+        self.insert("mediatype", list(enumerate(MEDIA_TYPES, 1)))
+        self.insert("executionruletype", list(enumerate(RULE_TYPES, 1)))
+        self.insert("attributedatatype", [(1, "Integer"), (2, "Text")])
+        self.insert("attributetype", list(enumerate(INT_ATTRIBUTES + TEXT_ATTRIBUTES, 1)))
+        self.insert("timetableperiod", [(1, "TT2025")])
+        self.insert("station", [(i, "Station{0}".format(i), "S{0}".format(i)) for i in range(1, 201)])
+        self.insert("eventtrigger", [(i, i % 3, "Trigger{0}".format(i), i * 10, i % 2) for i in range(1, 11)])
+
+        # attribute lists (int and text values, some keys duplicated in one list)
+        attribute_rows, int_rows, text_rows = [], [], []
+        for list_id in range(1, self.attr_lists + 1):
+            for _ in range(rnd.randint(1, 4)):
+                detail_id = len(attribute_rows) + 1
+                if rnd.random() < 0.5:
+                    int_rows.append((detail_id, rnd.randint(1, len(INT_ATTRIBUTES)), rnd.choice([-1, 5, 10, 30])))
+                    attribute_rows.append((None, list_id, 1, detail_id))
+                else:
+                    text_rows.append((detail_id, rnd.randint(len(INT_ATTRIBUTES) + 1, len(INT_ATTRIBUTES) + len(TEXT_ATTRIBUTES)),
+                                      "Value{0}".format(rnd.randint(1, 20))))
+                    attribute_rows.append((None, list_id, 2, detail_id))
+        self.insert("attribute", attribute_rows)
+        self.insert("attributeint", int_rows)
+        self.insert("attributetext", text_rows)
+
+        # validity dates: a few hundred distinct values
+        vc_rows = []
+        for vc_id in range(1, 301):
+            month = rnd.randint(1, 12)
+            vc_rows.append((vc_id, vc_id, packDate(2025, month, rnd.randint(1, 28)),
+                            packDate(2026, month, rnd.randint(1, 28)), 127, None))
+        self.insert("validcycle", vc_rows)
+
+        # complex action pool
+        self.action_rows, self.rule_rows, self.cplx_rows, self.childlist_rows = [], [], [], []
+        for _ in range(self.cplx_pool):
+            self.cplx_roots.append(self.newComplexAction(self.depth))
+
+        # train numbers with lines, sections, events and actions
+        tn_rows, line_rows, circ_rows, ls_rows, le_rows = [], [], [], [], []
+        act_list_id = 0
+        for tn_id in range(1, self.trainnumbers + 1):
+            line_rows.append((tn_id, "L{0}".format(tn_id)))
+            circ_rows.append((tn_id, "C{0}".format(tn_id), 0, 1, rnd.randint(1, 300)))
+            tn_rows.append((tn_id, tn_id, "{0}".format(1000 + tn_id), tn_id))
+            for ls_order in range(self.sections):
+                ls_id = len(ls_rows) + 1
+                ls_tp = 2 if ls_order == 0 else 1
+                from_st = None if ls_order == 0 else rnd.randint(1, 200)
+                ls_rows.append((ls_id, tn_id, from_st, rnd.randint(1, 200), ls_tp, ls_order))
+                for le_order in range(self.events):
+                    act_list_id += 1
+                    le_rows.append((None, ls_id, act_list_id, rnd.randint(1, 10), le_order))
+                    for _ in range(self.actions):
+                        if rnd.random() < self.cplx_ratio:
+                            root_id = rnd.choice(self.cplx_roots)
+                            cplx_id = self.action_rows[root_id - 1][2]
+                            self.newAction(act_list_id, cplx_id, self.action_rows[root_id - 1][3])
+                        else:
+                            self.newAction(act_list_id, rnd.randint(1, 1000), rnd.choice([1, 2, 5]))
+
+        self.insert("line", line_rows)
+        self.insert("circulation", circ_rows)
+        self.insert("trainnumber", tn_rows)
+        self.insert("linesection", ls_rows)
+        self.insert("lineevent", le_rows)
+        self.insert("action", self.action_rows)
+        self.insert("executionrule", self.rule_rows)
+        self.insert("complexaction", self.cplx_rows)
+        self.insert("complexactionchildlist", self.childlist_rows)
+        self.db_conn.commit()
+
+
+def generateDatabase(dbfile, **knobs):
+    '''
+    Generate a synthetic database into the given (new) file.
+    dbfile: database file to create (must not exist)
+    knobs: scale knobs (see Generator)
+    '''
+    if os.path.exists(dbfile):
+        raise FileExistsError("database '{}' exists".format(dbfile))
+    db_conn = sqlite3.connect(dbfile)
+    try:
+        Generator(db_conn, **knobs).generate()
+    finally:
+        db_conn.close()
+
+
+def addKnobArguments(parser):
+    ''' Add the scale knobs (see Generator) as arguments to the given parser '''
+    parser.add_argument("--trainnumbers", type=int, default=100, help="number of train numbers (each with its own line)")
+    parser.add_argument("--sections", type=int, default=10, help="number of line sections per line")
+    parser.add_argument("--events", type=int, default=3, help="number of line events per line section")
+    parser.add_argument("--actions", type=int, default=4, help="number of actions per action list (line event)")
+    parser.add_argument("--depth", type=int, default=3, help="depth of the complex action trees")
+    parser.add_argument("--fanout", type=int, default=3, help="number of children per complex action")
+    parser.add_argument("--cplx-pool", type=int, default=50, help="number of distinct root complex actions")
+    parser.add_argument("--cplx-ratio", type=float, default=0.25, help="share of the line event actions which are complex actions")
+    parser.add_argument("--attr-lists", type=int, default=40, help="number of distinct attribute lists")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+
+
+def getKnobs(args):
+    ''' The scale knobs of the parsed arguments (see addKnobArguments) '''
+    return {name: getattr(args, name) for name in ("trainnumbers", "sections", "events", "actions", "depth", "fanout",
+                                                   "cplx_pool", "cplx_ratio", "attr_lists", "seed")}
+
+
+def getDatabase(knobs):
+    '''
+    Get the database of the given knobs: generated once in the temporary directory (the same knobs give the same database)
+    knobs: scale knobs (see getKnobs)
+    return database file
+    '''
+    dbfile = os.path.join(tempfile.gettempdir(), "cab-bench-{}.db".format("-".join("{}".format(value) for value in knobs.values())))
+    if not os.path.exists(dbfile):
+        start = time.perf_counter()
+        generateDatabase(dbfile + ".tmp", **knobs)
+        os.replace(dbfile + ".tmp", dbfile)
+        print("generated {} in {:.1f} s".format(dbfile, time.perf_counter() - start))
+    return dbfile
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic mobileSQLite database")
+    parser.add_argument("dbfile", help="database file to create")
+    parser.add_argument("--force", action="store_true", help="replace an existing database file")
+    addKnobArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.force and os.path.exists(args.dbfile):
+        os.remove(args.dbfile)
+    generateDatabase(args.dbfile, **getKnobs(args))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
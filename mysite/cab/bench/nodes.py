@@ -0,0 +1,122 @@
+''' Benchmark: memory per node (tracemalloc) of the actions trees, loaded and with their output built
+
+The trees are the actions of the biggest train number (line, line sections, events, actions), the biggest complex action
+tree and the train number list, read from a synthetic database (see cab.bench.gendb) or the given one.
+
+Usage (from the mysite directory):
+    python -m cab.bench.nodes [--dbfile <dbfile>] [generator knobs, see cab.bench.gendb]
+'''
+
+
+import gc
+import sys
+import argparse
+import tracemalloc
+
+
+from cab.bench import gendb
+from cab.bench import suite
+from cab.dbaccess import database
+from cab.dbaccess import action as act
+from cab.dbaccess import cplxaction as cplx
+from cab.dbaccess import trainnumber as tn
+
+
+QUERY_BIGGEST_LINE = """SELECT tr.TrainNumberID FROM trainnumber tr
+INNER JOIN linesection ls ON ls.LineID = tr.LineID
+INNER JOIN lineevent le ON le.LineSectionID = ls.LineSectionID
+INNER JOIN action a ON a.ActionListID = le.ActionListID
+GROUP BY tr.TrainNumberID
+ORDER BY COUNT(*) DESC
+LIMIT 1;"""
+
+# complex actions compared to find the biggest tree
+CPLX_CANDIDATES = 50
+
+
+def countNodes(data):
+    ''' Count the nodes (dictionaries) of an output tree or list '''
+    count = 0
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            count += 1
+            stack.extend(item.get("children") or [])
+        elif isinstance(item, list):
+            stack.extend(item)
+    return count
+
+
+def measure(load, build):
+    '''
+    Measure the memory of a tree: its loaded nodes, then with its output built (both alive, as while a request is served)
+    load: function loading the tree, return root node
+    build: function building the output of the root node
+    return (nodes, loaded bytes, built bytes, peak bytes)
+    '''
+    # once before: connection and statement caches are not counted
+    build(load())
+    gc.collect()
+    tracemalloc.start()
+    try:
+        root = load()
+        loaded = tracemalloc.get_traced_memory()[0]
+        output = build(root)
+        built, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return countNodes(output), loaded, built, peak
+
+
+def loadCplxAction(dbfile, row):
+    ''' Load a complex action tree (no memo: all nodes are read) '''
+    root = cplx.CplxAction(*row)
+    with database.Database(dbfile) as my_database:
+        cplx.DbCplxAction(my_database.db_conn).getAction(root)
+    return root
+
+
+def findBiggestCplxAction(dbfile):
+    ''' The complex action (action row) with the biggest tree among the first CPLX_CANDIDATES '''
+    with database.Database(dbfile) as my_database:
+        rows = my_database.db_conn.execute(suite.QUERY_CA_ACTIONS, (CPLX_CANDIDATES,)).fetchall()
+    return max(rows, key=lambda row: countNodes(loadCplxAction(dbfile, row).buildTree()))
+
+
+def loadTrainNumbers(dbfile):
+    with database.Database(dbfile) as my_database:
+        my_trainnumbers = tn.DbTrainNumber(my_database.db_conn)
+        my_trainnumbers.getTrainNumbers()
+    return my_trainnumbers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memory per node of the actions trees (tracemalloc)")
+    parser.add_argument("--dbfile", help="mobileSQLite database (default: generated with the knobs below)")
+    gendb.addKnobArguments(parser)
+    # a line of 20000 actions, complex actions of up to some thousand nodes
+    parser.set_defaults(trainnumbers=5, sections=100, events=10, actions=20, depth=5, fanout=4)
+    args = parser.parse_args(argv)
+
+    dbfile = args.dbfile or gendb.getDatabase(gendb.getKnobs(args))
+    print("database: {}".format(dbfile))
+
+    with database.Database(dbfile) as my_database:
+        trainNumberId = my_database.db_conn.execute(QUERY_BIGGEST_LINE).fetchone()[0]
+    cplxAction = findBiggestCplxAction(dbfile)
+
+    trees = {
+        "actions of a train number": (lambda: act.loadActions(dbfile, trainNumberId).my_line, lambda line: line.makeDict()),
+        "complex action tree": (lambda: loadCplxAction(dbfile, cplxAction), lambda root: root.buildTree()),
+        "train numbers": (lambda: loadTrainNumbers(dbfile), lambda my_trainnumbers: my_trainnumbers.trainnumbers),
+    }
+
+    print("{0:<28} {1:>8} {2:>16} {3:>16} {4:>16}".format("tree", "nodes", "loaded [B/node]", "built [B/node]", "peak [B/node]"))
+    for name, (load, build) in trees.items():
+        nodes, loaded, built, peak = measure(load, build)
+        print("{0:<28} {1:>8} {2:>16.0f} {3:>16.0f} {4:>16.0f}".format(name, nodes, loaded / nodes, built / nodes, peak / nodes))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,83 @@
+''' Benchmark: payload size and encode/decode time of the largest train number action tree, double vs single encoded
+
+"double" is the former response: json.dumps of the data, sent as a JSON string (JsonResponse encodes it again),
+parsed twice by the client. "single" sends the data itself, encoded once with json or orjson.
+
+Usage (from the mysite directory):
+    python -m cab.bench.payload <dbfile> [--trainnumbers N] [--repeat N]
+'''
+
+
+import sys
+import json
+import time
+import argparse
+
+
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+from cab.dbaccess import action as act
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encodeDouble(data):
+    return json.dumps(json.dumps(data)).encode("utf-8")
+
+
+def decodeDouble(payload):
+    return json.loads(json.loads(payload))
+
+
+def encodeJson(data):
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def timeIt(function, arg, repeat):
+    '''
+    Call the function repeat times
+    return (result of the last call, mean time in seconds)
+    '''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(arg)
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the JSON payload of a large action tree (double vs single encoded)")
+    parser.add_argument("dbfile", help="mobileSQLite database")
+    parser.add_argument("--trainnumbers", type=int, default=50, help="number of train numbers to search for the largest tree")
+    parser.add_argument("--repeat", type=int, default=20, help="number of repetitions (averaged)")
+    args = parser.parse_args(argv)
+
+    # the largest action tree of the first train numbers
+    with database.Database(args.dbfile) as my_database:
+        trainNumberIds = [row[0] for row in my_database.db_conn.execute(db_queries.QUERY_TRAINNUMBERS)][:args.trainnumbers]
+        data = None
+        for trainNumberId in trainNumberIds:
+            db_action = act.DbAction(my_database.db_conn, trainNumberId)
+            db_action.getActions()
+            actions = db_action.makeActionsDict()
+            if (data is None) or (len(encodeJson(actions)) > len(encodeJson(data))):
+                data = actions
+
+    encoders = [("double (json)", encodeDouble, decodeDouble), ("single (json)", encodeJson, json.loads)]
+    if orjson is not None:
+        encoders.append(("single (orjson)", orjson.dumps, orjson.loads))
+
+    print("train number: {0}".format(data["trainNumberId"]))
+    print("{0:<18} {1:>12} {2:>14} {3:>14}".format("encoding", "bytes", "encode [ms]", "decode [ms]"))
+    for name, encode, decode in encoders:
+        payload, encode_time = timeIt(encode, data, args.repeat)
+        decoded, decode_time = timeIt(decode, payload, args.repeat)
+        assert decoded == data
+        print("{0:<18} {1:>12} {2:>14.3f} {3:>14.3f}".format(name, len(payload), encode_time * 1000, decode_time * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,96 @@
+''' Benchmark: query plans (EXPLAIN QUERY PLAN) and times of the lookup queries, uploaded database vs its working copy
+
+The working copy (see workingcopy.py) has the indexes of the lookups: its plans must have no full table scans.
+
+Usage (from the mysite directory):
+    python -m cab.bench.queryplan <dbfile> [--mode memory|scratch] [--repeat N] [--plans]
+'''
+
+
+import sys
+import time
+import sqlite3
+import argparse
+
+
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+from cab.dbaccess import workingcopy
+
+
+def timeQuery(db_conn, query_name, parameters, repeat):
+    ''' Mean time (seconds) of a lookup query, all rows fetched '''
+    query = getattr(db_queries, query_name)
+    if "{placeholders}" in query:
+        query = query.format(placeholders="?1")
+    start = time.perf_counter()
+    for _ in range(repeat):
+        db_conn.execute(query, parameters).fetchall()
+    return (time.perf_counter() - start) / repeat
+
+
+def getParameters(db_conn):
+    ''' Parameters of the lookup queries taken from the database (a line, its first line section, action list and complex action) '''
+    lineId, lineSectionId = db_conn.execute("SELECT LineID, LineSectionID FROM linesection ORDER BY LineID, OrderIndex LIMIT 1;").fetchone()
+    trainNumberId = db_conn.execute("SELECT TrainNumberID FROM trainnumber WHERE LineID = ?;", (lineId,)).fetchone()[0]
+    actionListId = db_conn.execute("SELECT ActionListID FROM lineevent WHERE LineSectionID = ?;", (lineSectionId,)).fetchone()[0]
+    actionId, attributeListId = db_conn.execute("SELECT a.ActionID, ca.AttributeListID FROM action a "
+                                                "INNER JOIN complexaction ca ON a.ActionDetailID = ca.ComplexActionID LIMIT 1;").fetchone()
+    return {
+        "QUERY_TRAINNUMBER_ID": (trainNumberId,),
+        "QUERY_LINESECTIONS": (lineId,),
+        "QUERY_LINEEVENTS": (lineSectionId,),
+        "QUERY_LINEEVENTS_OF_LINE": (lineId,),
+        "QUERY_ACTIONS": (actionListId,),
+        "QUERY_ACTIONS_OF_LINE": (lineId,),
+        "QUERY_LINESECTION_ID": (lineId, lineSectionId),
+        "QUERY_ACTIONS_OF_LINESECTION": (lineSectionId,),
+        "QUERY_LINESECTION_COUNTS": {"id": lineId},
+        "QUERY_COMPLEX_ACTION": (actionId,),
+        "QUERY_CA_ATTRIBUTES": {"id": attributeListId},
+        "QUERY_COMPLEX_ACTION_TREE": (actionId,),
+        "QUERY_CA_ATTRIBUTE_LISTS": (attributeListId,),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Explain and time the lookup queries, uploaded database vs working copy")
+    parser.add_argument("dbfile", help="mobileSQLite database")
+    parser.add_argument("--mode", default="memory", choices=("memory", "scratch"), help="kind of working copy")
+    parser.add_argument("--repeat", type=int, default=5, help="number of repetitions (averaged)")
+    parser.add_argument("--plans", action="store_true", help="print the complete query plans")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    copy = workingcopy.makeWorkingCopy(args.dbfile, "cab-work-bench", args.mode)
+    print("working copy ({}): {} bytes, made in {:.0f} ms".format(args.mode, copy.nbytes, (time.perf_counter() - start) * 1000))
+
+    original = database.connect(args.dbfile, working_copy=False)
+    working = sqlite3.connect(copy.uri, uri=True)
+    parameters = getParameters(original)
+    plans = {"original": workingcopy.explainQueries(original), "copy": workingcopy.explainQueries(working)}
+
+    print("{0:<30} {1:>8} {2:>12} {3:>8} {4:>12}".format("query", "scans", "orig. [ms]", "scans", "copy [ms]"))
+    scans_left = 0
+    for query_name in workingcopy.LOOKUP_QUERIES:
+        original_scans = workingcopy.findScans(plans["original"][query_name])
+        copy_scans = workingcopy.findScans(plans["copy"][query_name])
+        scans_left += len(copy_scans)
+        print("{0:<30} {1:>8} {2:>12.3f} {3:>8} {4:>12.3f}".format(query_name,
+              len(original_scans), timeQuery(original, query_name, parameters[query_name], args.repeat) * 1000,
+              len(copy_scans), timeQuery(working, query_name, parameters[query_name], args.repeat) * 1000))
+        if args.plans:
+            for kind in ("original", "copy"):
+                print("    {}:".format(kind))
+                for line in plans[kind][query_name]:
+                    print("        {}".format(line))
+    print("full table scans left in the working copy: {}".format(scans_left))
+
+    working.close()
+    original.close()
+    copy.close()
+    return 1 if scans_left else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,88 @@
+''' Benchmark: per-call latency of getActions and getCplxActionTree, statements prepared on every call vs reused
+
+"before" runs with an empty statement cache (cached_statements=0): every statement is parsed and planned
+on every call, as it was with the ids formatted into the SQL text. "after" runs with the statement cache
+of the pooled connections (CACHED_STATEMENTS), where the parameterized statements are prepared once.
+
+Usage (from the mysite directory):
+    python -m cab.bench.statements <dbfile> [--calls N]
+'''
+
+
+import sys
+import time
+import argparse
+import functools
+import statistics
+
+
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+from cab.dbaccess import action as act
+from cab.dbaccess import cplxaction as cplx
+
+
+QUERY_CA_ACTIONS = """SELECT a.ActionID, a.ActionListID, a.ActionDetailID, at.ShortName, mt.ParamIdentifier
+FROM action a
+INNER JOIN actiontype at ON a.ActionTypeID = at.ActionTypeID
+INNER JOIN mediatype mt ON a.MediaTypeID = mt.MediaTypeID
+WHERE at.ShortName IN ('CAStatic', 'CANonstatic') AND a.ActionListID IS NOT NULL
+LIMIT ?;"""
+
+
+def timeCalls(function, args_list):
+    '''
+    Call the function once per arguments tuple
+    return list of latencies (seconds)
+    '''
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def getActions(db_conn, trainNumberId):
+    db_action = act.DbAction(db_conn, trainNumberId)
+    db_action.getActions()
+    return db_action.makeActionsDict()
+
+
+def getCplxActionTree(db_conn, act_id, act_list_id, act_det_id, act_typ, med_typ):
+    root_cplx = cplx.CplxAction(act_id, act_list_id, act_det_id, act_typ, med_typ)
+    cplx.DbCplxAction(db_conn).getAction(root_cplx)
+    return root_cplx.buildTree()
+
+
+def report(name, latencies):
+    print("{0:<28} {1:>10.3f} {2:>10.3f} {3:>10.3f}".format(
+        name,
+        statistics.mean(latencies) * 1000,
+        statistics.median(latencies) * 1000,
+        max(latencies) * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark per-call latency, without and with prepared statement reuse")
+    parser.add_argument("dbfile", help="mobileSQLite database")
+    parser.add_argument("--calls", type=int, default=50, help="number of calls per entry point")
+    args = parser.parse_args(argv)
+
+    db_conn = database.connect(args.dbfile)
+    trainNumberIds = [(row[0],) for row in db_conn.execute(db_queries.QUERY_TRAINNUMBERS)][:args.calls]
+    cplxActions = db_conn.execute(QUERY_CA_ACTIONS, (args.calls,)).fetchall()
+    db_conn.close()
+
+    print("{0:<28} {1:>10} {2:>10} {3:>10}".format("[ms]", "mean", "median", "max"))
+    for name, cached_statements in (("before", 0), ("after", database.CACHED_STATEMENTS)):
+        db_conn = database.connect(args.dbfile, cached_statements)
+        report("getActions ({0})".format(name),
+               timeCalls(functools.partial(getActions, db_conn), trainNumberIds))
+        report("getCplxActionTree ({0})".format(name),
+               timeCalls(functools.partial(getCplxActionTree, db_conn), cplxActions))
+        db_conn.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
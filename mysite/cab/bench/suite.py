@@ -0,0 +1,222 @@
+''' Benchmark suite of the dbaccess entry points: latency, statements and peak memory per call, on a synthetic database
+
+Each entry point is called once per sample (train number, line section or complex action), first "cold" (empty
+caches of the database: connections, complex action memo, train number index), then "warm" (same calls again).
+Latency is measured without tracemalloc, statements and peak memory (Python allocations) in a separate pass.
+
+The results can be saved (--save) and compared to saved results (--compare): the calls which got slower, issue more
+statements or need more memory than the tolerance are listed, and the suite exits non-zero.
+
+Usage (from the mysite directory):
+    python -m cab.bench.suite [--dbfile <dbfile>] [generator knobs, see cab.bench.gendb] [--samples N]
+                              [--save results.json] [--compare results.json] [--tolerance 0.25]
+'''
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import tracemalloc
+
+
+from cab.bench import gendb
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+from cab.dbaccess import search
+from cab.dbaccess import action as act
+from cab.dbaccess import cplxaction as cplx
+from cab.dbaccess import trainnumber as tn
+
+
+QUERY_CA_ACTIONS = """SELECT a.ActionID, a.ActionListID, a.ActionDetailID, at.ShortName, mt.ParamIdentifier
+FROM action a
+INNER JOIN actiontype at ON a.ActionTypeID = at.ActionTypeID
+INNER JOIN mediatype mt ON a.MediaTypeID = mt.MediaTypeID
+WHERE at.ShortName IN ('CAStatic', 'CANonstatic') AND a.ActionListID IS NOT NULL
+ORDER BY a.ActionID
+LIMIT ?;"""
+
+QUERY_LINESECTION_SAMPLES = """SELECT tr.TrainNumberID, ls.LineSectionID FROM trainnumber tr
+INNER JOIN linesection ls ON ls.LineID = tr.LineID
+WHERE ls.OrderIndex = 0
+ORDER BY tr.TrainNumberID
+LIMIT ?;"""
+
+# metrics compared by --compare: (name, unit, smallest difference which is no noise)
+METRICS = (("p50_ms", "ms", 0.25), ("statements", "statements", 0.5), ("peak_kib", "KiB", 4.0))
+
+
+def getSamples(dbfile, samples):
+    '''
+    The arguments of the entry points, taken from the database
+    dbfile: database file
+    samples: number of samples per entry point
+    return dictionary: entry point name -> (function, list of argument tuples)
+    '''
+    db_conn = database.connect(dbfile, working_copy=False)
+    try:
+        trainNumberIds = [row[0] for row in db_conn.execute(db_queries.QUERY_TRAINNUMBERS)][:samples]
+        lineSections = db_conn.execute(QUERY_LINESECTION_SAMPLES, (samples,)).fetchall()
+        cplxActions = db_conn.execute(QUERY_CA_ACTIONS, (samples,)).fetchall()
+        names = [row[2] for row in db_conn.execute(db_queries.QUERY_TRAINNUMBERS)]
+    finally:
+        db_conn.close()
+
+    return {
+        "getTrainNumbers": (tn.getTrainNumbers, [(dbfile,)] * samples),
+        "getTrainNumbers (columnar)": (tn.getTrainNumbers, [(dbfile, True)] * samples),
+        "getActions": (act.getActions, [(dbfile, trainNumberId) for trainNumberId in trainNumberIds]),
+        "getActions (lazy)": (act.getActions, [(dbfile, trainNumberId, True) for trainNumberId in trainNumberIds]),
+        "getLineSection": (act.getLineSection, [(dbfile, trainNumberId, lineSectionId) for trainNumberId, lineSectionId in lineSections]),
+        "getCplxActionTree": (cplx.getCplxActionTree, [(dbfile,) + tuple(row) for row in cplxActions]),
+        "getCplxActionTrees": (cplx.getCplxActionTrees, [(dbfile, trainNumberId) for trainNumberId in trainNumberIds]),
+        "searchTrainNumbers": (search.searchTrainNumbers, [(dbfile, (name or "")[:2]) for name in names[:samples]]),
+    }
+
+
+def resetCaches(dbfile):
+    ''' Drop the caches of the database: cold calls read it again '''
+    database.POOL.discard(dbfile)
+    cplx.removeMemo(dbfile)
+    search.INDEXES.remove(dbfile)
+
+
+def measureLatencies(function, args_list):
+    ''' Call the function once per arguments tuple, return the latencies (seconds) '''
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        result = function(*args)
+        latencies.append(time.perf_counter() - start)
+        if isinstance(result, dict) and ("exception" in result):
+            raise RuntimeError("{}{}: {}".format(function.__name__, args[1:], result["exception"]))
+    return latencies
+
+
+def measureResources(function, args_list):
+    ''' Call the function once per arguments tuple, return the statements and the peak memory (bytes) of each call '''
+    statements = []
+    peaks = []
+    for args in args_list:
+        counter = [0]
+        token = database.STATEMENTS.set(counter)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        try:
+            function(*args)
+        finally:
+            database.STATEMENTS.reset(token)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        statements.append(counter[0])
+    return statements, peaks
+
+
+def summarize(latencies, statements, peaks):
+    ''' The metrics of one entry point (cold or warm) '''
+    latencies = sorted(latencies)
+    return {
+        "calls": len(latencies),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "statements": round(statistics.mean(statements), 1),
+        "peak_kib": round(max(peaks) / 1024, 1),
+    }
+
+
+def runSuite(dbfile, samples):
+    '''
+    Run all entry points on the given database, cold and warm
+    dbfile: database file
+    samples: number of samples per entry point
+    return dictionary: "<entry point> [cold|warm]" -> metrics
+    '''
+    results = dict()
+    for name, (function, args_list) in getSamples(dbfile, samples).items():
+        # latency: cold, then warm
+        resetCaches(dbfile)
+        cold_latencies = measureLatencies(function, args_list)
+        warm_latencies = measureLatencies(function, args_list)
+
+        # statements and memory (tracemalloc slows the calls down): cold, then warm
+        resetCaches(dbfile)
+        tracemalloc.start()
+        try:
+            cold_resources = measureResources(function, args_list)
+            warm_resources = measureResources(function, args_list)
+        finally:
+            tracemalloc.stop()
+
+        results[name + " [cold]"] = summarize(cold_latencies, *cold_resources)
+        results[name + " [warm]"] = summarize(warm_latencies, *warm_resources)
+    resetCaches(dbfile)
+    return results
+
+
+def printResults(results):
+    print("{0:<34} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10} {6:>11} {7:>10}".format(
+        "entry point", "calls", "mean [ms]", "p50 [ms]", "p95 [ms]", "max [ms]", "statements", "peak [KiB]"))
+    for name, metrics in results.items():
+        print("{0:<34} {calls:>6} {mean_ms:>10.3f} {p50_ms:>10.3f} {p95_ms:>10.3f} {max_ms:>10.3f} {statements:>11} {peak_kib:>10.1f}".format(
+            name, **metrics))
+
+
+def compareResults(results, baseline, tolerance):
+    '''
+    Compare results to saved results
+    results: results of this run
+    baseline: saved results
+    tolerance: allowed relative increase of a metric (e.g. 0.25: 25 %)
+    return list of regressions (text)
+    '''
+    regressions = []
+    for name, metrics in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric, unit, noise in METRICS:
+            # small absolute differences (timer and allocator noise) are no regressions
+            if (metrics[metric] > before[metric] * (1 + tolerance)) and (metrics[metric] - before[metric] >= noise):
+                regressions.append("{}: {} {} -> {} {}".format(name, metric, before[metric], metrics[metric], unit))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark suite of the dbaccess entry points (latency, statements, peak memory)")
+    parser.add_argument("--dbfile", help="mobileSQLite database (default: generated with the knobs below)")
+    parser.add_argument("--samples", type=int, default=20, help="number of calls per entry point")
+    parser.add_argument("--save", help="save the results (JSON)")
+    parser.add_argument("--compare", help="compare to saved results (JSON)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative increase of a metric")
+    gendb.addKnobArguments(parser)
+    args = parser.parse_args(argv)
+
+    knobs = gendb.getKnobs(args)
+    dbfile = args.dbfile or gendb.getDatabase(knobs)
+    print("database: {} ({} bytes)".format(dbfile, os.path.getsize(dbfile)))
+
+    results = runSuite(dbfile, args.samples)
+    printResults(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"dbfile": dbfile, "knobs": knobs if args.dbfile is None else None, "results": results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compareResults(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            return 1
+        print("no regressions (tolerance {:.0%})".format(args.tolerance))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,70 @@
+''' Module for the cacheable (GET) variants of the database endpoints
+
+Their URLs carry the content hash of the database (see upload.findDbFile) and the ids: the response to a URL never
+changes. It is sent with a strong ETag and a long-lived Cache-Control (browser and reverse proxy), a request with
+a matching If-None-Match is answered with 304 before the view runs (no database access).
+'''
+
+
+import hashlib
+import functools
+
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.cache import add_never_cache_headers, patch_cache_control
+from django.views.decorators.http import etag
+
+
+from cab.jsonresponse import CabJsonResponse
+
+
+# part of the ETags: increment when the responses change for the same URL (e.g. new fields), cached responses are then not reused
+ETAG_VERSION = 1
+
+
+def getETag(request, *args, **kwargs):
+    ''' The (strong) ETag of a cacheable request: its URL (with the content hash of the database) and ETAG_VERSION '''
+    return '"{}"'.format(hashlib.sha256("{} {}".format(ETAG_VERSION, request.get_full_path()).encode("utf-8")).hexdigest()[:32])
+
+
+def setCacheControl(response):
+    ''' Let the response (also 304) be cached for CAB_CACHE_MAX_AGE, unless the view made it not cacheable (see makeResponse) '''
+    if not response.has_header("Cache-Control"):
+        patch_cache_control(response, public=True, max_age=settings.CAB_CACHE_MAX_AGE, immutable=True)
+    return response
+
+
+def cacheable(view):
+    '''
+    Decorator of the cacheable views (sync or async): ETag, 304 for a matching If-None-Match, Cache-Control
+    view: the view (its URL carries the content hash of the database)
+    '''
+    view = etag(getETag)(view)
+
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def cacheableView(request, *args, **kwargs):
+            return setCacheControl(await view(request, *args, **kwargs))
+    else:
+        @functools.wraps(view)
+        def cacheableView(request, *args, **kwargs):
+            return setCacheControl(view(request, *args, **kwargs))
+    return cacheableView
+
+
+def makeResponse(response_data):
+    '''
+    Make the response of a cacheable view: errors (e.g. database not stored or removed) are not cached
+    response_data: the data of the response
+    return response
+    '''
+    response = CabJsonResponse(response_data)
+    if isinstance(response_data, dict) and ("exception" in response_data):
+        add_never_cache_headers(response)
+    return response
+
+
+def unknownDatabase(digest):
+    ''' The response data of a content hash which is not stored '''
+    return {"exception": "no database stored with hash '{}'".format(digest)}
@@ -3,19 +3,22 @@
 
 import sys
 import traceback
-import datetime
 import logging
 
 
 from cab.dbaccess import database
 from cab.dbaccess import db_queries
+from cab.dbaccess import snapshot
+from cab.dbaccess import trainnumber as tn
 
 
 logger = logging.getLogger(__name__)
 
 
 class Action():
-    ''' Class to hold an action '''
+    ''' Class to hold an action (the dictionary is made on demand, not kept) '''
+
+    __slots__ = ("act_id", "act_det_id", "act_tp", "med_tp")
 
     def __init__(self, act_id, act_det_id, act_tp, med_tp):
         '''
@@ -30,21 +33,29 @@ class Action():
         self.act_tp = act_tp
         self.med_tp = med_tp
 
-        self.action = dict()
+    def makeFields(self):
+        ''' Make the fields of the action dictionary (see iterJson) '''
+        return {
+            'childType': 'action',
+            'actionId': self.act_id,
+            'actionDetailId': self.act_det_id,
+            'actionType': self.act_tp,
+            'mediaType': self.med_tp
+        }
+
+    def getChildren(self):
+        ''' An action has no children (see iterJson) '''
+        return None
 
     def makeDict(self):
-        ''' Make the action dictionary (fill in content) '''
-        self.action['childType'] = 'action'
-        self.action['actionId'] = self.act_id
-        self.action['actionDetailId'] = self.act_det_id
-        self.action['actionType'] = self.act_tp
-        self.action['mediaType'] = self.med_tp
-        
-        return self.action
+        ''' Make the action dictionary '''
+        return self.makeFields()
 
 
 class LineEvent():
-    ''' Class to hold a line section event '''
+    ''' Class to hold a line section event (the dictionary is made on demand, not kept) '''
+
+    __slots__ = ("ev_id", "ac_lst", "trg_nm", "actions")
 
     def __init__(self, ev_id, ac_lst, trg_nm):
         '''
@@ -58,24 +69,30 @@ class LineEvent():
         self.trg_nm = trg_nm
         
         self.actions = []
-        self.lineevent = dict()
+
+    def makeFields(self):
+        ''' Make the fields of the event dictionary, without its children (see iterJson) '''
+        return {
+            'childType': 'lineEvent',
+            'eventId': self.ev_id,
+            'actionListId': self.ac_lst,
+            'trigger': self.trg_nm
+        }
+
+    def getChildren(self):
+        return self.actions
 
     def makeDict(self):
-        ''' Make the event dictionary (fill in content) '''
-        self.lineevent['childType'] = 'lineEvent'
-        self.lineevent['eventId'] = self.ev_id
-        self.lineevent['actionListId'] = self.ac_lst
-        self.lineevent['trigger'] = self.trg_nm
-        self.lineevent['children'] = []
-
-        for act in self.actions:
-            self.lineevent['children'].append(act.makeDict())
-        
-        return self.lineevent
+        ''' Make the event dictionary '''
+        lineevent = self.makeFields()
+        lineevent['children'] = [act.makeDict() for act in self.actions]
+        return lineevent
 
 
 class LineSection():
-    ''' Class to hold a line section '''
+    ''' Class to hold a line section (the dictionary is made on demand, not kept) '''
+
+    __slots__ = ("ls_id", "from_st", "to_st", "from_st_abbr", "ls_tp", "to_st_abbr", "events", "event_count", "action_count")
 
     def __init__(self, ls_id, from_st, from_st_abbr, to_st, to_st_abbr, ls_tp):
         '''
@@ -93,27 +110,39 @@ class LineSection():
         self.to_st_abbr = to_st_abbr
 
         self.events = []
-        self.linesection = dict()
+        self.event_count = None    # lazy mode: events are not loaded, only counted
+        self.action_count = None
+
+    def makeFields(self):
+        ''' Make the fields of the line section dictionary, without its children (see iterJson) '''
+        fields = {
+            'childType': 'lineSection',
+            'lineSectionId': self.ls_id,
+            'fromStation': self.from_st,
+            'fromStationAbbr': self.from_st_abbr,
+            'toStation': self.to_st,
+            'toStationAbbr': self.to_st_abbr,
+            'lineSectionType': self.ls_tp
+        }
+        if self.event_count is not None:
+            fields['eventCount'] = self.event_count
+            fields['actionCount'] = self.action_count
+        return fields
+
+    def getChildren(self):
+        return self.events
 
     def makeDict(self):
-        ''' Make the line section dictionary (fill in content) '''
-        self.linesection['childType'] = 'lineSection'
-        self.linesection['lineSectionId'] = self.ls_id
-        self.linesection['fromStation'] = self.from_st
-        self.linesection['fromStationAbbr'] = self.from_st_abbr
-        self.linesection['toStation'] = self.to_st
-        self.linesection['toStationAbbr'] = self.to_st_abbr
-        self.linesection['lineSectionType'] = self.ls_tp
-        self.linesection['children'] = []
-
-        for le in self.events:
-            self.linesection['children'].append(le.makeDict())
-        
-        return self.linesection
+        ''' Make the line section dictionary '''
+        linesection = self.makeFields()
+        linesection['children'] = [le.makeDict() for le in self.events]
+        return linesection
 
 
 class Line():
-    ''' Class to hold a line (train number) '''
+    ''' Class to hold a line (train number), the dictionary is made on demand, not kept '''
+
+    __slots__ = ("tn_id", "tr_sn", "line_id", "circ_id", "from_date", "to_date", "line_sections")
 
     def __init__(self, tn_id, tr_sn, line_id, circ_id, from_date, to_date):
         '''
@@ -133,121 +162,315 @@ class Line():
         self.to_date = to_date
 
         self.line_sections = []
-        self.line = dict()
+
+    def makeFields(self):
+        ''' Make the fields of the line dictionnary, without its children (see iterJson) '''
+        return {
+            'childType': 'trainNumber',
+            'trainNumberId': self.tn_id,
+            'trainNumberShortName': self.tr_sn,
+            'lineId': self.line_id,
+            'circulationId': self.circ_id,
+            'fromDate': self.convertDbDate(self.from_date),
+            'toDate': self.convertDbDate(self.to_date)
+        }
+
+    def getChildren(self):
+        return self.line_sections
 
     def makeDict(self):
-        ''' Make the line dictionnary (fill in content) '''
-        self.line['childType'] = 'trainNumber'
-        self.line['trainNumberId'] = self.tn_id
-        self.line['trainNumberShortName'] = self.tr_sn
-        self.line['lineId'] = self.line_id
-        self.line['circulationId'] = self.circ_id
-        self.line['fromDate'] = self.convertDbDate(self.from_date)
-        self.line['toDate'] = self.convertDbDate(self.to_date)
-        self.line['children'] = []
-
-        for ls in self.line_sections:
-            self.line['children'].append(ls.makeDict())
-        
-        return self.line
+        ''' Make the line dictionnary '''
+        line = self.makeFields()
+        line['children'] = [ls.makeDict() for ls in self.line_sections]
+        return line
     
 
     def convertDbDate(self, dbdate):
         ''' Converts a dbdate from db-format into unix epoch time '''
-        year = (dbdate >> 9)
-        month = ((dbdate >> 5) & 0xF)
-        day = (dbdate & 0x1F)
-        myDateTime = datetime.datetime(year, month, day)
-        #print(year, month, day, myDateTime.timestamp());
-        return int(myDateTime.timestamp())
+        return tn.convertDbDate(dbdate)
 
 
 class DbAction():
     ''' Class to handle train number (line) actions (with line sections, triggers, etc) '''
 
-    def __init__(self, db_conn, trainNumberId):
+    def __init__(self, db_conn, trainNumberId, my_snapshot=None):
         '''
         Constructor
-        db_conn: database connection object (sqlite3)
+        db_conn: database connection object (sqlite3), not used if a snapshot is given
         trainNumberId: train number id (line)
+        my_snapshot: snapshot (in-memory index) of the database, or None
         '''
         self.db_conn = db_conn
         self.trainNumberId = trainNumberId
+        self.snapshot = my_snapshot
         self.my_line = None
 
-    def getActions(self):
+    def getActions(self, lazy=False):
         '''
-        Get actions (with line sections, triggers, etc)
+        Get actions (with line sections, triggers, etc).
+        Each level (line sections, line events, actions) is read with one query for the whole line,
+        the tree is then built in memory.
+        lazy: get the line sections only, with the number of their events and actions (see getLineSection)
         '''
         #print("getActions: ")
 
-        cursor = self.db_conn.execute(str(db_queries.QUERY_TRAINNUMBER_ID).format(self.trainNumberId))
-        for row in cursor:
+        if self.snapshot is None:
+            rows = self.db_conn.execute(db_queries.QUERY_TRAINNUMBER_ID, (self.trainNumberId,)).fetchall()
+        else:
+            rows = self.snapshot.trainnumber.get(int(self.trainNumberId), [])
+
+        for row in rows:
             #print("TrainNumber: row={0}".format(row))
             self.my_line = Line(
-                self.trainNumberId, 
+                self.trainNumberId,
                 row[1],   # trainnumber shortname
                 row[0],   # line id
                 row[2],   # circulation id
                 row[8],   # from date
                 row[9]    # to date
                 )
-            
-            cursor2 = self.db_conn.execute(str(db_queries.QUERY_LINESECTIONS).format(row[0]))
-            for row2 in cursor2:
-                #print("LineSections: row={0}".format(row2))
-                lineSection = LineSection(
-                    row2[0],   # line section id
-                    row2[2],   # from station shortname
-                    row2[3],   # from station abbreviation
-                    row2[5],   # to station shortname
-                    row2[6],   # to station abbreviation
-                    row2[7]
-                    )
-                
-                cursor3 = self.db_conn.execute(str(db_queries.QUERY_LINEEVENTS).format(row2[0]))
-                for row3 in cursor3:
-                    #print("LineEvents: row={0}".format(row3))
-                    lineevent = LineEvent(
-                        row3[0],   # line event id
-                        row3[1],   # action list id
-                        row3[3]    # trigger
-                    )
-
-                    cursor4 = self.db_conn.execute(str(db_queries.QUERY_ACTIONS).format(row3[1]))
-                    for row4 in cursor4:
-                        #print("Actions: row={0}".format(row4))
-                        action = Action(
-                            row4[0],   # action id
-                            row4[1],   # action detail id
-                            row4[2],   # action type
-                            row4[3]    # media type
-                        )
-                        lineevent.actions.append(action)
-
-                    lineSection.events.append(lineevent)
-
-                self.my_line.line_sections.append(lineSection)
+            self.getLineSections(self.my_line, lazy)
+
+    def getLineSections(self, line: Line, lazy=False):
+        '''
+        Get all line sections (with events and actions) of the given line
+        line: line object
+        lazy: get the number of events and actions of each line section instead of the events and actions
+        '''
+        if lazy:
+            counts = self.getLineSectionCounts(line.line_id)
+        elif self.snapshot is None:
+            actions = self.getLineActions(line.line_id)
+            events = self.getLineEvents(line.line_id)
+        else:
+            actions = self.snapshot.actions
+            events = self.snapshot.lineevents
+
+        if self.snapshot is None:
+            sections = self.db_conn.execute(db_queries.QUERY_LINESECTIONS, (line.line_id,))
+        else:
+            sections = self.snapshot.linesections.get(line.line_id, [])
+
+        for row in sections:
+            #print("LineSections: row={0}".format(row))
+            lineSection = self.makeLineSection(row)
+            if lazy:
+                lineSection.event_count, lineSection.action_count = counts.get(row[0], (0, 0))
+            else:
+                self.addLineEvents(lineSection, events.get(row[0], []), actions)
+
+            line.line_sections.append(lineSection)
+
+    def getLineSection(self, line_id, lineSectionId):
+        '''
+        Get one line section with its events and actions (lazy mode: loaded on demand)
+        line_id: line id
+        lineSectionId: line section id
+        return line section object, None if the line has no such section
+        '''
+        lineSectionId = int(lineSectionId)
+        if self.snapshot is None:
+            sections = self.db_conn.execute(db_queries.QUERY_LINESECTION_ID, (line_id, lineSectionId)).fetchall()
+            events = self.db_conn.execute(db_queries.QUERY_LINEEVENTS, (lineSectionId,)).fetchall()
+            actions = dict()
+            cursor = self.db_conn.execute(db_queries.QUERY_ACTIONS_OF_LINESECTION, (lineSectionId,))
+            for row in cursor:
+                actions.setdefault(row[6], []).append(row)
+        else:
+            sections = [row for row in self.snapshot.linesections.get(int(line_id), []) if row[0] == lineSectionId]
+            events = self.snapshot.lineevents.get(lineSectionId, [])
+            actions = self.snapshot.actions
+
+        for row in sections:
+            lineSection = self.makeLineSection(row)
+            self.addLineEvents(lineSection, events, actions)
+            return lineSection
+        return None
+
+    def makeLineSection(self, row):
+        '''
+        Make a line section (without events) from a line sections row
+        row: row of QUERY_LINESECTIONS
+        return line section object
+        '''
+        return LineSection(
+            row[0],   # line section id
+            row[2],   # from station shortname
+            row[3],   # from station abbreviation
+            row[5],   # to station shortname
+            row[6],   # to station abbreviation
+            row[7]    # line section type
+            )
+
+    def addLineEvents(self, lineSection: LineSection, event_rows, actions):
+        '''
+        Add the events (with their actions) to the given line section
+        lineSection: line section object
+        event_rows: line event rows of the line section (ordered)
+        actions: dictionary (or snapshot table): action list id -> list of action rows
+        '''
+        for ev_row in event_rows:
+            #print("LineEvents: row={0}".format(ev_row))
+            lineevent = LineEvent(
+                ev_row[0],   # line event id
+                ev_row[1],   # action list id
+                ev_row[3]    # trigger
+            )
+
+            for act_row in actions.get(ev_row[1], []):
+                #print("Actions: row={0}".format(act_row))
+                lineevent.actions.append(Action(
+                    act_row[0],   # action id
+                    act_row[1],   # action detail id
+                    act_row[2],   # action type
+                    act_row[3]    # media type
+                ))
+
+            lineSection.events.append(lineevent)
+
+    def getLineSectionCounts(self, line_id):
+        '''
+        Count the events and actions of each line section of the given line
+        line_id: line id
+        return dictionary: line section id -> (number of events, number of actions)
+        '''
+        counts = dict()
+        if self.snapshot is None:
+            cursor = self.db_conn.execute(db_queries.QUERY_LINESECTION_COUNTS, {"id": line_id})
+            for row in cursor:
+                counts[row[0]] = (row[1], row[2] or 0)
+        else:
+            for row in self.snapshot.linesections.get(line_id, []):
+                event_rows = self.snapshot.lineevents.get(row[0], [])
+                counts[row[0]] = (
+                    len(event_rows),
+                    sum(len(self.snapshot.actions.get(ev_row[1], [])) for ev_row in event_rows))
+
+        return counts
+
+    def getLineEvents(self, line_id):
+        '''
+        Get all line events of the given line
+        line_id: line id
+        return dictionary: line section id -> list of line event rows (ordered)
+        '''
+        events = dict()
+        cursor = self.db_conn.execute(db_queries.QUERY_LINEEVENTS_OF_LINE, (line_id,))
+        for row in cursor:
+            events.setdefault(row[6], []).append(row)
+
+        return events
+
+    def getLineActions(self, line_id):
+        '''
+        Get all actions of the given line
+        line_id: line id
+        return dictionary: action list id -> list of action rows
+        '''
+        actions = dict()
+        cursor = self.db_conn.execute(db_queries.QUERY_ACTIONS_OF_LINE, (line_id,))
+        for row in cursor:
+            actions.setdefault(row[6], []).append(row)
+
+        return actions
 
-    
     def makeActionsDict(self):
         return self.my_line.makeDict()
 
 
-def getActions(dbfile, trainNumberId):
+def loadActions(dbfile, trainNumberId, lazy=False):
+    '''
+    Load all actions (with line sections, triggers, etc) of the given train number (line) from the given database
+    dbfile: database file
+    trainNumberId: train number id
+    lazy: load the line sections only, with the number of their events and actions (see getLineSection)
+    return DbAction object (with the loaded line, None if the train number is not found)
+    '''
+    my_snapshot = snapshot.getSnapshot(dbfile)
+    if my_snapshot is not None:
+        # answer from the in-memory snapshot
+        db_action = DbAction(None, trainNumberId, my_snapshot)
+        with database.phase("fetch"):
+            db_action.getActions(lazy)
+        return db_action
+
+    with database.Database(dbfile) as my_database:
+        db_action = DbAction(my_database.db_conn, trainNumberId)
+        with database.phase("fetch"):
+            db_action.getActions(lazy)
+    return db_action
+
+
+def iterJson(node, encode):
+    '''
+    Serialize an actions tree node by node, without building its dictionary: the JSON is the same as encode(node.makeDict())
+    node: node of the tree (line, line section, event or action object)
+    encode: function encoding a dictionary as compact JSON (bytes)
+    yield JSON fragments (bytes)
+    '''
+    fields = node.makeFields()
+    children = node.getChildren()
+    if children is None:
+        yield encode(fields)
+        return
+
+    if all(child.getChildren() is None for child in children):
+        # the children are leaves (actions): encoded with the node, at once
+        fields['children'] = [child.makeFields() for child in children]
+        yield encode(fields)
+        return
+
+    # 'children' is the last field: the node is sent up to its '[', then the children, then ']}'
+    fields['children'] = []
+    yield encode(fields)[:-2]
+    separator = b""
+    for child in children:
+        yield separator
+        yield from iterJson(child, encode)
+        separator = b","
+    yield b"]}"
+
+
+def getActionTree(dbfile, trainNumberId, lazy=False):
+    '''
+    Retrieve all actions of the given train number (line) from the given database, as tree of objects to serialize (see iterJson)
+    dbfile: database file
+    trainNumberId: train number id
+    lazy: retrieve the line sections only, with the number of their events and actions (see getLineSection)
+    return line object, or json (exception)
+    '''
+    try:
+        line = loadActions(dbfile, trainNumberId, lazy).my_line
+        if line is None:
+            raise database.DatabaseException("train number {} not found".format(trainNumberId))
+        return line
+
+    except database.DatabaseException as e:
+        logger.error("Programm ended with a database error:{}".format(str(e)))
+        return {"exception":"{}".format(str(e))}
+
+    except:
+        logger.error("Programm ended with unknown error: see message below")
+        exception_type, exception_value, exception_traceback = sys.exc_info()
+        logger.error("Exception Type: {}, Exception Value: {}".format(exception_type, exception_value))
+        file_name, line_number, procedure_name, line_code = traceback.extract_tb(exception_traceback)[-1]
+        logger.error("File Name: {}, Line Number: {}, Procedure Name: {}, Line Code: {}".format(file_name, line_number, procedure_name, line_code))
+        return {"exception":"{}".format(str(exception_value))}
+
+
+def getActions(dbfile, trainNumberId, lazy=False):
     '''
     Retrieve all actions (with line sections, triggers, etc) of the given train number (line) from the given database.
     dbfile: database file
     trainNumberId: train number id
+    lazy: retrieve the line sections only, with the number of their events and actions (see getLineSection)
     return actions as json
     '''
     try:
-        my_database = database.Database(dbfile)
-        db_action = DbAction(my_database.db_conn, trainNumberId)
-        db_action.getActions()
-        actions = db_action.makeActionsDict()
+        db_action = loadActions(dbfile, trainNumberId, lazy)
+        with database.phase("build"):
+            actions = db_action.makeActionsDict()
         #print(actions)
-        my_database.close()
         return actions
 
     except database.DatabaseException as e:
@@ -261,4 +484,39 @@ def getActions(dbfile, trainNumberId):
         file_name, line_number, procedure_name, line_code = traceback.extract_tb(exception_traceback)[-1]
         logger.error("File Name: {}, Line Number: {}, Procedure Name: {}, Line Code: {}".format(file_name, line_number, procedure_name, line_code))
         return {"exception":"{}".format(str(exception_value))}
-    
\ No newline at end of file
+
+
+def getLineSection(dbfile, lineId, lineSectionId):
+    '''
+    Retrieve one line section with its events and actions from the given database (lazy mode: loaded on demand).
+    dbfile: database file
+    lineId: line id
+    lineSectionId: line section id
+    return line section as json
+    '''
+    try:
+        my_snapshot = snapshot.getSnapshot(dbfile)
+        if my_snapshot is not None:
+            # answer from the in-memory snapshot
+            with database.phase("fetch"):
+                lineSection = DbAction(None, None, my_snapshot).getLineSection(lineId, lineSectionId)
+        else:
+            with database.Database(dbfile) as my_database, database.phase("fetch"):
+                lineSection = DbAction(my_database.db_conn, None).getLineSection(lineId, lineSectionId)
+
+        if lineSection is None:
+            raise database.DatabaseException("line {} has no line section {}".format(lineId, lineSectionId))
+        with database.phase("build"):
+            return lineSection.makeDict()
+
+    except database.DatabaseException as e:
+        logger.error("Programm ended with a database error:{}".format(str(e)))
+        return {"exception":"{}".format(str(e))}
+
+    except:
+        logger.error("Programm ended with unknown error: see message below")
+        exception_type, exception_value, exception_traceback = sys.exc_info()
+        logger.error("Exception Type: {}, Exception Value: {}".format(exception_type, exception_value))
+        file_name, line_number, procedure_name, line_code = traceback.extract_tb(exception_traceback)[-1]
+        logger.error("File Name: {}, Line Number: {}, Procedure Name: {}, Line Code: {}".format(file_name, line_number, procedure_name, line_code))
+        return {"exception":"{}".format(str(exception_value))}
@@ -4,17 +4,52 @@
 import sys
 import traceback
 import logging
+import sqlite3
+import threading
+import collections
+import contextvars
+import concurrent.futures
 
 
 from cab.dbaccess import database
 from cab.dbaccess import db_queries
+from cab.dbaccess import snapshot
+from cab.dbaccess import action as act
 
 
 logger = logging.getLogger(__name__)
 
 
+# action types of complex actions (actions having children)
+CA_ACTION_TYPES = ("CAStatic", "CANonstatic")
+
+# maximum depth of a complex action tree (deeper trees are rejected)
+MAX_TREE_DEPTH = 256
+
+# maximum number of ids in one 'IN (...)' list of a query
+MAX_BATCH_IDS = 512
+
+# smallest 'IN (...)' list: lists are padded to a power of two, so that only a few different statements are prepared
+MIN_BATCH_IDS = 8
+
+# maximum number of complex action subtrees memoized per database
+MEMO_SIZE = 10000
+
+# number of threads resolving the complex actions of batch requests (process-wide)
+BATCH_WORKERS = 4
+
+# attribute data types decoded (column of the value in the rows of QUERY_CA_ATTRIBUTE_LISTS), attributes of other types are ignored
+ATTRIBUTE_VALUE_COLUMNS = {'Integer': 3, 'Text': 4}
+
+# errors of the recursive query after which the walker is used: SQLite cannot prepare it (e.g. 'WITH RECURSIVE' not supported),
+# other errors (e.g. 'interrupted' by a cancelled job, database locked, disk I/O) are raised
+FALLBACK_ERRORS = ("syntax error", "no such")
+
+
 class CplxAction():
-    ''' Class to hold an action '''
+    ''' Class to hold an action (its tree is built on demand, not kept) '''
+
+    __slots__ = ("act_id", "act_list_id", "act_det_id", "act_typ", "med_typ", "typ", "children", "attributes", "subtree")
 
     def __init__(self, act_id, act_list_id, act_det_id, act_typ, med_typ):
         '''
@@ -33,8 +68,8 @@ class CplxAction():
         self.typ = act_typ   # this type is overwritten for complex action (e.g. 'Serial' instead of 'CAStatic')
 
         self.children = []
-        self.attributes = []
-        self.tree = dict()
+        self.attributes = []   # attribute lists (shared, see AttributeLists), in database order
+        self.subtree = None   # memoized (type, attribute lists, frozen children trees, height) of the complex action, see SubtreeMemo
 
     def addChild(self, action):
         '''
@@ -44,39 +79,335 @@ class CplxAction():
         self.children.append(action)
 
     def buildTree(self):
-        ''' Build the action data (content) tree (dictionnary) '''
-        self.tree['type'] = self.typ
-        self.tree['actionId'] = self.act_id
-        self.tree['actionDetailId'] = self.act_det_id
-        self.tree['actionType'] = self.act_typ
-        self.tree['mediaType'] = self.med_typ
-
-        for attr in self.attributes:
-            for key, value in attr.items():
-                if key in self.tree:
-                    # append to existing attribute
-                    self.tree[key] = str("{0}, {1}").format(self.tree[key], value)
+        ''' Build the action data (content) tree (dictionnary), the action objects do not keep it '''
+        # iterative (depth first) to support trees deeper than the python recursion limit:
+        # each node is taken with its (empty) tree dictionary, created by its parent
+        root = dict()
+        actions = [(self, root)]
+        # frozen nodes of the memo (see SubtreeMemo) with their tree dictionary: copied, never handed out
+        frozen = []
+        while actions:
+            action, tree = actions.pop()
+            tree['type'] = action.typ
+            tree['actionId'] = action.act_id
+            tree['actionDetailId'] = action.act_det_id
+            tree['actionType'] = action.act_typ
+            tree['mediaType'] = action.med_typ
+
+            if action.subtree is not None:
+                # memoized: the attributes are merged as for a built node, the children trees are copied from the memo
+                if action.subtree[1]:
+                    mergeAttributes(tree, action.subtree[1])
+                tree['children'] = [dict() for child in action.subtree[2]]
+                frozen.extend(zip(action.subtree[2], tree['children']))
+                continue
+
+            if action.attributes:
+                mergeAttributes(tree, action.attributes)
+
+            tree['children'] = [dict() for child in action.children]
+            actions.extend(zip(action.children, tree['children']))
+
+        while frozen:
+            (items, children), tree = frozen.pop()
+            tree.update(items)
+            tree['children'] = [dict() for child in children]
+            frozen.extend(zip(children, tree['children']))
+
+        return root
+
+
+def decodeAttributeList(rows):
+    '''
+    Decode the rows of an attribute list
+    rows: attribute rows (columns of QUERY_CA_ATTRIBUTE_LISTS)
+    return attribute list: tuple of (attribute, value), the value typed as in the database (int for 'Integer', str for 'Text')
+    '''
+    return tuple((row[1], row[ATTRIBUTE_VALUE_COLUMNS[row[2]]]) for row in rows if row[2] in ATTRIBUTE_VALUE_COLUMNS)
+
+
+def mergeAttributes(tree, attributeLists):
+    '''
+    Add the attributes of the given lists to an action tree node, in linear time:
+    the values of an attribute found more than once are joined into one text ('value1, value2, ...')
+    tree: action tree node (dictionary)
+    attributeLists: attribute lists (see decodeAttributeList)
+    '''
+    values = dict()
+    for attributes in attributeLists:
+        for key, value in attributes:
+            key_values = values.get(key)
+            if key_values is None:
+                values[key] = [value]
+            else:
+                key_values.append(value)
+
+    for key, key_values in values.items():
+        if key in tree:
+            # e.g. an attribute named as a node key: appended to it
+            key_values.insert(0, tree[key])
+        tree[key] = key_values[0] if len(key_values) == 1 else ", ".join(map(str, key_values))
+
+
+class AttributeLists():
+    '''
+    Class to hold the decoded attribute lists of one database, by attribute list id (thread-safe).
+    The lists missing when a tree is read are loaded in bulk, decoded once and shared by all trees (and their nodes).
+    '''
+
+    def __init__(self):
+        ''' Constructor '''
+        self.lists = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, attrListIds, load):
+        '''
+        Get the given attribute lists, the missing ones are loaded
+        attrListIds: attribute list ids (None is ignored)
+        load: function (list of attribute list ids) -> dictionary: attribute list id -> attribute rows (columns of QUERY_CA_ATTRIBUTE_LISTS)
+        return dictionary: attribute list id -> attribute list (see decodeAttributeList), empty if the list has no attributes
+        '''
+        found = dict()
+        missing = []
+        with self.lock:
+            for attrListId in attrListIds:
+                if (attrListId is None) or (attrListId in found):
+                    continue
+                attributes = self.lists.get(attrListId)
+                if attributes is None:
+                    missing.append(attrListId)
                 else:
-                    # create new attribute
-                    self.tree[key] = value
+                    found[attrListId] = attributes
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            rows = load(missing)
+            loaded = {attrListId: decodeAttributeList(rows.get(attrListId, [])) for attrListId in missing}
+            with self.lock:
+                self.lists.update(loaded)
+            found.update(loaded)
+        return found
 
-        self.tree['children'] = []
-        for action in self.children:
-            action.buildTree()
-            self.tree['children'].append(action.tree)
-        
-        return self.tree
+    def stats(self):
+        ''' Attribute list counters (hits, misses, entries) '''
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.lists)}
+
+
+class SubtreeMemo():
+    '''
+    Class to hold the built subtrees of the complex actions of one database, by action id (thread-safe, LRU eviction).
+    A subtree only depends on the action id: its type, its attributes and its children trees.
+    The subtrees are kept frozen (tuples, see putTree) and copied into new dictionaries by CplxAction.buildTree:
+    a tree given by the memo can be changed by its caller (e.g. while it is served or cached), the memo is not.
+    A hit saves the queries of the subtree, not its size: the subtree is still copied (one dictionary per node).
+    '''
+
+    def __init__(self, max_entries=MEMO_SIZE):
+        '''
+        Constructor
+        max_entries: maximum number of subtrees kept
+        '''
+        self.max_entries = max_entries
+        self.subtrees = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, act_id):
+        '''
+        Get the subtree of the given complex action
+        act_id: action id
+        return (type, attribute lists, frozen children trees, height), None if not memoized
+        '''
+        with self.lock:
+            subtree = self.subtrees.get(act_id)
+            if subtree is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.subtrees.move_to_end(act_id)
+            return subtree
+
+    def putTree(self, action: CplxAction, tree):
+        '''
+        Memoize the subtrees of all complex actions of the given action tree, frozen: a node as (tuple of its
+        (key, value) items except the children, tuple of its frozen children). The attribute lists of a complex action are
+        kept apart from its node (its node keys are given by its parent): an attribute named as a node key (e.g. 'type')
+        is merged into it on a hit, as in a built tree.
+        The frozen nodes are shared between the subtrees of the memo only, not with the given tree.
+        action: root action object
+        tree: its built tree (see CplxAction.buildTree), walked along with the action objects
+        '''
+        # post order (children first): the height and the frozen children of a subtree are known when it is memoized
+        heights = dict()
+        frozen = dict()
+        subtrees = []
+        actions = [(action, tree, False)]
+        while actions:
+            node, node_tree, visited = actions.pop()
+            if node.subtree is not None:
+                heights[id(node)] = node.subtree[3]
+                children = node.subtree[2]
+            elif not visited:
+                actions.append((node, node_tree, True))
+                actions.extend((child, child_tree, False) for child, child_tree in zip(node.children, node_tree['children']))
+                continue
+            else:
+                children = tuple(frozen[id(child)] for child in node.children)
+                if node.act_typ in CA_ACTION_TYPES:
+                    # the height counts complex actions only (as the depth, see buildComplexActionTree)
+                    heights[id(node)] = 1 + max((heights[id(child)] for child in node.children), default=0)
+                    subtrees.append((int(node.act_id), (node.typ, tuple(node.attributes), children, heights[id(node)])))
+                else:
+                    heights[id(node)] = 0
+            frozen[id(node)] = (tuple((key, value) for key, value in node_tree.items() if key != 'children'), children)
+
+        with self.lock:
+            # the root first (evicted before its subtrees)
+            for act_id, subtree in reversed(subtrees):
+                self.subtrees[act_id] = subtree
+                self.subtrees.move_to_end(act_id)
+            while len(self.subtrees) > self.max_entries:
+                self.subtrees.popitem(last=False)
+
+    def stats(self):
+        ''' Memo counters (hits, misses, entries) '''
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.subtrees)}
+
+
+class InFlight():
+    '''
+    Class to hold the complex actions being built by the resolvers of one batch request, by action id (thread-safe):
+    a resolver meeting a complex action built by another one waits for its subtree and takes it from the memo,
+    instead of reading and building it again.
+    A resolver registers the complex actions of its tree once they are read (see register), and waits while it reads only:
+    a resolver holding registrations never waits for another one (no deadlock).
+    '''
+
+    def __init__(self):
+        ''' Constructor '''
+        self.events = dict()
+        self.lock = threading.Lock()
+
+    def register(self, action: CplxAction):
+        '''
+        Register the complex actions of the given tree which are not memoized (read, being built)
+        action: root action object (read, see DbCplxAction.getAction)
+        return event to set once the subtrees are memoized (or cannot be built)
+        '''
+        act_ids = []
+        actions = [action]
+        while actions:
+            node = actions.pop()
+            if (node.act_typ in CA_ACTION_TYPES) and (node.subtree is None):
+                act_ids.append(int(node.act_id))
+                actions.extend(node.children)
+        event = threading.Event()
+        with self.lock:
+            for act_id in act_ids:
+                # built by the first resolver registering it
+                self.events.setdefault(act_id, event)
+        return event
+
+    def wait(self, act_id):
+        '''
+        Wait for the given complex action if it is built by a resolver
+        act_id: action id
+        return True if waited (the subtree is memoized, unless it could not be built or was evicted since)
+        '''
+        with self.lock:
+            event = self.events.get(act_id)
+        if event is None:
+            return False
+        event.wait()
+        return True
+
+
+# the subtree memos and the attribute lists, by database
+MEMOS = dict()
+ATTRIBUTE_LISTS = dict()
+MEMOS_LOCK = threading.Lock()
+
+
+def getMemo(dbfile):
+    '''
+    Get the subtree memo of the given database (created on first use)
+    dbfile: database file
+    return memo object
+    '''
+    with MEMOS_LOCK:
+        memo = MEMOS.get(dbfile)
+        if memo is None:
+            memo = MEMOS[dbfile] = SubtreeMemo(MEMO_SIZE)
+        return memo
+
+
+def getAttributeLists(dbfile):
+    '''
+    Get the attribute lists of the given database (created on first use)
+    dbfile: database file
+    return attribute lists object
+    '''
+    with MEMOS_LOCK:
+        attribute_lists = ATTRIBUTE_LISTS.get(dbfile)
+        if attribute_lists is None:
+            attribute_lists = ATTRIBUTE_LISTS[dbfile] = AttributeLists()
+        return attribute_lists
+
+
+def removeMemo(dbfile):
+    '''
+    Remove the subtree memo and the attribute lists of the given database
+    dbfile: database file
+    '''
+    with MEMOS_LOCK:
+        MEMOS.pop(dbfile, None)
+        ATTRIBUTE_LISTS.pop(dbfile, None)
 
 
 class DbCplxAction():
     ''' Class to handle database actions, incl. complex actions '''
 
-    def __init__(self, db_conn):
+    def __init__(self, db_conn, recursive_query=True, my_snapshot=None, memo=None, attribute_lists=None, inflight=None):
         '''
         Constructor
-        db_conn: database connection object (sqlite3)
+        db_conn: database connection object (sqlite3), not used if a snapshot is given
+        recursive_query: read the whole tree with one recursive query (True),
+                         or walk the tree with one query per node (False)
+        my_snapshot: snapshot (in-memory index) of the database, or None
+        memo: subtree memo of the database (memoized complex actions are not read again), or None
+        attribute_lists: attribute lists of the database (lists read before are not read again), or None (kept by this object only)
+        inflight: complex actions being built by the other resolvers of a batch (waited for, see InFlight), or None
         '''
         self.db_conn = db_conn
+        self.recursive_query = recursive_query
+        self.snapshot = my_snapshot
+        self.memo = memo
+        self.attribute_lists = AttributeLists() if attribute_lists is None else attribute_lists
+        self.inflight = inflight
+
+    def getMemoized(self, action: CplxAction):
+        '''
+        Take the subtree of the given complex action from the memo
+        action: complex action object
+        return True if memoized
+        '''
+        if self.memo is None:
+            return False
+        subtree = self.memo.get(int(action.act_id))
+        if (subtree is None) and (self.inflight is not None) and self.inflight.wait(int(action.act_id)):
+            # built by another resolver of the batch: memoized by now
+            subtree = self.memo.get(int(action.act_id))
+        if subtree is None:
+            return False
+        action.typ = subtree[0]
+        action.subtree = subtree
+        return True
 
     def getAction(self, action: CplxAction):
         '''
@@ -85,48 +416,192 @@ class DbCplxAction():
         '''
         #print("getAction: ", action.act_typ)
 
-        if ( (action.act_typ == "CAStatic") or (action.act_typ == "CANonstatic") ) :
+        if action.act_typ in CA_ACTION_TYPES:
+            if self.getMemoized(action):
+                return
+            if self.recursive_query or (self.snapshot is not None):
+                try:
+                    self.getComplexActionTree(action)
+                    return
+                except sqlite3.OperationalError as e:
+                    if not any(error in str(e) for error in FALLBACK_ERRORS):
+                        raise
+                    # e.g. 'WITH RECURSIVE' not supported: use the recursive walker
+                    logger.warning("recursive query failed ({}), falling back to the recursive walker".format(str(e)))
+                    self.recursive_query = False
             self.getComplexAction(action)
 
     def getComplexAction(self, action: CplxAction):
         '''
-        Get action tree for the given complex action
+        Get action tree for the given complex action (walker, one query per node): the rows of a node are read
+        when the tree is checked (cycles) or built, with the same checks as the recursive query
+        action: complex action object
+        '''
+        rows = dict()
+
+        def getRows(act_id, default):
+            node_rows = rows.get(act_id)
+            if node_rows is None:
+                node_rows = rows[act_id] = self.db_conn.execute(db_queries.QUERY_COMPLEX_ACTION, (act_id,)).fetchall()
+            return node_rows or default
+
+        self.buildComplexActionTree(action, getRows,
+                                    lambda attrListId, default: self.getAttributeLists((attrListId,)).get(attrListId, default))
+
+    def getComplexActionTree(self, action: CplxAction):
+        '''
+        Get action tree for the given complex action:
+        all nodes are read with one recursive query, all attributes lists with one query (per batch),
+        the tree is then built in memory.
         action: complex action object
         '''
-        cursor = self.db_conn.execute(str(db_queries.QUERY_COMPLEX_ACTION).format(action.act_id))
+        if self.snapshot is not None:
+            # answer from the in-memory snapshot
+            self.buildComplexActionTree(action, self.snapshot.complexActionRows,
+                                        lambda attrListId, default: self.getAttributeLists((attrListId,)).get(attrListId, default))
+            return
+
+        # rows of all complex actions of the tree, by (parent) action id
+        rows = dict()
+        cursor = self.db_conn.execute(db_queries.QUERY_COMPLEX_ACTION_TREE, (action.act_id,))
         for row in cursor:
-            #print("getComplexAction: row={0}".format(row))
+            rows.setdefault(row[9], []).append(row)
+
+        attrListIds = set()
+        for node_rows in rows.values():
+            for row in node_rows:
+                attrListIds.add(row[2])
+                attrListIds.add(row[3])
+        attributes = self.getAttributeLists(attrListIds)
+
+        self.buildComplexActionTree(action, rows.get, attributes.get)
+
+    def buildComplexActionTree(self, action: CplxAction, getRows, getAttributes):
+        '''
+        Build the action tree of the given complex action from the given rows
+        action: complex action object
+        getRows: function (action id, default) -> rows of the complex action (columns of QUERY_COMPLEX_ACTION)
+        getAttributes: function (attribute list id, default) -> attribute list (see decodeAttributeList)
+        '''
+        # the root action id may be given as text (request parameter)
+        root_id = int(action.act_id)
+        self.checkCycles(root_id, getRows)
 
-            # overwrite the action type (write e.g. 'Serial' instead of 'CAStatic')
-            action.typ = row[1]
+        nodes = [(action, root_id, 0)]
+        while nodes:
+            node, node_id, depth = nodes.pop()
+            if depth + (0 if node.subtree is None else node.subtree[3] - 1) > MAX_TREE_DEPTH:
+                raise database.DatabaseException("complex action {} exceeds the maximum tree depth ({})".format(root_id, MAX_TREE_DEPTH))
+            if node.subtree is not None:
+                continue
 
-            # get rule attributes
-            self.getCAAttributes(row[2], action)
+            for row in getRows(node_id, []):
+                # overwrite the action type (write e.g. 'Serial' instead of 'CAStatic')
+                node.typ = row[1]
 
-            # get complex action attributes
-            self.getCAAttributes(row[3], action)
+                # rule attributes, then complex action attributes
+                for attrListId in (row[2], row[3]):
+                    attributes = getAttributes(attrListId, None)
+                    if attributes:
+                        node.attributes.append(attributes)
 
-            child_action = CplxAction(row[4], action.act_list_id, row[5], row[6], row[7])
-            if (row[4] is not None):   # actionId
-                self.getAction(child_action)
-                action.addChild(child_action)
+                if (row[4] is not None):   # actionId
+                    child_action = CplxAction(row[4], node.act_list_id, row[5], row[6], row[7])
+                    if child_action.act_typ in CA_ACTION_TYPES:
+                        # memoized subtrees are only checked for their depth
+                        self.getMemoized(child_action)
+                        nodes.append((child_action, row[4], depth + 1))
+                    node.addChild(child_action)
 
-    def getCAAttributes(self, attrListId, action: CplxAction):
+    def checkCycles(self, act_id, getRows):
         '''
-        Get the list of attributes of the given complex action 
-        attrListId: attributes list id
-        action: complex action
+        Check that the complex action graph starting at the given action has no cycle.
+        act_id: root action id
+        getRows: function (action id, default) -> rows of the complex action
+        raise DatabaseException if a cycle is found
         '''
-        if attrListId is not None:
-            cursor = self.db_conn.execute(str(db_queries.QUERY_CA_ATTRIBUTES).format(attrListId))
+        # iterative depth first search: ids on the current path are 'open', fully visited ids are 'done'
+        state = {act_id: 'open'}
+        path = [(act_id, iter(getRows(act_id, [])))]
+        while path:
+            parent_id, children = path[-1]
+            for row in children:
+                child_id = row[4]
+                if (child_id is None) or (row[6] not in CA_ACTION_TYPES):
+                    continue
+                if state.get(child_id) == 'open':
+                    raise database.DatabaseException("complex action {} contains a cycle (action {})".format(act_id, child_id))
+                if child_id not in state:
+                    state[child_id] = 'open'
+                    path.append((child_id, iter(getRows(child_id, []))))
+                    break
+            else:
+                state[parent_id] = 'done'
+                path.pop()
+
+    def getAttributeLists(self, attrListIds):
+        '''
+        Get the given attribute lists, the lists not read before are read from the snapshot or the database (in bulk)
+        attrListIds: attribute list ids (None is ignored)
+        return dictionary: attribute list id -> attribute list (see decodeAttributeList)
+        '''
+        if self.snapshot is not None:
+            return self.attribute_lists.get(attrListIds, lambda ids: {attrListId: self.snapshot.attributes.get(attrListId, []) for attrListId in ids})
+        return self.attribute_lists.get(attrListIds, self.getCAAttributeLists)
+
+    def getCAAttributeLists(self, attrListIds):
+        '''
+        Get the given attribute lists (in batches of MAX_BATCH_IDS lists per query)
+        attrListIds: attribute list ids (None is ignored)
+        return dictionary: attribute list id -> list of attribute rows
+        '''
+        attributes = dict()
+        ids = sorted(attrListId for attrListId in attrListIds if attrListId is not None)
+        for start in range(0, len(ids), MAX_BATCH_IDS):
+            batch = ids[start:start + MAX_BATCH_IDS]
+            size = MIN_BATCH_IDS
+            while size < len(batch):
+                size *= 2
+            batch += [None] * (size - len(batch))   # NULL never matches
+            placeholders = ", ".join("?{0}".format(index + 1) for index in range(size))
+            query = db_queries.QUERY_CA_ATTRIBUTE_LISTS.format(placeholders=placeholders)
+            cursor = self.db_conn.execute(query, batch)
             for row in cursor:
-                #print("getCAAttributes: row={0}".format(row))
-                attr = dict()
-                if row[1] == 'Integer':
-                    attr[row[0]] = row[2]
-                elif row[1] == 'Text':
-                    attr[row[0]] = row[3]
-                action.attributes.append(attr)
+                attributes.setdefault(row[0], []).append(row)
+        return attributes
+
+def resolveCplxActionTree(dbfile, memo, my_snapshot, act_id, act_list_id, act_det_id, act_typ, med_typ, inflight=None):
+    '''
+    Build the actions tree of the given complex action (from the snapshot if given, from the database otherwise)
+    and memoize its subtrees.
+    dbfile: database file
+    memo: subtree memo of the database
+    my_snapshot: snapshot (in-memory index) of the database, or None
+    act_id, act_list_id, act_det_id, act_typ, med_typ: the complex action (see CplxAction)
+    inflight: complex actions being built by the resolvers of the batch (see InFlight), or None
+    return complex action tree
+    '''
+    root_cplx = CplxAction(act_id, act_list_id, act_det_id, act_typ, med_typ)
+    attribute_lists = getAttributeLists(dbfile)
+    if my_snapshot is not None:
+        # answer from the in-memory snapshot
+        with database.phase("fetch"):
+            DbCplxAction(None, my_snapshot=my_snapshot, memo=memo, attribute_lists=attribute_lists, inflight=inflight).getAction(root_cplx)
+    else:
+        with database.Database(dbfile) as my_database, database.phase("fetch"):
+            DbCplxAction(my_database.db_conn, memo=memo, attribute_lists=attribute_lists, inflight=inflight).getAction(root_cplx)
+
+    # read: the complex actions of the tree are waited for by the other resolvers until memoized
+    built = None if inflight is None else inflight.register(root_cplx)
+    try:
+        with database.phase("build"):
+            cplxaction_tree = root_cplx.buildTree()
+            memo.putTree(root_cplx, cplxaction_tree)
+    finally:
+        if built is not None:
+            built.set()
+    return cplxaction_tree
+
 
 def getCplxActionTree(dbfile, act_id, act_list_id, act_det_id, act_typ, med_typ):
     '''
@@ -140,13 +615,10 @@ def getCplxActionTree(dbfile, act_id, act_list_id, act_det_id, act_typ, med_typ)
     return complex action tree as json
     '''
     try:
-        my_database = database.Database(dbfile)
-        dbcplx = DbCplxAction(my_database.db_conn)
-        root_cplx = CplxAction(act_id, act_list_id, act_det_id, act_typ, med_typ)
-        dbcplx.getAction(root_cplx)
-        cplxaction_tree = root_cplx.buildTree()
+        # complex actions expanded before are taken from the memo (no query)
+        cplxaction_tree = resolveCplxActionTree(dbfile, getMemo(dbfile), snapshot.getSnapshot(dbfile),
+                                                act_id, act_list_id, act_det_id, act_typ, med_typ)
         #print(cplxaction_tree)
-        my_database.close()
         return cplxaction_tree
     
     except database.DatabaseException as e:
@@ -160,3 +632,86 @@ def getCplxActionTree(dbfile, act_id, act_list_id, act_det_id, act_typ, med_typ)
         file_name, line_number, procedure_name, line_code = traceback.extract_tb(exception_traceback)[-1]
         logger.error("File Name: {}, Line Number: {}, Procedure Name: {}, Line Code: {}".format(file_name, line_number, procedure_name, line_code))
         return {"exception":"{}".format(str(exception_value))}
+
+
+# thread pool of the batch requests (created on first use)
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+
+
+def getExecutor():
+    ''' Get the (process-wide, bounded) thread pool resolving the complex actions of batch requests '''
+    global EXECUTOR
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="cab-cplx")
+        return EXECUTOR
+
+
+def getLineCplxActions(line: act.Line):
+    '''
+    Get the complex actions under the line events of the given line (each action once, in tree order)
+    line: line object (with line sections, events and actions)
+    return list of (act_id, act_list_id, act_det_id, act_typ, med_typ)
+    '''
+    cplxActions = dict()
+    for lineSection in line.line_sections:
+        for lineevent in lineSection.events:
+            for action in lineevent.actions:
+                if (action.act_tp in CA_ACTION_TYPES) and (action.act_id not in cplxActions):
+                    cplxActions[action.act_id] = (action.act_id, lineevent.ac_lst, action.act_det_id, action.act_tp, action.med_tp)
+    return list(cplxActions.values())
+
+
+def getCplxActionTrees(dbfile, trainNumberId):
+    '''
+    Retrieve the actions trees of all complex actions of the given train number (line):
+    the complex actions are resolved on a bounded thread pool, subtrees memoized before (by this or an earlier request)
+    are not read again. A subtree shared between complex actions resolved at the same time is built once: the resolvers
+    meeting it while another one builds it wait for it (see InFlight), a root of the batch is then not read at all.
+    dbfile: database file
+    trainNumberId: train number id
+    return json: train number id, list of complex action trees (an exception entry for a tree which cannot be built)
+    '''
+    try:
+        my_snapshot = snapshot.getSnapshot(dbfile)
+        if my_snapshot is not None:
+            db_action = act.DbAction(None, trainNumberId, my_snapshot)
+            with database.phase("fetch"):
+                db_action.getActions()
+        else:
+            with database.Database(dbfile) as my_database, database.phase("fetch"):
+                db_action = act.DbAction(my_database.db_conn, trainNumberId)
+                db_action.getActions()
+        if db_action.my_line is None:
+            raise database.DatabaseException("train number {} not found".format(trainNumberId))
+
+        memo = getMemo(dbfile)
+        inflight = InFlight()
+        cplxActions = getLineCplxActions(db_action.my_line)
+        # each task runs in a copy of the caller's context (e.g. the statements counter of the request)
+        futures = [getExecutor().submit(contextvars.copy_context().run, resolveCplxActionTree, dbfile, memo, my_snapshot, *cplxAction,
+                                        inflight=inflight)
+                   for cplxAction in cplxActions]
+
+        cplxaction_trees = []
+        for cplxAction, future in zip(cplxActions, futures):
+            try:
+                cplxaction_trees.append(future.result())
+            except Exception as e:
+                logger.error("complex action {} of train number {}: {}".format(cplxAction[0], trainNumberId, str(e)))
+                cplxaction_trees.append({"actionId": cplxAction[0], "exception": "{}".format(str(e))})
+
+        return {"trainNumberId": trainNumberId, "complexActions": cplxaction_trees}
+
+    except database.DatabaseException as e:
+        logger.error("Programm ended with a database error:{}".format(str(e)))
+        return {"exception":"{}".format(str(e))}
+
+    except:
+        logger.error("Programm ended with unknown error: see message below")
+        exception_type, exception_value, exception_traceback = sys.exc_info()
+        logger.error("Exception Type: {}, Exception Value: {}".format(exception_type, exception_value))
+        file_name, line_number, procedure_name, line_code = traceback.extract_tb(exception_traceback)[-1]
+        logger.error("File Name: {}, Line Number: {}, Procedure Name: {}, Line Code: {}".format(file_name, line_number, procedure_name, line_code))
+        return {"exception":"{}".format(str(exception_value))}
@@ -1,11 +1,205 @@
 ''' Module to handle database (sqlite3) functions '''
 
 
+import time
 import sqlite3
+import itertools
+import threading
+import contextlib
+import contextvars
+
+
+from cab.dbaccess import db_queries
+from cab.dbaccess import workingcopy
 
 
 DB_NAME = "database.db"
 
+# number of prepared statements cached per connection (sqlite3 statement cache):
+# all queries use bound parameters, so each statement is prepared once per connection
+CACHED_STATEMENTS = 1024
+
+# idle pooled connections are closed after this time (seconds)
+POOL_IDLE_TIMEOUT = 300
+
+# maximum number of idle connections kept per database
+POOL_MAX_IDLE = 4
+
+# the interrupt (see INTERRUPT) is checked every this number of SQLite virtual machine instructions
+PROGRESS_STEPS = 10000
+
+# tables of a mobileSQLite database read by the cab
+REQUIRED_TABLES = frozenset(("line", "timetableperiod", "validcycle", "circulation", "trainnumber", "station",
+                             "linesection", "eventtrigger", "lineevent", "actiontype", "mediatype", "action",
+                             "executionruletype", "executionrule", "complexaction", "complexactionchildlist",
+                             "attributedatatype", "attributetype", "attributeint", "attributetext", "attribute"))
+
+
+# number of statements executed in the current context: a one-element list set by the caller (e.g. a request, the counter
+# of its profile, see profiling), or None. The only statement counter: the profile and the request log read it
+STATEMENTS = contextvars.ContextVar("statements", default=None)
+
+
+# profile of the database access in the current context: a Profile set by the caller (e.g. a request), or None
+PROFILE = contextvars.ContextVar("profile", default=None)
+
+
+def countStatement(statement):
+    ''' Trace callback of the connections: counts the executed statements (see STATEMENTS) '''
+    counter = STATEMENTS.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+# cancellation of the statements executed in the current context: an event set by the caller (e.g. a background job), or None
+INTERRUPT = contextvars.ContextVar("interrupt", default=None)
+
+
+def checkInterrupt():
+    ''' Progress handler of the connections: interrupts the running statement once INTERRUPT is set (counts the progress, see PROFILE) '''
+    profile = PROFILE.get()
+    if profile is not None:
+        profile.progress += 1
+    interrupt = INTERRUPT.get()
+    return (interrupt is not None) and interrupt.is_set()
+
+
+class Profile():
+    '''
+    Class to hold the profile of the database access of one context (e.g. a request, see PROFILE): statements executed,
+    time spent in SQLite by statement, SQLite progress (virtual machine instructions) and the time of named phases
+    (e.g. 'fetch', 'build'). Shared by the threads working for the context.
+    '''
+
+    def __init__(self):
+        ''' Constructor '''
+        self.counter = [0]            # statements executed: the STATEMENTS counter of the context (see profiling)
+        self.progress = 0             # progress handler calls (one per PROGRESS_STEPS instructions)
+        self.sql_seconds = 0.0        # time spent executing the statements and fetching their rows
+        self.by_statement = dict()    # statement (as written, with placeholders) -> [executions, seconds]
+        self.phases = dict()          # phase name -> seconds
+        self.lock = threading.Lock()
+
+    @property
+    def statements(self):
+        ''' Number of statements executed (trace callback, see STATEMENTS) '''
+        return self.counter[0]
+
+    def addStatement(self, sql, seconds):
+        '''
+        Add the execution of a statement
+        sql: the statement (with placeholders)
+        seconds: time spent executing it and fetching its rows
+        '''
+        with self.lock:
+            self.sql_seconds += seconds
+            entry = self.by_statement.get(sql)
+            if entry is None:
+                self.by_statement[sql] = [1, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+
+    def addPhase(self, name, seconds):
+        '''
+        Add the time of a phase (phases of the same name add up, also across threads)
+        name: name of the phase
+        seconds: time of the phase
+        '''
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def getTopStatements(self, count):
+        '''
+        Get the statements which took the most time
+        count: maximum number of statements
+        return list of (statement, executions, seconds), the slowest first
+        '''
+        with self.lock:
+            entries = [(sql, executions, seconds) for sql, (executions, seconds) in self.by_statement.items()]
+        entries.sort(key=lambda entry: entry[2], reverse=True)
+        return entries[:count]
+
+
+@contextlib.contextmanager
+def profiling(profile):
+    '''
+    Profile the database access of the current context (see PROFILE): its statements are counted by the profile
+    profile: the Profile
+    '''
+    profile_token = PROFILE.set(profile)
+    statements_token = STATEMENTS.set(profile.counter)
+    try:
+        yield profile
+    finally:
+        STATEMENTS.reset(statements_token)
+        PROFILE.reset(profile_token)
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''
+    Time a phase of the database access in the profile of the current context (nothing if none, see PROFILE)
+    name: name of the phase (e.g. 'fetch': rows read into objects, 'build': response data built from the objects)
+    '''
+    profile = PROFILE.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.addPhase(name, time.perf_counter() - start)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    '''
+    Class of the cursors used in a profiled context (see ProfiledConnection): the rows of a statement are fetched
+    when it is executed, so that the time spent in SQLite is measured once per statement (not once per row).
+    '''
+
+    def executeProfiled(self, profile, sql, parameters):
+        '''
+        Execute a statement, fetch all its rows and add the time to the profile
+        profile: profile of the context
+        sql: the statement
+        parameters: parameters of the statement
+        return self
+        '''
+        start = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+            self.rows = iter(super().fetchall())
+        finally:
+            profile.addStatement(sql, time.perf_counter() - start)
+        return self
+
+    def __iter__(self):
+        return self.rows
+
+    def __next__(self):
+        return next(self.rows)
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self.rows, self.arraysize if size is None else size))
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    ''' Class of the connections: the statements executed in a profiled context (see PROFILE) are timed '''
+
+    def execute(self, sql, parameters=()):
+        profile = PROFILE.get()
+        if profile is None:
+            return super().execute(sql, parameters)
+        return self.cursor(ProfiledCursor).executeProfiled(profile, sql, parameters)
+
 
 class DatabaseException(Exception):
     ''' Class to handle database exceptions '''
@@ -16,25 +210,185 @@ class DatabaseException(Exception):
 
     def __str__(self):
         return("Database Exception: {}".format(self.message))
-    
+
+
+def connect(db_name, cached_statements=None, working_copy=True):
+    '''
+    Open a read-only connection to the given database (to its working copy, if enabled: see workingcopy.MODE).
+    The connection may be used by another thread than the one which opened it (but not concurrently).
+    db_name: name of the database (complete file name with path)
+    cached_statements: size of the prepared statements cache. Default CACHED_STATEMENTS
+    working_copy: False: connect to the database itself, even if working copies are enabled
+    return: connection object (sqlite3)
+    '''
+    if cached_statements is None:
+        cached_statements = CACHED_STATEMENTS
+    uri = None
+    if working_copy and (workingcopy.MODE is not None):
+        uri = workingcopy.COPIES.getUri(db_name, checkInterrupt)
+    db_conn = sqlite3.connect(uri or f'file:{db_name}?mode=ro', uri=True, factory=ProfiledConnection,
+                              cached_statements=cached_statements, check_same_thread=False)
+    db_conn.set_trace_callback(countStatement)
+    db_conn.set_progress_handler(checkInterrupt, PROGRESS_STEPS)
+    return db_conn
+
+
+class ConnectionPool():
+    ''' Class to hold read-only connections for reuse, by database (process-wide, thread-safe) '''
+
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT, max_idle=POOL_MAX_IDLE):
+        '''
+        Constructor
+        idle_timeout: idle connections are closed after this time (seconds)
+        max_idle: maximum number of idle connections kept per database
+        '''
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.idle = dict()     # database name -> list of (connection, release time)
+        self.in_use = dict()   # database name -> set of connections
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, db_name):
+        '''
+        Get a connection to the given database: an idle one, or a new one
+        db_name: name of the database
+        return: connection object (sqlite3)
+        '''
+        with self.lock:
+            self.prune(time.monotonic())
+            idle = self.idle.get(db_name)
+            if idle:
+                db_conn = idle.pop()[0]
+                if not idle:
+                    del self.idle[db_name]
+                self.hits += 1
+                self.in_use.setdefault(db_name, set()).add(db_conn)
+                return db_conn
+            self.misses += 1
+
+        # connected outside the lock: the first connection may make the working copy of the database
+        db_conn = connect(db_name)
+        with self.lock:
+            self.in_use.setdefault(db_name, set()).add(db_conn)
+        return db_conn
+
+    def release(self, db_name, db_conn):
+        '''
+        Give back a connection (acquired before) to the pool
+        db_name: name of the database
+        db_conn: connection object (sqlite3)
+        '''
+        with self.lock:
+            now = time.monotonic()
+            users = self.in_use.get(db_name)
+            if (users is None) or (db_conn not in users):
+                # the database was discarded while the connection was in use
+                db_conn.close()
+            else:
+                users.discard(db_conn)
+                if not users:
+                    del self.in_use[db_name]
+                idle = self.idle.setdefault(db_name, [])
+                if len(idle) < self.max_idle:
+                    idle.append((db_conn, now))
+                else:
+                    db_conn.close()
+            self.prune(now)
+
+    def discard(self, db_name):
+        '''
+        Close all connections to the given database (e.g. because the database file is removed),
+        connections in use are closed when released.
+        db_name: name of the database
+        '''
+        with self.lock:
+            idle = self.idle.pop(db_name, [])
+            self.in_use.pop(db_name, None)
+        for db_conn, _ in idle:
+            db_conn.close()
+
+    def prune(self, now):
+        ''' Close the connections idle for longer than the idle timeout (lock must be held) '''
+        for db_name in list(self.idle):
+            idle = self.idle[db_name]
+            while idle and (now - idle[0][1] > self.idle_timeout):
+                idle.pop(0)[0].close()
+            if not idle:
+                del self.idle[db_name]
+
+    def stats(self):
+        ''' Pool counters (hits, misses, idle and in use connections) '''
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "idle": sum(len(idle) for idle in self.idle.values()),
+                "inUse": sum(len(users) for users in self.in_use.values())
+            }
+
+
+# the process-wide connection pool
+POOL = ConnectionPool()
+
 
 class Database():
     ''' Class to hold a database connection '''
 
-    def __init__(self, db_name = None):
+    def __init__(self, db_name = None, pooled = True):
         '''
         Constructor: initializes database object.
         dbname: name of the database (complete file name with path). Default 'database.db'
+        pooled: take the connection from the process-wide pool (and give it back on close)
         return: connection object (sqlites3)
         '''
         self.db_conn = None
         if db_name is None:
             db_name = DB_NAME
+        self.db_name = db_name
+        self.pooled = pooled
         try:
-            self.db_conn = sqlite3.connect(f'file:{db_name}?mode=ro', uri=True)
+            if pooled:
+                self.db_conn = POOL.acquire(db_name)
+            else:
+                self.db_conn = connect(db_name)
         except:
             raise DatabaseException("cannot connect to database '{}'".format(db_name))
 
     def close(self):
         if self.db_conn is not None:
-            self.db_conn.close()
+            if self.pooled:
+                POOL.release(self.db_name, self.db_conn)
+            else:
+                self.db_conn.close()
+            self.db_conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+
+def checkDatabase(db_name):
+    '''
+    Check that the given file is a sound mobileSQLite database: SQLite quick check and the tables read by the cab
+    db_name: name of the database (complete file name with path)
+    raise DatabaseException if not
+    '''
+    try:
+        # the uploaded database itself (its working copy is made from it once checked)
+        db_conn = connect(db_name, working_copy=False)
+        try:
+            problem = db_conn.execute(db_queries.QUERY_QUICK_CHECK).fetchone()[0]
+            tables = {row[0] for row in db_conn.execute(db_queries.QUERY_TABLES)}
+        finally:
+            db_conn.close()
+    except sqlite3.DatabaseError as e:
+        raise DatabaseException("cannot read database '{}': {}".format(db_name, e))
+    if problem != "ok":
+        raise DatabaseException("database '{}' is damaged: {}".format(db_name, problem))
+    missing = REQUIRED_TABLES - tables
+    if missing:
+        raise DatabaseException("'{}' is no mobileSQLite database, missing tables: {}".format(db_name, ", ".join(sorted(missing))))
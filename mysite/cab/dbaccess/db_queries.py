@@ -1,6 +1,26 @@
 ''' Module to hold all databae statements in one place '''
 
 
+QUERY_QUICK_CHECK = "PRAGMA quick_check(1);"
+
+QUERY_TABLES = "SELECT lower(name) FROM sqlite_master WHERE type = 'table';"
+
+# indexes created in the working copy of a database (see workingcopy.py): covering the lookups of the queries below
+CREATE_WORKING_COPY_INDEXES = (
+"""CREATE INDEX IF NOT EXISTS cab_linesection_line 
+ON linesection (LineID, OrderIndex, LineSectionID, FromStationID, ToStationID, LineSectionTypeID);""",
+"""CREATE INDEX IF NOT EXISTS cab_lineevent_linesection 
+ON lineevent (LineSectionID, OrderIndex, LineEventID, ActionListID, EventTriggerID);""",
+"""CREATE INDEX IF NOT EXISTS cab_action_actionlist 
+ON action (ActionListID, ActionID, ActionDetailID, ActionTypeID, MediaTypeID, SequenceListID);""",
+"""CREATE INDEX IF NOT EXISTS cab_complexactionchildlist_complexaction 
+ON complexactionchildlist (ComplexActionID, OrderIndex, ActionID);""",
+"""CREATE INDEX IF NOT EXISTS cab_attribute_attributelist 
+ON attribute (AttributeListID, AttributeDataTypeID, AttributeDetailID);""",
+"""CREATE INDEX IF NOT EXISTS cab_validcycle_validcyclelist 
+ON validcycle (ValidCycleListID, FromDateDate, UntilDateDate, Weekdays, ValidityBitSet);""",
+)
+
 QUERY_TRAINNUMBERS = """SELECT tr.TrainNumberId, tr.LineId, tr.shortname, tr.CirculationId, ci.shortname, ci.flagLoop, ci.TimetablePeriodId, ci.validcycleListId, tp.Shortname, 
 vc.FromDateDate, vc.UntilDateDate, vc.Weekdays, vc.ValidityBitSet  
 FROM trainnumber tr 
@@ -18,27 +38,64 @@ INNER JOIN Line li ON  tr.LineId = li.LineId
 INNER JOIN Circulation ci ON  tr.CirculationId = ci.CirculationId 
 INNER JOIN timetableperiod tp ON  tp.TimetablePeriodId = ci.TimetablePeriodId 
 INNER JOIN ValidCycle vc ON vc.validcyclelistId  = ci.validcycleListId 
-WHERE tr.TrainNumberID = {0} 
+WHERE tr.TrainNumberID = ? 
 GROUP BY tr.LineId , ci.CirculationID 
 Order by tr.LineId, ci.CirculationID;"""
 
 QUERY_LINESECTIONS = """SELECT  ls.LineSectionID, ls.FromStationID, st1.ShortName, st1.Abbreviation, ls.ToStationID, st2.ShortName, st2.Abbreviation, ls.LineSectionTypeID FROM linesection ls
 LEFT JOIN station st1 ON ls.FromStationId = st1.StationID 
 INNER JOIN station st2 ON ls.ToStationId = st2.StationID 
-WHERE ls.LineID = {0} 
+WHERE ls.LineID = ? 
 Order by OrderIndex;"""
 
 QUERY_LINEEVENTS = """SELECT le.LineEventID, le.ActionListID,  et.TriggerType, et.ShortName, et.Value, et.FlagValue FROM lineevent le 
 INNER JOIN eventtrigger et 
 ON le.EventTriggerID = et.EventTriggerID 
-WHERE le.LineSectionID = {0} 
+WHERE le.LineSectionID = ? 
+ORDER BY le.OrderIndex;"""
+
+QUERY_LINEEVENTS_OF_LINE = """SELECT le.LineEventID, le.ActionListID,  et.TriggerType, et.ShortName, et.Value, et.FlagValue, le.LineSectionID FROM lineevent le 
+INNER JOIN eventtrigger et 
+ON le.EventTriggerID = et.EventTriggerID 
+WHERE le.LineSectionID IN (SELECT ls.LineSectionID FROM linesection ls WHERE ls.LineID = ?) 
 ORDER BY le.OrderIndex;"""
 
 QUERY_ACTIONS = """SELECT ActionId, ActionDetailID, at.ShortName, mt.ParamIdentifier, SequenceListId, NULL as Duration 
 FROM action a 
 INNER JOIN actiontype at ON a.ActionTypeID = at.ActionTypeID 
 INNER JOIN mediatype mt ON a.MediaTypeID = mt.MediaTypeID 
-WHERE ActionListID = {0};"""
+WHERE ActionListID = ?;"""
+
+QUERY_ACTIONS_OF_LINE = """SELECT ActionId, ActionDetailID, at.ShortName, mt.ParamIdentifier, SequenceListId, NULL as Duration, a.ActionListID 
+FROM action a 
+INNER JOIN actiontype at ON a.ActionTypeID = at.ActionTypeID 
+INNER JOIN mediatype mt ON a.MediaTypeID = mt.MediaTypeID 
+WHERE a.ActionListID IN (SELECT le.ActionListID FROM lineevent le 
+WHERE le.LineSectionID IN (SELECT ls.LineSectionID FROM linesection ls WHERE ls.LineID = ?));"""
+
+QUERY_LINESECTION_ID = """SELECT  ls.LineSectionID, ls.FromStationID, st1.ShortName, st1.Abbreviation, ls.ToStationID, st2.ShortName, st2.Abbreviation, ls.LineSectionTypeID FROM linesection ls
+LEFT JOIN station st1 ON ls.FromStationId = st1.StationID 
+INNER JOIN station st2 ON ls.ToStationId = st2.StationID 
+WHERE ls.LineID = ? AND ls.LineSectionID = ?;"""
+
+QUERY_ACTIONS_OF_LINESECTION = """SELECT ActionId, ActionDetailID, at.ShortName, mt.ParamIdentifier, SequenceListId, NULL as Duration, a.ActionListID 
+FROM action a 
+INNER JOIN actiontype at ON a.ActionTypeID = at.ActionTypeID 
+INNER JOIN mediatype mt ON a.MediaTypeID = mt.MediaTypeID 
+WHERE a.ActionListID IN (SELECT le.ActionListID FROM lineevent le WHERE le.LineSectionID = ?);"""
+
+QUERY_LINESECTION_COUNTS = """SELECT le.LineSectionID, COUNT(*), SUM(IFNULL(ac.ActionCount, 0)) 
+FROM lineevent le 
+INNER JOIN eventtrigger et 
+ON le.EventTriggerID = et.EventTriggerID 
+LEFT JOIN (SELECT a.ActionListID, COUNT(*) AS ActionCount FROM action a 
+INNER JOIN actiontype at ON a.ActionTypeID = at.ActionTypeID 
+INNER JOIN mediatype mt ON a.MediaTypeID = mt.MediaTypeID 
+WHERE a.ActionListID IN (SELECT le.ActionListID FROM lineevent le 
+WHERE le.LineSectionID IN (SELECT ls.LineSectionID FROM linesection ls WHERE ls.LineID = :id)) 
+GROUP BY a.ActionListID) ac ON ac.ActionListID = le.ActionListID 
+WHERE le.LineSectionID IN (SELECT ls.LineSectionID FROM linesection ls WHERE ls.LineID = :id) 
+GROUP BY le.LineSectionID;"""
 
 QUERY_COMPLEX_ACTION = """SELECT 
 ca.complexactionid as ActionId_Parent,  
@@ -58,7 +115,7 @@ LEFT JOIN complexactionchildlist cacl ON ca.complexactionid = cacl.complexaction
 LEFT JOIN action child_a ON cacl.actionid = child_a.actionId 
 LEFT JOIN mediatype mt ON mt.mediatypeId = child_a.mediatypeid 
 LEFT JOIN actiontype at ON child_a.actiontypeid = at.actiontypeid 
-WHERE parent_a.actionid = {0} 
+WHERE parent_a.actionid = ? 
 ORDER BY cacl.orderindex;"""
 
 QUERY_CA_ATTRIBUTES = """SELECT 
@@ -67,11 +124,149 @@ from Attribute a
 INNER JOIN attributedatatype adt ON ( a.attributedatatypeId = adt.attributedatatypeId and adt.typeName != 'Text') 
 INNER JOIN attributeint ai ON (ai.attributeintId = a.attributedetailId) 
 INNER JOIN attributetype aty ON (aty.attributeTypeId = ai.attributetypeId) 
-where AttributeListId= {0} 
+where AttributeListId= :id 
 UNION 
 SELECT aty.TypeName as Attribute, adt.TypeName as Type, NULL as Interger, at.attribute as Text 
 from Attribute a 
 INNER JOIN attributedatatype adt ON ( a.attributedatatypeId = adt.attributedatatypeId and adt.typeName == 'Text') 
 INNER JOIN attributetext at ON (at.attributetextId = a.attributedetailId) 
 INNER JOIN attributetype aty ON ( aty.attributeTypeId = at.attributetypeId) 
-WHERE AttributeListId= {0};"""
+WHERE AttributeListId= :id;"""
+
+QUERY_COMPLEX_ACTION_TREE = """WITH RECURSIVE nodes(ActionId) AS ( 
+SELECT ? 
+UNION 
+SELECT child_a.actionid FROM nodes 
+INNER JOIN action parent_a ON parent_a.actionid = nodes.ActionId 
+INNER JOIN complexactionchildlist cacl ON parent_a.actiondetailid = cacl.complexactionid 
+INNER JOIN action child_a ON cacl.actionid = child_a.actionId 
+INNER JOIN actiontype at ON child_a.actiontypeid = at.actiontypeid 
+WHERE at.shortname IN ('CAStatic', 'CANonstatic') 
+) 
+SELECT 
+ca.complexactionid as ActionId_Parent,  
+ert.typename as Rule_TypeName_Parent, 
+er.attributelistid as Rule_AttributeListId_Parent, 
+ca.attributelistid  as Attributelistid_Parent, 
+child_a.actionid  as ActionId_Child, 
+child_a.actiondetailid as ActionDetailId_Child, 
+at.shortname as ActionType_Child, 
+mt.paramIdentifier as mediatype_Child, 
+child_a.sequenceListId as sequenceListId_Child, 
+parent_a.actionid as ActionId_Parent_Action 
+FROM action parent_a 
+INNER JOIN complexaction ca ON parent_a.actiondetailid = ca.complexactionid 
+LEFT JOIN executionrule er ON ca.executionruleid = er.executionruleid 
+LEFT JOIN executionruletype ert ON er.executionruletypeid = ert.executionruletypeid 
+LEFT JOIN complexactionchildlist cacl ON ca.complexactionid = cacl.complexactionid 
+LEFT JOIN action child_a ON cacl.actionid = child_a.actionId 
+LEFT JOIN mediatype mt ON mt.mediatypeId = child_a.mediatypeid 
+LEFT JOIN actiontype at ON child_a.actiontypeid = at.actiontypeid 
+WHERE parent_a.actionid IN (SELECT ActionId FROM nodes) 
+ORDER BY parent_a.actionid, cacl.orderindex;"""
+
+# {placeholders}: numbered parameters of the attribute list ids (?1, ?2, ...), used in both parts of the union
+QUERY_CA_ATTRIBUTE_LISTS = """SELECT 
+a.AttributeListId as AttributeListId, aty.TypeName as Attribute, adt.TypeName as Type, ai.attribute as Integer, NULL as Text 
+from Attribute a 
+INNER JOIN attributedatatype adt ON ( a.attributedatatypeId = adt.attributedatatypeId and adt.typeName != 'Text') 
+INNER JOIN attributeint ai ON (ai.attributeintId = a.attributedetailId) 
+INNER JOIN attributetype aty ON (aty.attributeTypeId = ai.attributetypeId) 
+where a.AttributeListId IN ({placeholders}) 
+UNION 
+SELECT a.AttributeListId as AttributeListId, aty.TypeName as Attribute, adt.TypeName as Type, NULL as Interger, at.attribute as Text 
+from Attribute a 
+INNER JOIN attributedatatype adt ON ( a.attributedatatypeId = adt.attributedatatypeId and adt.typeName == 'Text') 
+INNER JOIN attributetext at ON (at.attributetextId = a.attributedetailId) 
+INNER JOIN attributetype aty ON ( aty.attributeTypeId = at.attributetypeId) 
+WHERE a.AttributeListId IN ({placeholders}) 
+ORDER BY 1, 2, 3, 4, 5;"""
+
+
+# queries to read whole tables into a snapshot (see snapshot.py), same columns as the queries above plus the key column
+
+QUERY_SNAPSHOT_TRAINNUMBER = """SELECT tr.LineId, tr.shortname, tr.CirculationId, ci.shortname, ci.flagLoop, ci.TimetablePeriodId, ci.validcycleListId, tp.Shortname, 
+vc.FromDateDate, vc.UntilDateDate, vc.Weekdays, vc.ValidityBitSet, tr.TrainNumberID 
+FROM trainnumber tr 
+INNER JOIN Line li ON  tr.LineId = li.LineId 
+INNER JOIN Circulation ci ON  tr.CirculationId = ci.CirculationId 
+INNER JOIN timetableperiod tp ON  tp.TimetablePeriodId = ci.TimetablePeriodId 
+INNER JOIN ValidCycle vc ON vc.validcyclelistId  = ci.validcycleListId 
+GROUP BY tr.TrainNumberID, tr.LineId , ci.CirculationID;"""
+
+QUERY_SNAPSHOT_LINESECTIONS = """SELECT  ls.LineSectionID, ls.FromStationID, st1.ShortName, st1.Abbreviation, ls.ToStationID, st2.ShortName, st2.Abbreviation, ls.LineSectionTypeID, ls.LineID FROM linesection ls
+LEFT JOIN station st1 ON ls.FromStationId = st1.StationID 
+INNER JOIN station st2 ON ls.ToStationId = st2.StationID 
+Order by OrderIndex;"""
+
+QUERY_SNAPSHOT_LINEEVENTS = """SELECT le.LineEventID, le.ActionListID,  et.TriggerType, et.ShortName, et.Value, et.FlagValue, le.LineSectionID FROM lineevent le 
+INNER JOIN eventtrigger et 
+ON le.EventTriggerID = et.EventTriggerID 
+ORDER BY le.OrderIndex;"""
+
+QUERY_SNAPSHOT_ACTIONS = """SELECT ActionId, ActionDetailID, at.ShortName, mt.ParamIdentifier, SequenceListId, NULL as Duration, a.ActionListID 
+FROM action a 
+INNER JOIN actiontype at ON a.ActionTypeID = at.ActionTypeID 
+INNER JOIN mediatype mt ON a.MediaTypeID = mt.MediaTypeID;"""
+
+QUERY_SNAPSHOT_CA_ACTIONS = """SELECT a.ActionID, a.ActionDetailID 
+FROM action a 
+INNER JOIN complexaction ca ON a.ActionDetailID = ca.ComplexActionID;"""
+
+QUERY_SNAPSHOT_COMPLEX_ACTIONS = """SELECT 
+ca.complexactionid as ActionId_Parent,  
+ert.typename as Rule_TypeName_Parent, 
+er.attributelistid as Rule_AttributeListId_Parent, 
+ca.attributelistid  as Attributelistid_Parent, 
+child_a.actionid  as ActionId_Child, 
+child_a.actiondetailid as ActionDetailId_Child, 
+at.shortname as ActionType_Child, 
+mt.paramIdentifier as mediatype_Child, 
+child_a.sequenceListId as sequenceListId_Child 
+FROM complexaction ca 
+LEFT JOIN executionrule er ON ca.executionruleid = er.executionruleid 
+LEFT JOIN executionruletype ert ON er.executionruletypeid = ert.executionruletypeid 
+LEFT JOIN complexactionchildlist cacl ON ca.complexactionid = cacl.complexactionid 
+LEFT JOIN action child_a ON cacl.actionid = child_a.actionId 
+LEFT JOIN mediatype mt ON mt.mediatypeId = child_a.mediatypeid 
+LEFT JOIN actiontype at ON child_a.actiontypeid = at.actiontypeid 
+ORDER BY cacl.orderindex;"""
+
+QUERY_SNAPSHOT_CA_ATTRIBUTES = """SELECT 
+a.AttributeListId as AttributeListId, aty.TypeName as Attribute, adt.TypeName as Type, ai.attribute as Integer, NULL as Text 
+from Attribute a 
+INNER JOIN attributedatatype adt ON ( a.attributedatatypeId = adt.attributedatatypeId and adt.typeName != 'Text') 
+INNER JOIN attributeint ai ON (ai.attributeintId = a.attributedetailId) 
+INNER JOIN attributetype aty ON (aty.attributeTypeId = ai.attributetypeId) 
+UNION 
+SELECT a.AttributeListId as AttributeListId, aty.TypeName as Attribute, adt.TypeName as Type, NULL as Interger, at.attribute as Text 
+from Attribute a 
+INNER JOIN attributedatatype adt ON ( a.attributedatatypeId = adt.attributedatatypeId and adt.typeName == 'Text') 
+INNER JOIN attributetext at ON (at.attributetextId = a.attributedetailId) 
+INNER JOIN attributetype aty ON ( aty.attributeTypeId = at.attributetypeId) 
+ORDER BY 1, 2, 3, 4, 5;"""
+
+
+# queries to hash whole databases (see diff.py): all rows of a table with their parent (first column), in tree order, 
+# and the names of the ids they refer to
+
+QUERY_DIFF_STATIONS = "SELECT StationID, ShortName, Abbreviation FROM station;"
+
+QUERY_DIFF_EVENTTRIGGERS = "SELECT EventTriggerID, ShortName FROM eventtrigger;"
+
+QUERY_DIFF_ACTIONTYPES = "SELECT ActionTypeID, ShortName FROM actiontype;"
+
+QUERY_DIFF_MEDIATYPES = "SELECT MediaTypeID, ParamIdentifier FROM mediatype;"
+
+QUERY_DIFF_LINESECTIONS = """SELECT ls.LineID, ls.FromStationID, ls.ToStationID, ls.LineSectionTypeID, ls.LineSectionID 
+FROM linesection ls 
+ORDER BY ls.LineID, ls.OrderIndex, ls.LineSectionID;"""
+
+QUERY_DIFF_LINEEVENTS = """SELECT le.LineSectionID, le.EventTriggerID, le.ActionListID 
+FROM lineevent le 
+ORDER BY le.LineSectionID, le.OrderIndex, le.LineEventID;"""
+
+QUERY_DIFF_ACTIONS = """SELECT a.ActionListID, a.ActionTypeID, a.MediaTypeID, a.ActionDetailID 
+FROM action a 
+WHERE a.ActionListID IS NOT NULL 
+ORDER BY a.ActionID;"""
@@ -0,0 +1,359 @@
+''' Module to compare two databases (e.g. two versions of a timetable) with content hashes of their trees (Merkle hashes)
+
+Each node of the trees (train number with its line sections, line event, action, complex action) has a content hash
+made of its own content and the hashes of its children: two subtrees with the same hash are equal and are not compared
+further. The hashes of a whole database (of its complex actions and its lines) are computed from one query per table,
+without building any tree; only the train numbers whose hashes differ are loaded (see action.loadActions), their line
+sections, events and actions are hashed to find their differing subtrees.
+
+The content of a node is what the cab shows of it without the ids of its rows (two exports of a timetable may number
+them differently): e.g. the stations of a line section, the trigger of an event, the type of an action. The action
+detail id of a simple action is content (it refers to the details of the action, which the cab does not read), the
+content of a complex action is its tree. Train numbers are matched by short name and validity (from and to date).
+'''
+
+
+import sys
+import json
+import hashlib
+import difflib
+import logging
+import operator
+import functools
+import itertools
+import traceback
+
+
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+from cab.dbaccess import action as act
+from cab.dbaccess import cplxaction as cplx
+from cab.dbaccess import trainnumber as tn
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# size of the content hashes (bytes)
+DIGEST_SIZE = 16
+
+# maximum number of changed train numbers compared subtree by subtree (the others are only listed)
+DETAIL_LIMIT = 20
+
+
+def makeDigest(content):
+    '''
+    Hash the given content, encoded as JSON (orjson when installed, json otherwise: the databases compared are hashed alike)
+    content: lists and tuples of values (str, int, None, digests)
+    return digest (hex str)
+    '''
+    if orjson is not None:
+        encoded = orjson.dumps(content)
+    else:
+        encoded = json.dumps(content, ensure_ascii=False, check_circular=False).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=DIGEST_SIZE).hexdigest()
+
+
+class DbDigests():
+    ''' Class to hold the content hashes of one database: of its train numbers and of its complex actions '''
+
+    def __init__(self, dbfile):
+        '''
+        Constructor
+        dbfile: database file
+        '''
+        self.dbfile = dbfile
+        self.attributes = dict()     # attribute list id -> attribute list (see cplx.decodeAttributeList)
+        self.cplxRows = dict()       # complex action id -> rows (columns of QUERY_SNAPSHOT_COMPLEX_ACTIONS)
+        self.cplxDigests = dict()    # complex action id -> digest
+        self.cyclic = set()          # complex action ids in a cycle or reaching one (not shown as tree, see getCplxDigest)
+        self.trainNumbers = dict()   # train number key (see readTrainNumbers) -> (digest, row of QUERY_TRAINNUMBERS)
+
+    def read(self):
+        ''' Read the whole database and hash all its train numbers (one query per table) '''
+        with database.Database(self.dbfile) as my_database, database.phase("fetch"):
+            self.readComplexActions(my_database.db_conn)
+            lineDigests = self.readLines(my_database.db_conn)
+            self.readTrainNumbers(my_database.db_conn, lineDigests)
+
+    def readComplexActions(self, db_conn):
+        '''
+        Read all complex actions with their attribute lists and hash them
+        db_conn: database connection object (sqlite3)
+        '''
+        cursor = db_conn.execute(db_queries.QUERY_SNAPSHOT_CA_ATTRIBUTES)
+        for attrListId, rows in itertools.groupby(cursor, operator.itemgetter(0)):
+            self.attributes[attrListId] = cplx.decodeAttributeList(list(rows))
+
+        for row in db_conn.execute(db_queries.QUERY_SNAPSHOT_COMPLEX_ACTIONS):
+            self.cplxRows.setdefault(row[0], []).append(row)
+        for cplxId in self.cplxRows:
+            self.getCplxDigest(cplxId)
+
+    def readLines(self, db_conn):
+        '''
+        Hash all lines: the content of a line (its line sections with their events and actions) is gathered bottom up
+        from one query per table and hashed at once
+        db_conn: database connection object (sqlite3)
+        return dictionary: line id -> digest
+        '''
+        # the rows refer to ids of these tables, their content is the names (rows without names are not shown by the cab)
+        stations = {row[0]: row[1:] for row in db_conn.execute(db_queries.QUERY_DIFF_STATIONS)}
+        triggers = dict(db_conn.execute(db_queries.QUERY_DIFF_EVENTTRIGGERS))
+        mediaTypes = dict(db_conn.execute(db_queries.QUERY_DIFF_MEDIATYPES))
+        actionTypes = dict()
+        cplxTypes = set()
+        for actionTypeId, act_tp in db_conn.execute(db_queries.QUERY_DIFF_ACTIONTYPES):
+            actionTypes[actionTypeId] = act_tp
+            if act_tp in cplx.CA_ACTION_TYPES:
+                cplxTypes.add(actionTypeId)
+
+        # actions in their order (action id: no sorting), grouped by action list: flat lists of their content
+        actionLists = dict()
+        cplxDigests = self.cplxDigests
+        for actionListId, actionTypeId, mediaTypeId, act_det_id in db_conn.execute(db_queries.QUERY_DIFF_ACTIONS):
+            if (actionTypeId not in actionTypes) or (mediaTypeId not in mediaTypes):
+                continue
+            if actionTypeId in cplxTypes:
+                act_det_id = cplxDigests.get(act_det_id)
+            actions = actionLists.get(actionListId)
+            if actions is None:
+                actionLists[actionListId] = [actionTypes[actionTypeId], mediaTypes[mediaTypeId], act_det_id]
+            else:
+                actions.extend((actionTypes[actionTypeId], mediaTypes[mediaTypeId], act_det_id))
+
+        events = dict()
+        cursor = db_conn.execute(db_queries.QUERY_DIFF_LINEEVENTS)
+        for lineSectionId, rows in itertools.groupby(cursor, operator.itemgetter(0)):
+            events[lineSectionId] = [(triggers[row[1]], actionLists.get(row[2])) for row in rows if row[1] in triggers]
+
+        lines = dict()
+        cursor = db_conn.execute(db_queries.QUERY_DIFF_LINESECTIONS)
+        for lineId, rows in itertools.groupby(cursor, operator.itemgetter(0)):
+            lines[lineId] = makeDigest([(stations.get(row[1]), stations[row[2]], row[3], events.get(row[4]))
+                                        for row in rows if row[2] in stations])
+        return lines
+
+    def readTrainNumbers(self, db_conn, lineDigests):
+        '''
+        Hash all train numbers
+        db_conn: database connection object (sqlite3)
+        lineDigests: dictionary: line id -> digests of its line sections (see readLines)
+        '''
+        for row in db_conn.execute(db_queries.QUERY_TRAINNUMBERS):
+            content = (row[2], row[9], row[10])   # short name, from date, to date
+            # the same short name and validity more than once: matched in order
+            key = content
+            occurrence = 1
+            while key in self.trainNumbers:
+                key = content + (occurrence,)
+                occurrence += 1
+            self.trainNumbers[key] = (makeDigest((content, lineDigests.get(row[1], ()))), row)
+
+    def getActionKey(self, act_tp, med_tp, act_det_id):
+        '''
+        The content of an action (its hash is the hash of this content)
+        act_tp: action type
+        med_tp: media type
+        act_det_id: action detail id (complex action id of a complex action)
+        return tuple
+        '''
+        if act_tp in cplx.CA_ACTION_TYPES:
+            return (act_tp, med_tp, self.cplxDigests.get(act_det_id))
+        return (act_tp, med_tp, act_det_id)
+
+    def getCplxDigest(self, cplxId):
+        '''
+        Hash a complex action: its rule, its attributes and its children (complex actions first).
+        A complex action in a cycle, or reaching one, has no tree (see cplx.DbCplxAction.checkCycles): it is hashed by its
+        rule and attributes with a cycle marker, the same whichever complex action of the cycle is hashed first.
+        cplxId: complex action id
+        return digest, None if the complex action does not exist
+        '''
+        # iterative post order (children first) to support deep trees: the open ids are the path to the current node
+        nodes = [(cplxId, False)]
+        open_ids = set()
+        while nodes:
+            node_id, visited = nodes.pop()
+            if (node_id in self.cplxDigests) or (node_id not in self.cplxRows):
+                continue
+            rows = self.cplxRows[node_id]
+            if not visited:
+                open_ids.add(node_id)
+                nodes.append((node_id, True))
+                nodes.extend((row[5], False) for row in rows
+                             if (row[4] is not None) and (row[6] in cplx.CA_ACTION_TYPES) and (row[5] not in open_ids))
+                continue
+            content = (rows[0][1], self.attributes.get(rows[0][2], ()), self.attributes.get(rows[0][3], ()))
+            if any((row[5] in open_ids) or (row[5] in self.cyclic)
+                   for row in rows if (row[4] is not None) and (row[6] in cplx.CA_ACTION_TYPES)):
+                self.cyclic.add(node_id)
+                self.cplxDigests[node_id] = makeDigest(("cycle", content))
+            else:
+                children = tuple(self.getActionKey(row[6], row[7], row[5]) for row in rows if row[4] is not None)
+                self.cplxDigests[node_id] = makeDigest((content, children))
+            open_ids.discard(node_id)
+        return self.cplxDigests.get(cplxId)
+
+    def getTrainNumberFields(self, key):
+        ''' The fields of a train number (see Line.makeFields) '''
+        row = self.trainNumbers[key][1]
+        return {
+            'trainNumberId': row[0],
+            'trainNumberShortName': row[2],
+            'lineId': row[1],
+            'fromDate': tn.convertDbDate(row[9]),
+            'toDate': tn.convertDbDate(row[10])
+        }
+
+    def getSectionNodes(self, line: act.Line):
+        ''' The nodes (see diffNodes) of the line sections of a loaded line: hashed with their events '''
+        nodes = []
+        for lineSection in line.line_sections:
+            events = self.getEventNodes(lineSection)
+            content = (lineSection.from_st, lineSection.from_st_abbr, lineSection.to_st, lineSection.to_st_abbr, lineSection.ls_tp)
+            nodes.append((makeDigest((content, [node[0] for node in events])), lineSection.makeFields(),
+                          functools.partial(self.getEventNodes, lineSection)))
+        return nodes
+
+    def getEventNodes(self, lineSection: act.LineSection):
+        ''' The nodes (see diffNodes) of the events of a loaded line section: hashed with their actions '''
+        nodes = []
+        for lineevent in lineSection.events:
+            actions = self.getActionNodes(lineevent)
+            digest = makeDigest((lineevent.trg_nm, [node[0] for node in actions]))
+            nodes.append((digest, lineevent.makeFields(), functools.partial(self.getActionNodes, lineevent)))
+        return nodes
+
+    def getActionNodes(self, lineevent: act.LineEvent):
+        ''' The nodes (see diffNodes) of the actions of a loaded line event '''
+        return [self.makeActionNode(action.act_tp, action.med_tp, action.act_det_id, action.makeFields())
+                for action in lineevent.actions]
+
+    def getCplxNodes(self, cplxId):
+        ''' The nodes (see diffNodes) of the children of a complex action '''
+        return [self.makeActionNode(row[6], row[7], row[5],
+                                    {'actionId': row[4], 'actionDetailId': row[5], 'actionType': row[6], 'mediaType': row[7]})
+                for row in self.cplxRows.get(cplxId, []) if row[4] is not None]
+
+    def makeActionNode(self, act_tp, med_tp, act_det_id, fields):
+        '''
+        Make the node (see diffNodes) of an action: keyed by its content, a complex action shows its type (rule) and
+        its attributes (as in its action tree), its children are the children of the complex action
+        act_tp: action type
+        med_tp: media type
+        act_det_id: action detail id (complex action id of a complex action)
+        fields: fields of the action
+        return node
+        '''
+        if act_tp not in cplx.CA_ACTION_TYPES:
+            return (self.getActionKey(act_tp, med_tp, act_det_id), fields, None)
+        if act_det_id in self.cyclic:
+            # no tree: its children are not compared
+            return (self.getActionKey(act_tp, med_tp, act_det_id), fields, None)
+        rows = self.cplxRows.get(act_det_id)
+        if rows:
+            fields['type'] = rows[0][1]
+            cplx.mergeAttributes(fields, (self.attributes.get(rows[0][2], ()), self.attributes.get(rows[0][3], ())))
+        return (self.getActionKey(act_tp, med_tp, act_det_id), fields, functools.partial(self.getCplxNodes, act_det_id))
+
+
+def diffNodes(baseNodes, otherNodes):
+    '''
+    Compare two lists of nodes: equal subtrees (same key) are skipped, differing nodes at the same place are compared further
+    baseNodes, otherNodes: lists of (key, fields, children) - key: digest (content of an action), fields: dictionary shown,
+                           children: function returning the nodes of the children, None for a leaf
+    return list of differences: {"change": "added"/"removed", "node": fields}
+                                or {"change": "changed", "base": fields, "other": fields, "children": differences}
+    '''
+    differences = []
+    matcher = difflib.SequenceMatcher(None, [node[0] for node in baseNodes], [node[0] for node in otherNodes], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        paired = min(i2 - i1, j2 - j1)
+        for base, other in zip(baseNodes[i1:i1 + paired], otherNodes[j1:j1 + paired]):
+            difference = {"change": "changed", "base": base[1], "other": other[1]}
+            if (base[2] is not None) and (other[2] is not None):
+                difference["children"] = diffNodes(base[2](), other[2]())
+            differences.append(difference)
+        differences.extend({"change": "removed", "node": node[1]} for node in baseNodes[i1 + paired:i2])
+        differences.extend({"change": "added", "node": node[1]} for node in otherNodes[j1 + paired:j2])
+    return differences
+
+
+def diffDatabases(baseFile, otherFile, limit=DETAIL_LIMIT):
+    '''
+    Compare two databases
+    baseFile: database file of the base version
+    otherFile: database file of the other version
+    limit: maximum number of changed train numbers compared subtree by subtree (see DETAIL_LIMIT)
+    return dictionary: counts, added, removed and changed train numbers (with their differing subtrees)
+    '''
+    base = DbDigests(baseFile)
+    base.read()
+    if otherFile == baseFile:
+        other = base
+    else:
+        other = DbDigests(otherFile)
+        other.read()
+
+    removed = [key for key in base.trainNumbers if key not in other.trainNumbers]
+    added = [key for key in other.trainNumbers if key not in base.trainNumbers]
+    changed = [key for key, (digest, row) in base.trainNumbers.items()
+               if (key in other.trainNumbers) and (other.trainNumbers[key][0] != digest)]
+
+    differences = []
+    with database.phase("build"):
+        for index, key in enumerate(changed):
+            difference = {"change": "changed", "base": base.getTrainNumberFields(key), "other": other.getTrainNumberFields(key)}
+            if index < limit:
+                baseLine = act.loadActions(baseFile, base.trainNumbers[key][1][0]).my_line
+                otherLine = act.loadActions(otherFile, other.trainNumbers[key][1][0]).my_line
+                if (baseLine is not None) and (otherLine is not None):
+                    difference["children"] = diffNodes(base.getSectionNodes(baseLine), other.getSectionNodes(otherLine))
+            differences.append(difference)
+
+    return {
+        "trainNumbers": {
+            "base": len(base.trainNumbers),
+            "other": len(other.trainNumbers),
+            "unchanged": len(base.trainNumbers) - len(removed) - len(changed),
+            "removed": len(removed),
+            "added": len(added),
+            "changed": len(changed)
+        },
+        "removed": [base.getTrainNumberFields(key) for key in removed],
+        "added": [other.getTrainNumberFields(key) for key in added],
+        "changed": differences
+    }
+
+
+def getDiff(baseFile, otherFile, limit=None):
+    '''
+    Compare two databases (see diffDatabases)
+    baseFile: database file of the base version
+    otherFile: database file of the other version
+    limit: maximum number of changed train numbers compared subtree by subtree, None: DETAIL_LIMIT
+    return differences as json
+    '''
+    try:
+        return diffDatabases(baseFile, otherFile, DETAIL_LIMIT if limit is None else int(limit))
+
+    except database.DatabaseException as e:
+        logger.error("Programm ended with a database error:{}".format(str(e)))
+        return {"exception":"{}".format(str(e))}
+
+    except:
+        logger.error("Programm ended with unknown error: see message below")
+        exception_type, exception_value, exception_traceback = sys.exc_info()
+        logger.error("Exception Type: {}, Exception Value: {}".format(exception_type, exception_value))
+        file_name, line_number, procedure_name, line_code = traceback.extract_tb(exception_traceback)[-1]
+        logger.error("File Name: {}, Line Number: {}, Procedure Name: {}, Line Code: {}".format(file_name, line_number, procedure_name, line_code))
+        return {"exception":"{}".format(str(exception_value))}
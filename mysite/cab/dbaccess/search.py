@@ -0,0 +1,210 @@
+''' Module to search train numbers by short name: prefix and substring matches over a sorted index '''
+
+
+import sys
+import array
+import bisect
+import logging
+
+
+from cab.dbaccess import database
+from cab.dbaccess import snapshot
+from cab.dbaccess import trainnumber as tn
+
+
+logger = logging.getLogger(__name__)
+
+
+# number of train numbers returned per page (default)
+PAGE_SIZE = 50
+
+# maximum number of train numbers returned per page
+MAX_PAGE_SIZE = 500
+
+# maximum memory (bytes) used by the indexes of all databases, least recently used indexes are evicted
+MAX_BYTES = 64 * 1024 * 1024
+
+# match kinds, in the order of the results: short name starts with the query, or contains it
+PREFIX = 0
+SUBSTRING = 1
+
+# start of the exception of an invalid request (cursor, limit), answered with status 400 (see getStatus)
+INVALID_REQUEST = "invalid search request"
+
+
+class TrainNumberIndex():
+    '''
+    Class to hold the train numbers of a database sorted by short name (case insensitive):
+    prefix matches are found by bisection, substring matches by searching the joined names.
+    '''
+
+    __slots__ = ('dbfile', 'columns', 'keys', 'text', 'offsets', 'nbytes')
+
+    def __init__(self, columns, dbfile):
+        '''
+        Constructor
+        columns: train numbers, column wise (DbTrainNumber.getTrainNumberColumns)
+        dbfile: database file
+        '''
+        self.dbfile = dbfile
+        self.columns = columns
+
+        # sort keys: (short name, train number id, row), the row makes each key unique
+        names = [(name or "").casefold().replace("\n", " ") for name in columns['trainNumberShortName']]
+        self.keys = sorted(zip(names, columns['trainNumberId'], range(len(names))))
+
+        # the sorted names, joined (one name per line), and the offset of each name in it
+        self.text = "\n".join(key[0] for key in self.keys)
+        offsets = []
+        offset = 0
+        for key in self.keys:
+            offsets.append(offset)
+            offset += len(key[0]) + 1
+        self.offsets = array.array('q', offsets)
+
+        self.nbytes = (sys.getsizeof(self.keys) + sum(sys.getsizeof(key) for key in self.keys)
+                       + sys.getsizeof(self.text) + sys.getsizeof(self.offsets))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, query, after=None, limit=PAGE_SIZE):
+        '''
+        Search the train numbers whose short name starts with (first) or contains the query, ordered by short name
+        query: text to search (case insensitive), empty: all train numbers
+        after: position (match kind, sort key) of the last train number of the previous page, None: first page
+        limit: maximum number of train numbers
+        return (list of (match kind, sort key), True if there are more)
+        '''
+        query = query.casefold()
+        matches = []
+        if after is not None:
+            self.checkPosition(query, after)
+        kind, key = after if after is not None else (PREFIX, None)
+
+        if kind == PREFIX:
+            if key is None:
+                index = bisect.bisect_left(self.keys, (query,))
+            else:
+                index = bisect.bisect_right(self.keys, key)
+            while (index < len(self.keys)) and self.keys[index][0].startswith(query):
+                if len(matches) == limit:
+                    return matches, True
+                matches.append((PREFIX, self.keys[index]))
+                index += 1
+            key = None
+
+        if (not query) or ("\n" in query):
+            return matches, False
+
+        # substring matches (prefix matches excluded: listed above)
+        index = 0 if key is None else bisect.bisect_right(self.keys, key)
+        while index < len(self.keys):
+            position = self.text.find(query, self.offsets[index])
+            if position < 0:
+                break
+            index = bisect.bisect_right(self.offsets, position) - 1
+            if position > self.offsets[index]:
+                if len(matches) == limit:
+                    return matches, True
+                matches.append((SUBSTRING, self.keys[index]))
+            index += 1
+        return matches, False
+
+    def checkPosition(self, query, position):
+        '''
+        Check that a position (of a cursor) is a match of the query in this index: a cursor of another database,
+        or of another query, is rejected (the page would start anywhere)
+        query: text searched (case folded)
+        position: (match kind, sort key)
+        raise ValueError if not
+        '''
+        kind, key = position
+        index = bisect.bisect_left(self.keys, key)
+        if (index == len(self.keys)) or (self.keys[index] != key):
+            raise ValueError("stale cursor: no train number {} in this database".format(key[1]))
+        if not ((kind == PREFIX and key[0].startswith(query)) or (kind == SUBSTRING and query and query in key[0] and not key[0].startswith(query))):
+            raise ValueError("stale cursor: train number {} is no match of this query".format(key[1]))
+
+    def makeDict(self, key):
+        ''' Make the dictionary of the train number of the given sort key (as TrainNumber.makeDict) '''
+        row = key[2]
+        return {name: values[row] for name, values in self.columns.items()}
+
+
+def encodeCursor(match):
+    ''' Encode the position (match kind, sort key) of a train number as pagination cursor (text) '''
+    kind, (name, trainNumberId, row) = match
+    return "{}:{}:{}:{}".format(kind, trainNumberId, row, name)
+
+
+def decodeCursor(cursor):
+    ''' Decode a pagination cursor into a position (match kind, sort key) '''
+    try:
+        kind, trainNumberId, row, name = cursor.split(":", 3)
+        return int(kind), (name, int(trainNumberId), int(row))
+    except ValueError:
+        raise ValueError("malformed cursor '{}'".format(cursor)) from None
+
+
+# the process-wide indexes (LRU eviction, as the snapshots)
+INDEXES = snapshot.SnapshotCache(MAX_BYTES)
+
+
+def getIndex(dbfile):
+    '''
+    Get the train number index of the given database (built on first use)
+    dbfile: database file
+    return index object
+    '''
+    my_index = INDEXES.get(dbfile)
+    if my_index is None:
+        my_snapshot = snapshot.getSnapshot(dbfile)
+        if my_snapshot is not None:
+            my_trainnumbers = tn.DbTrainNumber(None, my_snapshot)
+            columns = my_trainnumbers.getTrainNumberColumns()
+        else:
+            with database.Database(dbfile) as my_database:
+                my_trainnumbers = tn.DbTrainNumber(my_database.db_conn)
+                columns = my_trainnumbers.getTrainNumberColumns()
+        my_index = TrainNumberIndex(columns, dbfile)
+        INDEXES.put(my_index)
+        logger.info("train number index of {} built ({} train numbers, {} bytes)".format(dbfile, len(my_index), my_index.nbytes))
+    return my_index
+
+
+def searchTrainNumbers(dbfile, query, after=None, limit=None):
+    '''
+    Search the train numbers (lines) of the given database by short name: prefix matches first, then substring matches.
+    dbfile: database file
+    query: text to search (case insensitive), empty: all train numbers
+    after: cursor ('next' of the previous page), None: first page
+    limit: maximum number of train numbers (default PAGE_SIZE, at most MAX_PAGE_SIZE)
+    return json: total number of train numbers, train numbers of the page, cursor of the next page (None: last page)
+    '''
+    try:
+        limit = min(max(int(limit or PAGE_SIZE), 1), MAX_PAGE_SIZE)
+        with database.phase("fetch"):
+            my_index = getIndex(dbfile)
+        with database.phase("build"):
+            matches, more = my_index.search(query, decodeCursor(after) if after else None, limit)
+            return {
+                "count": len(my_index),
+                "trainNumbers": [my_index.makeDict(key) for _, key in matches],
+                "next": encodeCursor(matches[-1]) if more else None
+            }
+
+    except database.DatabaseException as e:
+        logger.error("Programm ended with a database error:{}".format(str(e)))
+        return {"exception":"{}".format(str(e))}
+
+    except ValueError as e:
+        logger.error("{}: {}".format(INVALID_REQUEST, str(e)))
+        return {"exception":"{}: {}".format(INVALID_REQUEST, str(e))}
+
+
+def getStatus(response_data):
+    ''' The HTTP status of a search response: 400 for an invalid request (malformed or stale cursor, limit), 200 otherwise '''
+    if str(response_data.get("exception", "")).startswith(INVALID_REQUEST):
+        return 400
+    return 200
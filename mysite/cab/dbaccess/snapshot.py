@@ -0,0 +1,283 @@
+''' Module to hold in-memory snapshots (indexes) of whole uploaded databases '''
+
+
+import sys
+import array
+import bisect
+import logging
+import operator
+import threading
+import collections
+
+
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+
+
+logger = logging.getLogger(__name__)
+
+
+# maximum memory (bytes) used by all snapshots, least recently used snapshots are evicted
+MAX_BYTES = 256 * 1024 * 1024
+
+# array type codes for integer columns (smallest first), the minimum value of a type code is used for NULL
+INT_TYPECODES = ('b', 'h', 'i', 'q')
+
+
+class Column():
+    ''' Class to hold the values of one column: integer array, string codes (array) or list '''
+
+    __slots__ = ('kind', 'values', 'strings', 'null')
+
+    def __init__(self, values):
+        '''
+        Constructor
+        values: list of the column values (int, str or None)
+        '''
+        self.strings = None
+        self.null = None
+        if all((value is None) or (type(value) is int) for value in values):
+            numbers = [value for value in values if value is not None] or [0]
+            low, high = min(numbers), max(numbers)
+            for typecode in INT_TYPECODES:
+                bits = array.array(typecode).itemsize * 8
+                if (low > -(1 << (bits - 1))) and (high < (1 << (bits - 1))):
+                    self.null = -(1 << (bits - 1))
+                    self.values = array.array(typecode, (self.null if value is None else value for value in values))
+                    self.kind = 'int'
+                    return
+        elif all((value is None) or (type(value) is str) for value in values):
+            # each distinct string is held only once, code 0 is NULL
+            codes = {None: 0}
+            self.strings = [None]
+            for value in values:
+                if value not in codes:
+                    codes[value] = len(self.strings)
+                    self.strings.append(value)
+            self.values = array.array('I', (codes[value] for value in values))
+            self.kind = 'str'
+            return
+        self.values = list(values)
+        self.kind = 'obj'
+
+    def __getitem__(self, index):
+        value = self.values[index]
+        if self.kind == 'int':
+            return None if value == self.null else value
+        if self.kind == 'str':
+            return self.strings[value]
+        return value
+
+    def nbytes(self):
+        ''' Memory used by the column (bytes) '''
+        if self.kind == 'obj':
+            return sys.getsizeof(self.values) + sum(sys.getsizeof(value) for value in self.values)
+        nbytes = sys.getsizeof(self.values)
+        if self.strings is not None:
+            nbytes += sys.getsizeof(self.strings) + sum(sys.getsizeof(value) for value in self.strings)
+        return nbytes
+
+
+class Table():
+    ''' Class to hold the rows of a query, column wise, grouped by a key column (the row order within a key is kept) '''
+
+    __slots__ = ('keys', 'starts', 'columns')
+
+    def __init__(self, rows, key=None):
+        '''
+        Constructor
+        rows: list of rows (tuples)
+        key: index of the key column (rows with a NULL key are dropped), None: no key (all rows in one group)
+        '''
+        if key is None:
+            self.keys = None
+            self.starts = array.array('q', [0, len(rows)])
+        else:
+            # stable sort: the query order is kept within a key
+            rows = sorted((row for row in rows if row[key] is not None), key=operator.itemgetter(key))
+            keys = []
+            starts = []
+            for index, row in enumerate(rows):
+                if not keys or keys[-1] != row[key]:
+                    keys.append(row[key])
+                    starts.append(index)
+            starts.append(len(rows))
+            try:
+                self.keys = array.array('q', keys)
+            except (TypeError, OverflowError):
+                self.keys = keys
+            self.starts = array.array('q', starts)
+
+        ncolumns = len(rows[0]) if rows else 0
+        self.columns = [Column([row[col] for row in rows]) for col in range(ncolumns)]
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def rowsAt(self, start, end):
+        ''' Rows (tuples) from start to end (excluded) '''
+        return [tuple(column[index] for column in self.columns) for index in range(start, end)]
+
+    def rows(self):
+        ''' All rows (tuples) '''
+        return self.rowsAt(0, len(self))
+
+    def column(self, col):
+        ''' All values of one column (list), without building the rows '''
+        column = self.columns[col]
+        if column.kind == 'int':
+            return [None if value == column.null else value for value in column.values]
+        if column.kind == 'str':
+            return [column.strings[value] for value in column.values]
+        return list(column.values)
+
+    def get(self, key, default=None):
+        '''
+        Rows (tuples) of the given key (the same interface as dict.get)
+        key: key value
+        default: returned if there is no row with that key
+        '''
+        if (self.keys is None) or (key is None):
+            return default
+        try:
+            index = bisect.bisect_left(self.keys, key)
+        except TypeError:
+            return default
+        if (index == len(self.keys)) or (self.keys[index] != key):
+            return default
+        return self.rowsAt(self.starts[index], self.starts[index + 1])
+
+    def nbytes(self):
+        ''' Memory used by the table (bytes) '''
+        nbytes = sys.getsizeof(self.starts) + sum(column.nbytes() for column in self.columns)
+        if self.keys is not None:
+            nbytes += sys.getsizeof(self.keys)
+        return nbytes
+
+
+class Snapshot():
+    ''' Class to hold the snapshot (in-memory index) of a whole database '''
+
+    __slots__ = ('dbfile', 'trainnumbers', 'trainnumber', 'linesections', 'lineevents', 'actions',
+                 'cplxactionids', 'cplxactions', 'attributes', 'nbytes')
+
+    def __init__(self, db_conn, dbfile):
+        '''
+        Constructor: reads all tables (queries with the same columns as the dbaccess queries)
+        db_conn: database connection object (sqlite3)
+        dbfile: database file
+        '''
+        self.dbfile = dbfile
+
+        def read(query, key=None):
+            return Table(db_conn.execute(query).fetchall(), key)
+
+        self.trainnumbers = read(db_queries.QUERY_TRAINNUMBERS)                   # all train numbers (ordered)
+        self.trainnumber = read(db_queries.QUERY_SNAPSHOT_TRAINNUMBER, 12)        # by train number id
+        self.linesections = read(db_queries.QUERY_SNAPSHOT_LINESECTIONS, 8)       # by line id
+        self.lineevents = read(db_queries.QUERY_SNAPSHOT_LINEEVENTS, 6)           # by line section id
+        self.actions = read(db_queries.QUERY_SNAPSHOT_ACTIONS, 6)                 # by action list id
+        self.cplxactionids = read(db_queries.QUERY_SNAPSHOT_CA_ACTIONS, 0)        # complex action id by action id
+        self.cplxactions = read(db_queries.QUERY_SNAPSHOT_COMPLEX_ACTIONS, 0)     # by complex action id
+        self.attributes = read(db_queries.QUERY_SNAPSHOT_CA_ATTRIBUTES, 0)        # by attribute list id
+
+        self.nbytes = sum(table.nbytes() for table in (
+            self.trainnumbers, self.trainnumber, self.linesections, self.lineevents, self.actions,
+            self.cplxactionids, self.cplxactions, self.attributes))
+
+    def complexActionRows(self, act_id, default=None):
+        '''
+        Rows of the complex action of the given action (same columns as QUERY_COMPLEX_ACTION)
+        act_id: action id
+        default: returned if the action is no complex action
+        '''
+        for row in self.cplxactionids.get(act_id, []):
+            return self.cplxactions.get(row[1], default)
+        return default
+
+
+class SnapshotCache():
+    ''' Class to hold the snapshots of all uploaded databases (process-wide, thread-safe, LRU eviction) '''
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        '''
+        Constructor
+        max_bytes: maximum memory (bytes) used by all snapshots
+        '''
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.snapshots = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, dbfile):
+        '''
+        Get the snapshot of the given database (None if there is none)
+        dbfile: database file
+        '''
+        with self.lock:
+            my_snapshot = self.snapshots.get(dbfile)
+            if my_snapshot is not None:
+                self.snapshots.move_to_end(dbfile)
+            return my_snapshot
+
+    def put(self, my_snapshot):
+        '''
+        Add the given snapshot, evict the least recently used snapshots if needed
+        my_snapshot: snapshot object
+        '''
+        with self.lock:
+            self.pop(my_snapshot.dbfile)
+            if my_snapshot.nbytes > self.max_bytes:
+                logger.warning("snapshot of {} too large ({} bytes), not kept".format(my_snapshot.dbfile, my_snapshot.nbytes))
+                return
+            self.snapshots[my_snapshot.dbfile] = my_snapshot
+            self.nbytes += my_snapshot.nbytes
+            while self.nbytes > self.max_bytes:
+                dbfile, evicted = self.snapshots.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                logger.info("snapshot of {} evicted ({} bytes)".format(dbfile, evicted.nbytes))
+
+    def remove(self, dbfile):
+        '''
+        Remove the snapshot of the given database
+        dbfile: database file
+        '''
+        with self.lock:
+            self.pop(dbfile)
+
+    def pop(self, dbfile):
+        ''' Remove the snapshot of the given database (lock must be held) '''
+        my_snapshot = self.snapshots.pop(dbfile, None)
+        if my_snapshot is not None:
+            self.nbytes -= my_snapshot.nbytes
+
+
+# the process-wide snapshots
+SNAPSHOTS = SnapshotCache()
+
+
+def buildSnapshot(dbfile):
+    '''
+    Build the snapshot of the given database and keep it.
+    dbfile: database file
+    return snapshot object, None on error
+    '''
+    try:
+        with database.Database(dbfile) as my_database:
+            my_snapshot = Snapshot(my_database.db_conn, dbfile)
+        SNAPSHOTS.put(my_snapshot)
+        logger.info("snapshot of {} built ({} bytes)".format(dbfile, my_snapshot.nbytes))
+        return my_snapshot
+
+    except Exception as e:
+        logger.error("cannot build snapshot of {}: {}".format(dbfile, str(e)))
+        return None
+
+
+def getSnapshot(dbfile):
+    '''
+    Get the snapshot of the given database.
+    dbfile: database file
+    return snapshot object, None if there is none
+    '''
+    return SNAPSHOTS.get(dbfile)
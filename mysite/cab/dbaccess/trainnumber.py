@@ -4,18 +4,50 @@
 import sys
 import traceback
 import datetime
+import functools
 import logging
 
 
 from cab.dbaccess import database
 from cab.dbaccess import db_queries
+from cab.dbaccess import snapshot
 
 
 logger = logging.getLogger(__name__)
 
 
+# number of rows fetched at once (columnar train numbers)
+FETCH_SIZE = 1024
+
+# the columns of the columnar train numbers: name, index in QUERY_TRAINNUMBERS
+COLUMNS = (
+    ('trainNumberId', 0),
+    ('trainNumberShortName', 2),
+    ('lineId', 1),
+    ('circulationId', 3),
+    ('fromDate', 9),
+    ('toDate', 10)
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def convertDbDate(dbdate):
+    '''
+    Converts a dbdate from db-format into unix epoch time
+    (memoized: a database has only a few hundred distinct validity dates)
+    '''
+    year = (dbdate >> 9)
+    month = ((dbdate >> 5) & 0xF)
+    day = (dbdate & 0x1F)
+    myDateTime = datetime.datetime(year, month, day)
+    #print(year, month, day, myDateTime.timestamp());
+    return int(myDateTime.timestamp())
+
+
 class TrainNumber():
-    ''' Class to hold a train number (line) '''
+    ''' Class to hold a train number (line), the dictionary is made on demand, not kept '''
+
+    __slots__ = ("tn_id", "tr_sn", "line_id", "circ_id", "from_date", "to_date")
 
     def __init__(self, tn_id, tr_sn, line_id, circ_id, from_date, to_date):
         '''
@@ -34,48 +66,50 @@ class TrainNumber():
         self.from_date = from_date
         self.to_date = to_date
 
-        self.trainnumber = dict()
-
     def makeDict(self):
-        ''' Make the dictionnary (fill in with content) '''
-        self.trainnumber['trainNumberId'] = self.tn_id
-        self.trainnumber['trainNumberShortName'] = self.tr_sn
-        self.trainnumber['lineId'] = self.line_id
-        self.trainnumber['circulationId'] = self.circ_id
-        self.trainnumber['fromDate'] = self.convertDbDate(self.from_date)
-        self.trainnumber['toDate'] = self.convertDbDate(self.to_date)
-        
-        return self.trainnumber
+        ''' Make the dictionnary '''
+        return {
+            'trainNumberId': self.tn_id,
+            'trainNumberShortName': self.tr_sn,
+            'lineId': self.line_id,
+            'circulationId': self.circ_id,
+            'fromDate': self.convertDbDate(self.from_date),
+            'toDate': self.convertDbDate(self.to_date)
+        }
     
     def convertDbDate(self, dbdate):
         ''' Converts a dbdate from db-format into unix epoch time '''
-        year = (dbdate >> 9)
-        month = ((dbdate >> 5) & 0xF)
-        day = (dbdate & 0x1F)
-        myDateTime = datetime.datetime(year, month, day)
-        #print(year, month, day, myDateTime.timestamp());
-        return int(myDateTime.timestamp())
+        return convertDbDate(dbdate)
 
 
 class DbTrainNumber():
     ''' Class to handle database train numbers (lines) '''
 
-    def __init__(self, db_conn):
+    def __init__(self, db_conn, my_snapshot=None):
         '''
         Constructor
-        db_conn: database connection object (sqlite3)
+        db_conn: database connection object (sqlite3), not used if a snapshot is given
+        my_snapshot: snapshot (in-memory index) of the database, or None
         '''
         self.db_conn = db_conn
+        self.snapshot = my_snapshot
         self.trainnumbers = []
 
-    def getTrainNumbers(self):
+    def getTrainNumbers(self, columnar=False):
         '''
         Get lines.
+        columnar: get the lines as one list per field (see getTrainNumberColumns) instead of one dictionary per line
         '''
         #print("getLines: ")
-
-        cursor = self.db_conn.execute(db_queries.QUERY_TRAINNUMBERS)
-        for row in cursor:
+        if columnar:
+            self.trainnumbers = self.getTrainNumberColumns()
+            return
+
+        if self.snapshot is None:
+            rows = self.db_conn.execute(db_queries.QUERY_TRAINNUMBERS)
+        else:
+            rows = self.snapshot.trainnumbers.rows()
+        for row in rows:
             #print("getLines: row={0}".format(row))
             
             trainnumber = TrainNumber(
@@ -88,20 +122,52 @@ class DbTrainNumber():
                 )
             self.trainnumbers.append(trainnumber.makeDict())
 
-
-def getTrainNumbers(dbfile):
+    def getTrainNumberColumns(self):
+        '''
+        Get lines, column wise: built straight from the cursor (fetched in batches), without an object per line.
+        return dictionary: field name (as in TrainNumber.makeDict) -> list of values (one per line)
+        '''
+        columns = {name: [] for name, _ in COLUMNS}
+
+        if self.snapshot is not None:
+            for name, col in COLUMNS:
+                columns[name] = self.snapshot.trainnumbers.column(col)
+        else:
+            cursor = self.db_conn.execute(db_queries.QUERY_TRAINNUMBERS)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                values = list(zip(*rows))
+                for name, col in COLUMNS:
+                    columns[name].extend(values[col])
+
+        columns['fromDate'] = [convertDbDate(dbdate) for dbdate in columns['fromDate']]
+        columns['toDate'] = [convertDbDate(dbdate) for dbdate in columns['toDate']]
+        return columns
+
+
+def getTrainNumbers(dbfile, columnar=False):
     '''
     Retrieve all train numbers (lines) from the given database.
+    columnar: one list per field instead of one dictionary per line
     return train numbers (lines) as json
     '''
     #print("getTrainNumbers: ", dbfile)
     try:
-        # open connection to database
-        my_database = database.Database(dbfile)
-        my_trainnumbers = DbTrainNumber(my_database.db_conn)
-        my_trainnumbers.getTrainNumbers()
+        my_snapshot = snapshot.getSnapshot(dbfile)
+        if my_snapshot is not None:
+            # answer from the in-memory snapshot
+            my_trainnumbers = DbTrainNumber(None, my_snapshot)
+            with database.phase("fetch"):
+                my_trainnumbers.getTrainNumbers(columnar)
+            return my_trainnumbers.trainnumbers
+
+        # open connection to database (the train numbers are built while the rows are read: one phase)
+        with database.Database(dbfile) as my_database, database.phase("fetch"):
+            my_trainnumbers = DbTrainNumber(my_database.db_conn)
+            my_trainnumbers.getTrainNumbers(columnar)
         #print(my_trainnumbers)
-        my_database.close()
         return my_trainnumbers.trainnumbers
 
     except database.DatabaseException as e:
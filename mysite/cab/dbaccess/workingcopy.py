@@ -0,0 +1,244 @@
+''' Module to hold working copies of the uploaded databases: copied (backup API) in memory or into a scratch file, with indexes '''
+
+
+import os
+import sqlite3
+import logging
+import tempfile
+import threading
+import itertools
+
+
+from cab.dbaccess import db_queries
+
+
+logger = logging.getLogger(__name__)
+
+
+# None: the queries run against the uploaded database as is, 'memory': against an in-memory copy,
+# 'scratch': against a copy in SCRATCH_DIR
+MODE = None
+
+# directory of the scratch copies (None: 'cab-work' in the system temporary directory)
+SCRATCH_DIR = None
+
+# number of pages copied per backup step (the copy is interrupted between steps)
+BACKUP_PAGES = 1024
+
+# scans which are no lookups (names as in db_queries): the recursive CTE of the tree query,
+# and the type tables of a few rows the planner may start a join from (timetableperiod, attributedatatype)
+UNINDEXED_SCANS = ("nodes", "tp", "adt")
+
+# the lookup queries (db_queries), with the parameters used to explain them
+LOOKUP_QUERIES = {
+    "QUERY_TRAINNUMBER_ID": (1,),
+    "QUERY_LINESECTIONS": (1,),
+    "QUERY_LINEEVENTS": (1,),
+    "QUERY_LINEEVENTS_OF_LINE": (1,),
+    "QUERY_ACTIONS": (1,),
+    "QUERY_ACTIONS_OF_LINE": (1,),
+    "QUERY_LINESECTION_ID": (1, 1),
+    "QUERY_ACTIONS_OF_LINESECTION": (1,),
+    "QUERY_LINESECTION_COUNTS": {"id": 1},
+    "QUERY_COMPLEX_ACTION": (1,),
+    "QUERY_CA_ATTRIBUTES": {"id": 1},
+    "QUERY_COMPLEX_ACTION_TREE": (1,),
+    "QUERY_CA_ATTRIBUTE_LISTS": (1,),
+}
+
+
+class WorkingCopy():
+    ''' Class to hold the working copy of one database '''
+
+    def __init__(self, db_name, uri, keeper=None, path=None, nbytes=0):
+        '''
+        Constructor
+        db_name: name of the copied database
+        uri: uri of the copy (read-only)
+        keeper: connection keeping an in-memory copy alive, or None
+        path: file of a scratch copy, or None
+        nbytes: size of the copy (bytes)
+        '''
+        self.db_name = db_name
+        self.uri = uri
+        self.keeper = keeper
+        self.path = path
+        self.nbytes = nbytes
+
+    def close(self):
+        ''' Drop the copy (connections still open keep reading it until they are closed) '''
+        if self.keeper is not None:
+            self.keeper.close()
+            self.keeper = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+def getScratchDir():
+    ''' The directory of the scratch copies (created if needed) '''
+    scratch_dir = SCRATCH_DIR or os.path.join(tempfile.gettempdir(), "cab-work")
+    os.makedirs(scratch_dir, exist_ok=True)
+    return scratch_dir
+
+
+def makeWorkingCopy(db_name, name, mode, interrupt=None):
+    '''
+    Copy a database (backup API) and create the indexes of the lookup queries in the copy
+    db_name: name of the database to copy
+    name: name of the copy (unique)
+    mode: 'memory' or 'scratch'
+    interrupt: function returning True when the copy is to be interrupted (progress handler), or None
+    return working copy object
+    '''
+    if mode == "memory":
+        # memdb: one in-memory database shared by all connections of the process (not the shared cache)
+        uri = "file:/{}?vfs=memdb".format(name)
+        path = None
+    else:
+        path = os.path.join(getScratchDir(), name + ".db")
+        uri = "file:{}".format(path)
+
+    def checkBackup(status, remaining, total):
+        if (interrupt is not None) and interrupt():
+            raise sqlite3.OperationalError("interrupted")
+
+    source = sqlite3.connect("file:{}?mode=ro".format(db_name), uri=True)
+    target = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    try:
+        source.backup(target, pages=BACKUP_PAGES, progress=checkBackup)
+        if interrupt is not None:
+            target.set_progress_handler(interrupt, 10000)
+        for statement in db_queries.CREATE_WORKING_COPY_INDEXES:
+            try:
+                target.execute(statement)
+            except sqlite3.OperationalError as e:
+                if (interrupt is not None) and interrupt():
+                    raise
+                # e.g. a column missing in this database: the lookups using it scan
+                logger.warning("working copy of {}: index not created ({}): {}".format(db_name, e, statement.split("\n")[0]))
+        # statistics of the new indexes for the query planner
+        target.execute("ANALYZE;")
+        target.commit()
+        target.set_progress_handler(None, 0)
+        nbytes = target.execute("PRAGMA page_count;").fetchone()[0] * target.execute("PRAGMA page_size;").fetchone()[0]
+    except BaseException:
+        target.close()
+        if (path is not None) and os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        source.close()
+
+    if mode == "memory":
+        return WorkingCopy(db_name, uri + "&mode=ro", keeper=target, nbytes=nbytes)
+    target.close()
+    return WorkingCopy(db_name, uri + "?mode=ro", path=path, nbytes=nbytes)
+
+
+class WorkingCopies():
+    ''' Class to hold the working copies by database (process-wide, thread-safe): each copy is made once, on first use '''
+
+    def __init__(self):
+        ''' Constructor '''
+        self.copies = dict()     # database name -> working copy, None: the database is used as is
+        self.building = dict()   # database name -> lock held while its copy is made
+        self.names = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def getUri(self, db_name, interrupt=None):
+        '''
+        Get the uri of the working copy of a database (the copy is made if there is none)
+        db_name: name of the database
+        interrupt: function returning True when the copy is to be interrupted, or None
+        return uri of the copy, None if the database cannot be copied (then it is used as is)
+        '''
+        with self.lock:
+            if db_name in self.copies:
+                copy = self.copies[db_name]
+                return None if copy is None else copy.uri
+            building = self.building.setdefault(db_name, threading.Lock())
+
+        # one thread makes the copy, the others wait for it
+        with building:
+            with self.lock:
+                if db_name in self.copies:
+                    copy = self.copies[db_name]
+                    return None if copy is None else copy.uri
+                if self.building.get(db_name) is not building:
+                    # removed while waiting
+                    return None
+                # unique across the processes of the server (each process makes its own copies)
+                name = "cab-work-{}-{}-{}".format(os.getpid(), next(self.names), os.path.splitext(os.path.basename(db_name))[0][:16])
+            try:
+                copy = makeWorkingCopy(db_name, name, MODE, interrupt)
+                logger.info("working copy of {} made ({}, {} bytes)".format(db_name, MODE, copy.nbytes))
+            except Exception as e:
+                if (interrupt is not None) and interrupt():
+                    # cancelled: made on next use
+                    return None
+                logger.error("cannot make working copy of {}: {}".format(db_name, str(e)))
+                copy = None
+            with self.lock:
+                removed = self.building.get(db_name) is not building
+                if not removed:
+                    self.copies[db_name] = copy
+                    self.building.pop(db_name, None)
+            if removed:
+                # the database was removed while its copy was made: the copy is dropped, not kept
+                if copy is not None:
+                    copy.close()
+                logger.info("working copy of {} dropped (database removed)".format(db_name))
+                return None
+        return None if copy is None else copy.uri
+
+    def remove(self, db_name):
+        '''
+        Drop the working copy of a database (a copy being made is dropped once made, see getUri)
+        db_name: name of the database
+        '''
+        with self.lock:
+            copy = self.copies.pop(db_name, None)
+            self.building.pop(db_name, None)
+        if copy is not None:
+            copy.close()
+
+    def stats(self):
+        ''' Working copy counters (copies and their bytes) '''
+        with self.lock:
+            copies = [copy for copy in self.copies.values() if copy is not None]
+            return {"copies": len(copies), "bytes": sum(copy.nbytes for copy in copies)}
+
+
+# the process-wide working copies
+COPIES = WorkingCopies()
+
+
+def explainQueries(db_conn):
+    '''
+    Explain the query plans of the lookup queries (EXPLAIN QUERY PLAN)
+    db_conn: connection to the database (or its working copy)
+    return dictionary: query name -> list of plan lines
+    '''
+    plans = dict()
+    for query_name, parameters in LOOKUP_QUERIES.items():
+        query = getattr(db_queries, query_name)
+        if "{placeholders}" in query:
+            query = query.format(placeholders="?1")
+        plans[query_name] = [row[3] for row in db_conn.execute("EXPLAIN QUERY PLAN " + query, parameters)]
+    return plans
+
+
+def findScans(plan):
+    '''
+    Find the full table scans of a query plan
+    plan: list of plan lines (see explainQueries)
+    return list of the scanned tables
+    '''
+    # 'SCAN t USING (COVERING) INDEX ...' reads an index, 'SCAN CONSTANT ROW' reads no table
+    return [line for line in plan
+            if line.startswith("SCAN ") and (" USING " not in line)
+            and (line.split()[1] not in UNINDEXED_SCANS) and (line != "SCAN CONSTANT ROW")]
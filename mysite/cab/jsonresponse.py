@@ -0,0 +1,84 @@
+''' Module to send JSON responses: the data is encoded once (orjson when installed, json otherwise), or streamed '''
+
+
+import json
+
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+
+
+from cab.dbaccess import database
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# the fragments of a streamed response are sent in chunks of about this size (bytes)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def dumps(data):
+    '''
+    Encode the given data as compact JSON
+    data: data to encode (dict, list, str, int, ...)
+    return JSON text (bytes, UTF-8)
+    '''
+    if (orjson is not None) and settings.CAB_JSON_ORJSON:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # e.g. nested deeper than orjson encodes (255 levels): a complex action tree adds two levels per node
+            # (node, children), trees up to cplxaction.MAX_TREE_DEPTH are encoded by json
+            pass
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class CabJsonResponse(HttpResponse):
+    ''' Class to send data as JSON (encoded once: the client parses the body with response.json() only) '''
+
+    def __init__(self, data, **kwargs):
+        '''
+        Constructor
+        data: data to send (any JSON type: train number lists are sent as arrays)
+        '''
+        kwargs.setdefault("content_type", "application/json")
+        with database.phase("json"):
+            content = dumps(data)
+        super().__init__(content=content, **kwargs)
+
+
+def joinChunks(fragments, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Join JSON fragments to chunks (a write to the client per chunk, not per fragment)
+    fragments: iterable of JSON fragments (bytes)
+    chunk_size: minimum size of a chunk (bytes), except the last one
+    yield chunks (bytes)
+    '''
+    # appended to one buffer: each fragment is freed at once (orjson over-allocates small results)
+    chunk = bytearray()
+    for fragment in fragments:
+        chunk += fragment
+        if len(chunk) >= chunk_size:
+            yield bytes(chunk)
+            chunk = bytearray()
+    if chunk:
+        yield bytes(chunk)
+
+
+class CabStreamingJsonResponse(StreamingHttpResponse):
+    '''
+    Class to send JSON while it is serialized: the first chunk is sent before the last one is made,
+    neither the data as dictionary nor the complete JSON are held in memory
+    '''
+
+    def __init__(self, chunks, **kwargs):
+        '''
+        Constructor
+        chunks: iterator of JSON chunks (bytes, see joinChunks), an asynchronous one under ASGI
+        '''
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(streaming_content=chunks, **kwargs)
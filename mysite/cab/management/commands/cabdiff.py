@@ -0,0 +1,47 @@
+''' Command to compare two databases (e.g. two versions of a timetable), see cab.dbaccess.diff
+
+Usage (from the mysite directory):
+    python manage.py cabdiff <base> <other> [--limit N] [--indent N]
+
+base and other are database files or content hashes of uploaded databases (see upload.findDbFile).
+The differences are written as JSON (as sent by cab/diff).
+'''
+
+
+import os
+import json
+
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+from cab import upload
+from cab.dbaccess import diff
+
+
+class Command(BaseCommand):
+    help = "Compare two databases: counts, removed, added and changed train numbers (with their differing subtrees) as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("base", help="database of the base version (file or content hash of an upload)")
+        parser.add_argument("other", help="database of the other version (file or content hash of an upload)")
+        parser.add_argument("--limit", type=int, help="number of changed train numbers compared subtree by subtree (default: CAB_DIFF_DETAIL_LIMIT)")
+        parser.add_argument("--indent", type=int, help="indent the JSON")
+
+    def handle(self, *args, **options):
+        baseFile = self.getDbFile(options["base"])
+        otherFile = self.getDbFile(options["other"])
+
+        response_data = diff.getDiff(baseFile, otherFile, options["limit"])
+        if "exception" in response_data:
+            raise CommandError(response_data["exception"])
+        self.stdout.write(json.dumps(response_data, ensure_ascii=False, indent=options["indent"]))
+
+    def getDbFile(self, name):
+        ''' The database file of a file name or of the content hash of an upload '''
+        if os.path.isfile(name):
+            return name
+        dbfile = upload.findDbFile(name)
+        if dbfile is None:
+            raise CommandError("no database file or uploaded database '{}'".format(name))
+        return dbfile
@@ -0,0 +1,146 @@
+''' Module to instrument the requests: statements and time spent in SQLite, building and serializing, sent as Server-Timing '''
+
+
+import time
+import logging
+
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+from cab.dbaccess import database
+
+
+logger = logging.getLogger(__name__)
+
+
+# phases reported (see database.phase), in this order: the time in SQLite ('sql') is part of 'fetch'
+PHASES = ("fetch", "build", "json", "log")
+
+# maximum number of characters of a statement logged by the slow request sampler
+STATEMENT_MAX_CHARS = 200
+
+
+class ServerTimingMiddleware():
+    '''
+    Class to instrument each request (sync and async): a database profile is set for the request (see database.PROFILE),
+    its statements, time in SQLite and phases are sent as Server-Timing header and logged as one line (INFO).
+    The top statements of the requests slower than CAB_SLOW_REQUEST_MS are logged (WARNING).
+    A streamed response (see CAB_STREAM_JSON) is built and serialized while it is sent, after its header: its chunks are
+    made in the profile of the request (phase 'json'), the line is logged once the last one is sent.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        '''
+        Constructor
+        get_response: the next middleware or the view
+        '''
+        if not settings.CAB_SERVER_TIMING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profile = database.Profile()
+        start = time.perf_counter()
+        with database.profiling(profile):
+            response = self.get_response(request)
+        return self.finish(request, response, profile, start)
+
+    async def __acall__(self, request):
+        profile = database.Profile()
+        start = time.perf_counter()
+        with database.profiling(profile):
+            response = await self.get_response(request)
+        return self.finish(request, response, profile, start)
+
+    def finish(self, request, response, profile, start):
+        '''
+        Send the profile of a request, log it (a streamed response: once sent)
+        request: the request
+        response: its response
+        profile: database profile of the request
+        start: start time of the request (time.perf_counter)
+        return response
+        '''
+        timing = self.getTiming(profile, start)
+        metrics = ['sql;dur={};desc="{} statements"'.format(timing["sql"], timing["statements"])]
+        metrics.extend("{};dur={}".format(name, timing[name]) for name in PHASES if name in profile.phases)
+        metrics.append("total;dur={}".format(timing["total"]))
+        response["Server-Timing"] = ", ".join(metrics)
+
+        if not response.streaming:
+            self.log(request, response, profile, timing)
+        elif response.is_async:
+            response.streaming_content = self.aprofileChunks(response.streaming_content, request, response, profile, start)
+        else:
+            response.streaming_content = self.profileChunks(response.streaming_content, request, response, profile, start)
+        return response
+
+    def profileChunks(self, chunks, request, response, profile, start):
+        ''' Make the chunks of a streamed response in the profile of its request, log the profile after the last one '''
+        try:
+            while True:
+                with database.profiling(profile), database.phase("json"):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.log(request, response, profile, self.getTiming(profile, start))
+
+    async def aprofileChunks(self, chunks, request, response, profile, start):
+        ''' Make the chunks of an asynchronous streamed response in the profile of its request (see profileChunks) '''
+        try:
+            while True:
+                with database.profiling(profile), database.phase("json"):
+                    chunk = await anext(chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.log(request, response, profile, self.getTiming(profile, start))
+
+    def getTiming(self, profile, start):
+        '''
+        The timing of a request so far: statements, SQLite progress, milliseconds in SQLite, by phase and in total
+        profile: database profile of the request
+        start: start time of the request (time.perf_counter)
+        '''
+        timing = {
+            "statements": profile.statements,
+            "vmSteps": profile.progress * database.PROGRESS_STEPS,
+            "sql": round(profile.sql_seconds * 1000, 2)
+        }
+        for name in PHASES:
+            timing[name] = round(profile.phases.get(name, 0.0) * 1000, 2)
+        timing["total"] = round((time.perf_counter() - start) * 1000, 2)
+        return timing
+
+    def log(self, request, response, profile, timing):
+        ''' Log the timing of a request (INFO), and its top statements if slow (WARNING) '''
+        if logger.isEnabledFor(logging.INFO):
+            summary = {"path": request.path, "status": response.status_code}
+            summary.update(timing)
+            logger.info("%s %s", "timing", " ".join("{}={}".format(key, value) for key, value in summary.items()),
+                        extra={"cab": summary})
+
+        slow_ms = settings.CAB_SLOW_REQUEST_MS
+        if (slow_ms is not None) and (timing["total"] >= slow_ms):
+            self.logTopStatements(request, profile, timing)
+
+    def logTopStatements(self, request, profile, timing):
+        ''' Log the statements of a slow request which took the most time (CAB_SLOW_REQUEST_STATEMENTS) '''
+        lines = ["slow request {} ({} ms, {} statements, {} ms in SQLite), top statements:".format(
+            request.path, timing["total"], timing["statements"], timing["sql"])]
+        for sql, executions, seconds in profile.getTopStatements(settings.CAB_SLOW_REQUEST_STATEMENTS):
+            lines.append("    {:.2f} ms {}x {}".format(seconds * 1000, executions, " ".join(sql.split())[:STATEMENT_MAX_CHARS]))
+        logger.warning("\n".join(lines))
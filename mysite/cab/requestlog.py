@@ -0,0 +1,116 @@
+''' Module to log the cab requests: a summary line at INFO, the (capped) response payload at DEBUG '''
+
+
+import time
+import logging
+
+
+from django.conf import settings
+
+
+from cab.dbaccess import database
+
+
+def countNodes(data):
+    '''
+    Count the nodes (dictionaries) of a response: tree nodes, items of a list, or rows of a columnar response
+    data: response data (or the tree of objects of a streamed response, see act.iterJson)
+    return number of nodes
+    '''
+    if isinstance(data, dict) and data and all(isinstance(values, list) for values in data.values()):
+        # columnar: one list per field
+        return len(next(iter(data.values())))
+    count = 0
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            count += 1
+            children = item.get("children")
+            if children:
+                stack.extend(children)
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif hasattr(item, "getChildren"):
+            count += 1
+            stack.extend(item.getChildren() or [])
+    return count
+
+
+class PayloadDump():
+    ''' Class to format a response payload only when the log record is emitted, capped to CAB_LOG_PAYLOAD_MAX_CHARS '''
+
+    __slots__ = ("content",)
+
+    def __init__(self, content):
+        '''
+        Constructor
+        content: response content (JSON, bytes)
+        '''
+        self.content = content
+
+    def __str__(self):
+        max_chars = settings.CAB_LOG_PAYLOAD_MAX_CHARS
+        text = self.content[:max_chars].decode("utf-8", errors="replace")
+        if len(self.content) > max_chars:
+            text += " ... ({} bytes not logged)".format(len(self.content) - max_chars)
+        return text
+
+
+class RequestLog():
+    '''
+    Class to log one request: duration, statements executed, nodes and bytes of the response.
+    Created when the request starts (the statements of this context are counted from then on, by the counter of the
+    context if set, e.g. of the request profile, see database.profiling).
+    '''
+
+    def __init__(self, logger, name, **fields):
+        '''
+        Constructor
+        logger: logger of the view
+        name: name of the request (e.g. view name)
+        fields: further fields to log (e.g. trainNumberId)
+        '''
+        self.logger = logger
+        self.name = name
+        self.fields = fields
+        self.statements = database.STATEMENTS.get()
+        self.token = None
+        if self.statements is None:
+            self.statements = [0]
+            self.token = database.STATEMENTS.set(self.statements)
+        self.first_statement = self.statements[0]
+        self.start = time.perf_counter()
+
+    def done(self, response, response_data):
+        '''
+        Log the summary (INFO) and the payload (DEBUG) of the request
+        response: the response to send
+        response_data: the data of the response
+        return response
+        '''
+        duration = time.perf_counter() - self.start
+        self.queries = self.statements[0] - self.first_statement
+        if self.token is not None:
+            database.STATEMENTS.reset(self.token)
+
+        with database.phase("log"):
+            self.log(response, response_data, duration)
+        return response
+
+    def log(self, response, response_data, duration):
+        ''' Log the summary and the payload (see done) '''
+        if self.logger.isEnabledFor(logging.INFO):
+            summary = dict(self.fields)
+            summary["nodes"] = countNodes(response_data)
+            # a streamed response is not sent yet
+            summary["bytes"] = "stream" if response.streaming else len(response.content)
+            summary["queries"] = self.queries
+            summary["ms"] = round(duration * 1000, 1)
+            if isinstance(response_data, dict) and ("exception" in response_data):
+                summary["exception"] = response_data["exception"]
+            self.logger.info("%s %s", self.name, " ".join("{}={}".format(key, value) for key, value in summary.items()),
+                             extra={"cab": summary}, stacklevel=3)
+
+        if not response.streaming:
+            self.logger.debug("%s payload: %s", self.name, PayloadDump(response.content), stacklevel=3)
@@ -0,0 +1,156 @@
+''' Module to cache the results recently served to each session (actions of a train number, complex action trees)
+
+A result is cached as its response body (JSON) in the cache CAB_RESULT_CACHE_ALIAS, a cache of the same backend as the
+sessions (see CACHES). The results of a session are listed in an index entry, least recently served first: once they
+take more than CAB_RESULT_CACHE_BYTES, the oldest are evicted. A result is keyed by the content hash of the uploaded
+database (see upload.getDigest) and the parameters of the request: a cached result is never stale, the results of a
+database uploaded before are only dropped to free the cache (see clearResults).
+
+The index is read, changed and written under a lock of the process: with a cache shared by several processes, an
+update of another process may be lost, its result is then not counted nor dropped by clearResults (until the TIMEOUT
+of the cache), never served for another database.
+'''
+
+
+import hashlib
+import logging
+import threading
+
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+
+from cab import upload
+
+
+logger = logging.getLogger(__name__)
+
+
+KEY_PREFIX = "cab-result"
+
+# lock of the index updates (get, change, set) of the process
+INDEX_LOCK = threading.Lock()
+
+
+def getCache():
+    ''' The cache of the results '''
+    return caches[settings.CAB_RESULT_CACHE_ALIAS]
+
+
+def getIndexKey(session_key):
+    ''' The key of the index of the results of a session: list of (result key, bytes), least recently served first '''
+    return "{}-index:{}".format(KEY_PREFIX, session_key)
+
+
+def isException(response_data):
+    ''' True for the response data of an error (not cached) '''
+    return isinstance(response_data, dict) and ("exception" in response_data)
+
+
+def makeResponse(content):
+    '''
+    Make the response of a cached result
+    content: cached response body (JSON, bytes)
+    return response
+    '''
+    return HttpResponse(content=content, content_type="application/json")
+
+
+class SessionResult():
+    ''' Class to get and store the result of one request of a session '''
+
+    def __init__(self, session_key, dbfile, name, *args):
+        '''
+        Constructor
+        session_key: key of the session, None: the result is not cached
+        dbfile: database file of the session, not cached unless stored by content (see upload.storeDbFile)
+        name: name of the request (e.g. view name)
+        args: parameters of the request
+        '''
+        self.session_key = session_key
+        self.max_bytes = settings.CAB_RESULT_CACHE_BYTES
+        self.key = None
+        db_digest = None if dbfile is None else upload.getDigest(dbfile)
+        if (session_key is not None) and (db_digest is not None) and (self.max_bytes > 0):
+            digest = hashlib.sha256(repr((name, args)).encode("utf-8")).hexdigest()[:32]
+            self.key = "{}:{}:{}:{}".format(KEY_PREFIX, session_key, db_digest, digest)
+
+    def get(self):
+        ''' Get the cached result (bytes), None if not cached '''
+        if self.key is None:
+            return None
+        cache = getCache()
+        content = cache.get(self.key)
+        if content is not None:
+            self.updateIndex(cache, len(content))
+        return content
+
+    def put(self, response_data, content):
+        '''
+        Cache a result (not an error, not bigger than CAB_RESULT_CACHE_BYTES)
+        response_data: the data of the response
+        content: its response body (JSON, bytes)
+        '''
+        if (self.key is None) or isException(response_data) or (len(content) > self.max_bytes):
+            return
+        cache = getCache()
+        cache.set(self.key, content)
+        self.updateIndex(cache, len(content))
+
+    def cacheChunks(self, chunks):
+        '''
+        Cache a streamed result while it is sent: its chunks are kept until they exceed CAB_RESULT_CACHE_BYTES
+        chunks: iterator of the chunks of the response body (bytes)
+        yield chunks
+        '''
+        if self.key is None:
+            yield from chunks
+            return
+        content = bytearray()
+        for chunk in chunks:
+            if content is not None:
+                if len(content) + len(chunk) <= self.max_bytes:
+                    content += chunk
+                else:
+                    content = None
+            yield chunk
+        if content is not None:
+            self.put(None, bytes(content))
+
+    def updateIndex(self, cache, nbytes):
+        '''
+        Move the result to the end of the index of the session (most recently served) and evict the oldest results
+        cache: cache of the results
+        nbytes: size of the result (bytes)
+        '''
+        index_key = getIndexKey(self.session_key)
+        with INDEX_LOCK:
+            index = [entry for entry in cache.get(index_key, []) if entry[0] != self.key]
+            index.append((self.key, nbytes))
+
+            total = sum(entry[1] for entry in index)
+            evicted = []
+            while total > self.max_bytes:
+                key, key_bytes = index.pop(0)
+                evicted.append(key)
+                total -= key_bytes
+            if evicted:
+                cache.delete_many(evicted)
+            cache.set(index_key, index)
+        if evicted:
+            logger.debug("session results evicted: {} ({} bytes kept)".format(len(evicted), total))
+
+
+def clearResults(session_key):
+    '''
+    Drop the cached results of a session (e.g. when it uploads another database)
+    session_key: key of the session, None: nothing to drop
+    '''
+    if (session_key is None) or (settings.CAB_RESULT_CACHE_BYTES <= 0):
+        return
+    cache = getCache()
+    index_key = getIndexKey(session_key)
+    with INDEX_LOCK:
+        cache.delete_many([entry[0] for entry in cache.get(index_key, [])] + [index_key])
@@ -0,0 +1,33 @@
+''' Module of the session engine of the cab (SESSION_ENGINE): the cache sessions, which release their upload when they end
+
+A flushed session (e.g. logout) releases its uploaded database at once (see uploadjobs.endSession). A session which
+expires in the cache is not noticed: its database is removed by the periodic sweep (see upload.removeExpiredDbFiles).
+'''
+
+
+from asgiref.sync import sync_to_async
+from django.contrib.sessions.backends import cache
+
+
+from cab import resultcache
+from cab import uploadjobs
+
+
+class SessionStore(cache.SessionStore):
+    ''' Cache session which releases its uploaded database and its cached results when it is flushed '''
+
+    def flush(self):
+        session_key = self.session_key
+        dbfile = self.get("dbfile")
+        job_id = self.get("uploadJob")
+        super().flush()
+        uploadjobs.endSession(session_key, dbfile, job_id)
+        resultcache.clearResults(session_key)
+
+    async def aflush(self):
+        session_key = self.session_key
+        dbfile = await self.aget("dbfile")
+        job_id = await self.aget("uploadJob")
+        await super().aflush()
+        await sync_to_async(uploadjobs.endSession)(session_key, dbfile, job_id)
+        await sync_to_async(resultcache.clearResults)(session_key)
@@ -28,8 +28,6 @@ function selectCplxAction(actionId, actionListId, actionDetailId, actionType, me
             throw new Error(`cannot uploadDbFile: ${data['exception']}`);
         }
 
-        data = JSON.parse(data);
-
         // load the complex action html page in a new tab
         page = data['new_tab']
         page += "?actId=" + actionId;
@@ -37,6 +35,10 @@ function selectCplxAction(actionId, actionListId, actionDetailId, actionType, me
         page += "&actDetId=" + actionDetailId;
         page += "&actTyp=" + actionType;
         page += "&medTyp=" + mediaType;
+        if (dbHash) {
+            // the tree is requested by a cacheable url
+            page += "&dbHash=" + dbHash;
+        }
         //console.log(page);
 
         var strWindowFeatures = "location=yes,height=768,width=1366,scrollbars=yes,status=yes";
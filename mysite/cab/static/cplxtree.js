@@ -358,6 +358,7 @@ function cplxtree() {
   const actionDetailId = urlParams.get('actDetId');
   const actionType = urlParams.get('actTyp');
   const mediaType = urlParams.get('medTyp');
+  const dbHash = urlParams.get('dbHash');
   //console.log(actionId, actionListId, actionDetailId, actionType, mediaType);
 
   // url of the django endpoint
@@ -373,14 +374,25 @@ function cplxtree() {
       'mediaType' : mediaType
   };
 
-  // Send a post request to the django server
-  fetch(url, {
-      method: 'POST',
-      headers: {
-          'Content-Type': 'application/json'
-      },
-      body: JSON.stringify(data) // Convert the data to a JSON string
-  })
+  // Send a get request (cacheable: the url carries the content hash of the database) or a post request to the django server
+  let request;
+  if (dbHash) {
+      request = fetch(`/cab/db/${dbHash}/cplxaction/${encodeURIComponent(actionId)}?` + new URLSearchParams({
+          'actionListId': actionListId,
+          'actionDetailId': actionDetailId,
+          'actionType': actionType,
+          'mediaType': mediaType
+      }));
+  } else {
+      request = fetch(url, {
+          method: 'POST',
+          headers: {
+              'Content-Type': 'application/json'
+          },
+          body: JSON.stringify(data) // Convert the data to a JSON string
+      });
+  }
+  request
   .then(response => {
       if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
@@ -389,8 +401,6 @@ function cplxtree() {
   })
   .then(data => {
       //console.log(data)
-      data = JSON.parse(data);
-
       if (data.hasOwnProperty("exception")) {
         throw new Error(`cannot uploadDbFile: ${data['exception']}`);
       }
@@ -10,6 +10,7 @@ function uploadDbFile(dbfile) {
     d3.select("#divTnActions").attr("style", "visibility: hidden");
     d3.select("#divTrainNumbers").attr("style", "visibility: hidden");
     d3.select("#dlTrainNumbers").html("");
+    dbHash = null;
 
     //document.getElementById('lstrainnumbers').value = "";
 
@@ -20,6 +21,7 @@ function uploadDbFile(dbfile) {
     // form the data (file) to send
     let data = new FormData()
     data.append('dbfile', dbfile)
+    data.append('format', 'page')   // the number of train numbers and the first page (then: searchTrainNumbers)
     //console.log(data)
 
     // set cursor shape to 'progress' while loading
@@ -37,20 +39,93 @@ function uploadDbFile(dbfile) {
         return response.json(); // Parse the response as JSON
     })
     .then(data => {
-        data = JSON.parse(data);
+        if (data.hasOwnProperty("exception")) {
+            throw new Error(`cannot uploadDbFile: ${data['exception']}`);
+        }
+        // uploaded: the database is processed in the background, poll its status
+        showUploadStatus(data);
+        setTimeout(getUploadStatus, UPLOAD_POLL_MS, data['jobId']);
+    })
+    .catch(error => {
+        // Handle errors here
+        document.body.style.cursor = "auto";
+        d3.select("#spUploadStatus").text("");
+        console.error(error);
+        alert(error);
+    });
+}
+
+
+// interval of the upload status requests (milliseconds)
+const UPLOAD_POLL_MS = 250;
+
+// id of the current upload job: the status of older jobs (replaced by a newer upload) is ignored
+let uploadJobId = null;
+
+// content hash of the uploaded database: the actions are then requested by cacheable urls (see getActions)
+let dbHash = null;
 
+
+/**
+ * Show the status of the upload job (step and progress) next to the file input
+ * @param {object} status status of the upload job
+ */
+function showUploadStatus(status) {
+    uploadJobId = status['jobId'];
+    const step = status['step'] ? ` (${status['step']})` : "";
+    d3.select("#spUploadStatus").text(`${status['state']}${step}: ${Math.round(status['progress'] * 100)} %`);
+}
+
+
+/**
+ * Get the status of an upload job from the server, until the train numbers are there
+ * @param {string} jobId id of the upload job
+ */
+function getUploadStatus(jobId) {
+
+    // a newer upload replaced this job
+    if (jobId != uploadJobId) {
+        return;
+    }
+
+    // url of the django endpoint
+    const url = '/cab/uploadstatus?' + new URLSearchParams({'jobId': jobId});
+
+    fetch(url)
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json(); // Parse the response as JSON
+    })
+    .then(data => {
+        if (jobId != uploadJobId) {
+            return;
+        }
         if (data.hasOwnProperty("exception")) {
             throw new Error(`cannot uploadDbFile: ${data['exception']}`);
         }
+        showUploadStatus(data);
+        if (data['state'] != 'done') {
+            if (data['state'] == 'cancelled') {
+                throw new Error('upload cancelled');
+            }
+            setTimeout(getUploadStatus, UPLOAD_POLL_MS, jobId);
+            return;
+        }
+
         // loaded: set cursor shape to 'auto' back
         document.body.style.cursor = "auto";
+        d3.select("#spUploadStatus").text("");
 
         // handle received train numbers
-        gotTrainNumbers(data);
+        dbHash = data['dbHash'];
+        gotTrainNumbers(data['trainNumbers']);
     })
     .catch(error => {
         // Handle errors here
         document.body.style.cursor = "auto";
+        d3.select("#spUploadStatus").text("");
         console.error(error);
         alert(error);
     });
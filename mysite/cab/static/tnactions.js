@@ -16,6 +16,9 @@ var svg;
 var gLink;
 var gNode;
 
+// the train number actions (lazy: the events and actions of a line section are fetched when it is clicked)
+var tnData;
+
 
 /**
  * Draws train number actions, including sections and events
@@ -23,6 +26,10 @@ var gNode;
  */
 function drawTnActions(data) {
 
+  // remove any currently drawn actions
+  tnData = data;
+  d3.select("#svgTnActions").selectAll("*").remove();
+
   // build the tree hierarchy (while indexing all nodes)
   const root = d3.hierarchy(data).eachBefore((i => d => d.index = i++)(0));
   //console.log(root);
@@ -219,6 +226,9 @@ function getContentLine2(d) {
   }
   else if (d.data.childType == "lineSection") {
     text = "LineSectionID: " + d.data.lineSectionId;
+    if (isCollapsed(d)) {
+      text += " (+" + d.data.eventCount + ")";
+    }
   }
   if (d.data.childType == "lineEvent") {
     text = "ActionListID: " + d.data.actionListId;
@@ -254,6 +264,9 @@ function getBoxColor(d) {
 
 
 function setCurstor(d) {
+  if ((d.data.childType == "lineSection") && (d.data.eventCount > 0)) {
+    return "pointer";
+  }
   if (d.data.childType == "action") {
     if (
       (d.data.actionType == "CAStatic") ||
@@ -272,6 +285,9 @@ function setCurstor(d) {
  */
 function selectAction(d) {
   //console.log(d); 
+  if ((d.data.childType == "lineSection") && (d.data.eventCount > 0)) {
+    toggleLineSection(d);
+  }
   if (d.data.childType == "action") {
     if (
       (d.data.actionType == "CAStatic") ||
@@ -288,6 +304,77 @@ function selectAction(d) {
   }
 }
 
+/**
+ * Tells if the events of a line section (lazy mode) are not shown
+ * @param {d3 data} d 
+ */
+function isCollapsed(d) {
+  return ((d.data.eventCount > 0) && (d.data.children.length == 0));
+}
+
+/**
+ * Shows (fetched on first use) or hides the events and actions of a line section
+ * @param {d3 data} d 
+ */
+function toggleLineSection(d) {
+  if (!isCollapsed(d)) {
+    d.data._children = d.data.children;
+    d.data.children = [];
+    drawTnActions(tnData);
+  }
+  else if (d.data._children) {
+    d.data.children = d.data._children;
+    d.data._children = null;
+    drawTnActions(tnData);
+  }
+  else {
+    getLineSection(tnData.lineId, d.data);
+  }
+}
+
+/**
+ * Get the events and actions of the given line section from the database
+ * @param {number} lineId 
+ * @param {json} lineSection - line section data (its children are filled in)
+ */
+function getLineSection(lineId, lineSection) {
+
+  // url of the django endpoint
+  const url = '/cab/getlinesection';
+
+  const data = {
+    'lineId': lineId,
+    'lineSectionId': lineSection.lineSectionId
+  };
+
+  // Send a post request to the django server
+  fetch(url, {
+      method: 'POST',
+      headers: {
+          'Content-Type': 'application/json'
+      },
+      body: JSON.stringify(data) // Convert the data to a JSON string
+  })
+  .then(response => {
+      if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      return response.json(); // Parse the response as JSON
+  })
+  .then(data => {
+      if (data.hasOwnProperty("exception")) {
+        throw new Error(`cannot getLineSection: ${data['exception']}`);
+      }
+
+      lineSection.children = data.children;
+      drawTnActions(tnData);
+  })
+  .catch(error => {
+      // Handle errors here
+      console.error(error);
+  });
+}
+
 /**
  * Handles receiving train number actions
  * @param {json} data 
@@ -10,17 +10,24 @@ function getActions(trainNumberId) {
 
     // form the data (file) to send
     const data = {
-        'trainNumberId': trainNumberId
+        'trainNumberId': trainNumberId,
+        'lazy': true    // line sections only: their events and actions are fetched on demand (getLineSection)
     };
 
-    // Send a post request to the django server
-    fetch(url, {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify(data) // Convert the data to a JSON string
-    })
+    // Send a get request (cacheable: the url carries the content hash of the database) or a post request to the django server
+    let request;
+    if (dbHash) {
+        request = fetch(`/cab/db/${dbHash}/actions/${trainNumberId}?lazy=1`);
+    } else {
+        request = fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(data) // Convert the data to a JSON string
+        });
+    }
+    request
     .then(response => {
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
@@ -29,8 +36,6 @@ function getActions(trainNumberId) {
     })
     .then(data => {
         //console.log(data)
-        data = JSON.parse(data);
-
         if (data.hasOwnProperty("exception")) {
             throw new Error(`cannot uploadDbFile: ${data['exception']}`);
         }
@@ -65,28 +70,80 @@ function selectTrainNumber(trainNumber) {
   }
 
 /**
- * Handles receiving train numbers
- * @param {json} data 
+ * Search train numbers by short name (prefix matches first, then substring matches) while the user types
+ * @param {text} query - text typed so far
  */
-function gotTrainNumbers(data) {
-    //console.log("gotTrainNumbers: ", data);
+function searchTrainNumbers(query) {
+
+    // url of the django endpoint
+    const url = '/cab/searchtrainnumbers?q=' + encodeURIComponent(query);
+
+    fetch(url)
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json(); // Parse the response as JSON
+    })
+    .then(data => {
+        if (data.hasOwnProperty("exception")) {
+            throw new Error(`cannot searchTrainNumbers: ${data['exception']}`);
+        }
 
-    // fill-in datalist with train numbers
+        // the answer to an older query is not shown
+        if (query == d3.select("#inTrainNumbers").property("value")) {
+            fillTrainNumbers(data.trainNumbers);
+        }
+    })
+    .catch(error => {
+        // Handle errors here
+        console.error(error);
+    });
+}
+
+/**
+ * Fill-in the datalist with the given train numbers (one page)
+ * @param {json} trainNumbers 
+ */
+function fillTrainNumbers(trainNumbers) {
     const trainnumbers = d3.select("#dlTrainNumbers")
-    data.forEach( function(item){
+    trainnumbers.html("");
+    trainNumbers.forEach( function(item){
         value = "'" + item.trainNumberShortName + "' (Id=" + item.trainNumberId + ")";
         trainnumbers.append("option")
         .attr("className", item.trainNumberId)
         .attr("value", value);
     });
+}
+
+/**
+ * Handles receiving train numbers: their number and the first page
+ * @param {json} data 
+ */
+function gotTrainNumbers(data) {
+    //console.log("gotTrainNumbers: ", data);
+
+    // fill-in datalist with the first page of train numbers
+    fillTrainNumbers(data.trainNumbers);
 
     const tn_field = d3.select("#divTrainNumbers")
         .attr("style", "visibility: visible");
 
-    const input_trainnumbers = d3.select("#inTrainNumbers");
+    const input_trainnumbers = d3.select("#inTrainNumbers")
+        .attr("placeholder", "search " + data.count + " train numbers");
     //console.log(list_trainnumbers);
     input_trainnumbers.on("change", (event) => {
         //console.log(event);
         selectTrainNumber(event.target.value);
         });
+
+    // search as the user types (not for a selected entry)
+    let searchTimer = null;
+    input_trainnumbers.on("input", (event) => {
+        const query = event.target.value;
+        clearTimeout(searchTimer);
+        if (query.indexOf("(Id=") < 0) {
+            searchTimer = setTimeout(() => searchTrainNumbers(query), 150);
+        }
+        });
 }
\ No newline at end of file
@@ -1,3 +1,1398 @@
-from django.test import TestCase
+''' Tests of the cab: dbaccess entry points and views on small synthetic databases (see cab.bench.gendb)
 
-# Create your tests here.
+Run (from the mysite directory): python manage.py test cab, or pytest (with pytest-django)
+'''
+
+
+import os
+import json
+import asyncio
+import time
+import shutil
+import sqlite3
+import hashlib
+import functools
+import http.client
+import tempfile
+import threading
+from unittest import mock
+
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.test import AsyncClient, Client, SimpleTestCase, override_settings
+from django.urls import include, path, resolve
+
+
+from cab import urls
+from cab import middleware
+from cab import views
+from cab import asyncviews
+from cab import upload
+from cab import uploadjobs
+from cab import jsonresponse
+from cab import resultcache
+from cab import sessions
+from cab.bench import gendb
+from cab.bench import suite
+from cab.bench.actions import LegacyDbAction
+from cab.dbaccess import database
+from cab.dbaccess import db_queries
+from cab.dbaccess import diff
+from cab.dbaccess import search
+from cab.dbaccess import snapshot
+from cab.dbaccess import workingcopy
+from cab.dbaccess import action as act
+from cab.dbaccess import cplxaction as cplx
+
+
+# knobs of the test databases: a few train numbers with small complex action trees
+TEST_KNOBS = dict(trainnumbers=6, sections=3, events=2, actions=3, depth=3, fanout=2, cplx_pool=6, cplx_ratio=0.5, attr_lists=10)
+
+# seconds to wait for an upload job
+JOB_TIMEOUT = 30
+
+
+def addChain(dbfile, length, cycle=False, actionListId=None):
+    '''
+    Add a chain of complex actions (each the only child of its parent) to a database
+    dbfile: database file
+    length: number of complex actions
+    cycle: the last complex action has the first one as child
+    actionListId: action list of the first action (e.g. of a line event), None: not referenced by a line
+    return the first action (act_id, act_list_id, act_det_id, act_typ, med_typ)
+    '''
+    db_conn = sqlite3.connect(dbfile)
+    try:
+        action_id = db_conn.execute("SELECT max(ActionID) FROM action").fetchone()[0]
+        cplx_id = db_conn.execute("SELECT max(ComplexActionID) FROM complexaction").fetchone()[0]
+        rule_id = db_conn.execute("SELECT min(ExecutionRuleID) FROM executionrule").fetchone()[0]
+        for index in range(length):
+            db_conn.execute("INSERT INTO action VALUES (?, ?, ?, 3, 1, NULL)",
+                            (action_id + 1 + index, actionListId if index == 0 else None, cplx_id + 1 + index))
+            db_conn.execute("INSERT INTO complexaction VALUES (?, ?, NULL)", (cplx_id + 1 + index, rule_id))
+            if (index + 1 < length) or cycle:
+                child_id = action_id + 2 + index if index + 1 < length else action_id + 1
+                db_conn.execute("INSERT INTO complexactionchildlist VALUES (NULL, ?, ?, 0)", (cplx_id + 1 + index, child_id))
+        db_conn.commit()
+    finally:
+        db_conn.close()
+    return (action_id + 1, actionListId, cplx_id + 1, "CAStatic", "Audio")
+
+
+def getCplxActions(dbfile, count=100):
+    ''' Complex actions of a database (act_id, act_list_id, act_det_id, act_typ, med_typ) '''
+    db_conn = sqlite3.connect(dbfile)
+    try:
+        return db_conn.execute(suite.QUERY_CA_ACTIONS, (count,)).fetchall()
+    finally:
+        db_conn.close()
+
+
+def getTreeDepth(tree):
+    ''' The number of levels of an action tree (first children) '''
+    depth = 0
+    while tree:
+        depth += 1
+        tree = (tree.get("children") or [None])[0]
+    return depth
+
+
+class CabTestCase(SimpleTestCase):
+    ''' Base class of the tests: an empty upload directory, empty caches, databases generated into a temporary directory '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        settings_override = override_settings(CAB_UPLOAD_DIR=os.path.join(self.directory, "uploads"), CAB_UPLOAD_SWEEP_INTERVAL=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # an empty store: the references of other tests are not seen
+        store_patch = mock.patch.object(upload, "STORE", upload.DbFileStore())
+        store_patch.start()
+        self.addCleanup(store_patch.stop)
+        self.addCleanup(self.removeUploads)
+        for cache in caches.all():
+            cache.clear()
+
+    def removeUploads(self):
+        ''' Remove the uploaded databases (and their snapshots, memos, connections) '''
+        upload_dir = upload.getUploadDir()
+        for name in os.listdir(upload_dir):
+            upload.removeDbFile(os.path.join(upload_dir, name))
+
+    def makeDatabase(self, name="cab.db", **knobs):
+        '''
+        Generate a test database (see TEST_KNOBS), its caches are dropped after the test
+        name: file name (in the temporary directory)
+        knobs: knobs replacing those of TEST_KNOBS
+        return database file
+        '''
+        dbfile = os.path.join(self.directory, name)
+        gendb.generateDatabase(dbfile, **dict(TEST_KNOBS, **knobs))
+        self.addCleanup(upload.removeDbFile, dbfile)
+        return dbfile
+
+    def setSessionDbFile(self, dbfile):
+        ''' Let the session of the test client use the given database (as after an upload) '''
+        session = self.client.session
+        session["dbfile"] = dbfile
+        session.save()
+
+    def postJson(self, name, data, client=None):
+        ''' Post JSON data to a cab endpoint, return the response '''
+        return (client or self.client).post("/cab/" + name, json.dumps(data), content_type="application/json")
+
+    def getJson(self, response):
+        ''' The JSON data of a response (also streamed) '''
+        return json.loads(b"".join(response.streaming_content) if response.streaming else response.content)
+
+    def postUpload(self, dbfile, client=None, upload_format=None):
+        '''
+        Upload a database, its upload job is started
+        dbfile: database file
+        client: test client (its session), None: the client of the test
+        upload_format: format of the train numbers (see upload.getUploadResponse), or None
+        return status of the job
+        '''
+        with open(dbfile, "rb") as file:
+            data = {"dbfile": file} if upload_format is None else {"dbfile": file, "format": upload_format}
+            status = json.loads((client or self.client).post("/cab/uploaddb", data).content)
+        self.assertNotIn("exception", status)
+        return status
+
+    def uploadDatabase(self, dbfile, client=None, upload_format=None):
+        '''
+        Upload a database and wait for its upload job (see postUpload)
+        return status of the job
+        '''
+        return self.waitForJob(self.postUpload(dbfile, client, upload_format))
+
+    def waitForJob(self, status):
+        '''
+        Wait for an upload job to finish
+        status: status of the job
+        return status of the finished job
+        '''
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while status["state"] not in (uploadjobs.DONE, uploadjobs.FAILED, uploadjobs.CANCELLED):
+            self.assertLess(time.monotonic(), deadline, "upload job not finished")
+            time.sleep(0.02)
+            status = uploadjobs.getJobStatus(status["jobId"])
+        return status
+
+
+class TreeDepthTests(CabTestCase):
+    ''' Complex action trees at the maximum depth are served (encoded beyond the nesting orjson supports), deeper ones are rejected '''
+
+    def test_deepest_tree_served(self):
+        dbfile = self.makeDatabase()
+        # the root is at depth 0: MAX_TREE_DEPTH + 1 levels are accepted
+        root = addChain(dbfile, cplx.MAX_TREE_DEPTH + 1, actionListId=1)
+        self.setSessionDbFile(dbfile)
+
+        response = self.postJson("getcplxaction", dict(zip(("actionId", "actionListId", "actionDetailId", "actionType", "mediaType"), root)))
+        self.assertEqual(response.status_code, 200)
+        tree = json.loads(response.content)
+        self.assertNotIn("exception", tree)
+        self.assertEqual(getTreeDepth(tree), cplx.MAX_TREE_DEPTH + 1)
+
+        response = self.postJson("getcplxactions", {"trainNumberId": 1})
+        self.assertEqual(response.status_code, 200)
+        trees = {tree["actionId"]: tree for tree in json.loads(response.content)["complexActions"]}
+        self.assertEqual(getTreeDepth(trees[root[0]]), cplx.MAX_TREE_DEPTH + 1)
+
+    def test_deeper_tree_rejected(self):
+        dbfile = self.makeDatabase()
+        root = addChain(dbfile, cplx.MAX_TREE_DEPTH + 2)
+        self.setSessionDbFile(dbfile)
+
+        response = self.postJson("getcplxaction", dict(zip(("actionId", "actionListId", "actionDetailId", "actionType", "mediaType"), root)))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("maximum tree depth", json.loads(response.content)["exception"])
+
+
+class EquivalenceTests(CabTestCase):
+    ''' The set-based loader, the slot node classes and the attribute lists give the JSON of the former loader and of the walker '''
+
+    def test_actions_match_legacy_loader(self):
+        dbfile = self.makeDatabase()
+        db_conn = sqlite3.connect(dbfile)
+        self.addCleanup(db_conn.close)
+        for trainNumberId in range(1, TEST_KNOBS["trainnumbers"] + 1):
+            legacy = LegacyDbAction(db_conn, trainNumberId)
+            legacy.getActions()
+            expected = jsonresponse.dumps(legacy.makeActionsDict())
+
+            db_action = act.DbAction(db_conn, trainNumberId)
+            db_action.getActions()
+            self.assertEqual(jsonresponse.dumps(db_action.makeActionsDict()), expected)
+            # streamed node by node
+            self.assertEqual(b"".join(act.iterJson(db_action.my_line, jsonresponse.dumps)), expected)
+
+        # from the snapshot
+        snapshot.buildSnapshot(dbfile)
+        for trainNumberId in range(1, TEST_KNOBS["trainnumbers"] + 1):
+            legacy = LegacyDbAction(db_conn, trainNumberId)
+            legacy.getActions()
+            self.assertEqual(jsonresponse.dumps(act.getActions(dbfile, trainNumberId)), jsonresponse.dumps(legacy.makeActionsDict()))
+
+    def test_nodes_keep_no_output(self):
+        line = act.Line(1, "TN1", 1, 1, gendb.packDate(2024, 1, 1), gendb.packDate(2024, 12, 31))
+        self.assertFalse(hasattr(line, "__dict__"))
+        self.assertFalse(hasattr(act.Action(1, 1, "Speak", "Audio"), "__dict__"))
+        self.assertFalse(hasattr(cplx.CplxAction(1, 1, 1, "CAStatic", "Audio"), "__dict__"))
+        self.assertIsNot(line.makeDict(), line.makeDict())
+
+    def test_trees_match_walker(self):
+        dbfile = self.makeDatabase()
+        cplxActions = getCplxActions(dbfile)
+        self.assertTrue(cplxActions)
+        memo = cplx.SubtreeMemo()
+        db_conn = sqlite3.connect(dbfile)
+        self.addCleanup(db_conn.close)
+        for cplxAction in cplxActions:
+            walker = cplx.CplxAction(*cplxAction)
+            cplx.DbCplxAction(db_conn, recursive_query=False).getAction(walker)
+            expected = jsonresponse.dumps(walker.buildTree())
+
+            root = cplx.CplxAction(*cplxAction)
+            cplx.DbCplxAction(db_conn).getAction(root)
+            self.assertEqual(jsonresponse.dumps(root.buildTree()), expected)
+
+            # memoized subtrees (second pass), and a tree changed by its caller does not change the memo
+            for _ in range(2):
+                tree = cplx.resolveCplxActionTree(dbfile, memo, None, *cplxAction)
+                self.assertEqual(jsonresponse.dumps(tree), expected)
+                for child in tree["children"]:
+                    child.clear()
+
+        snapshot.buildSnapshot(dbfile)
+        my_snapshot = snapshot.getSnapshot(dbfile)
+        for cplxAction in cplxActions:
+            walker = cplx.CplxAction(*cplxAction)
+            cplx.DbCplxAction(db_conn, recursive_query=False).getAction(walker)
+            tree = cplx.resolveCplxActionTree(dbfile, cplx.SubtreeMemo(), my_snapshot, *cplxAction)
+            self.assertEqual(jsonresponse.dumps(tree), jsonresponse.dumps(walker.buildTree()))
+
+    def test_memo_hit_keeps_node_key_attributes(self):
+        dbfile = self.makeDatabase()
+        # an attribute named as a node key: merged into the node key, also when the subtree is taken from the memo
+        db_conn = sqlite3.connect(dbfile)
+        self.addCleanup(db_conn.close)
+        with db_conn:
+            db_conn.execute("UPDATE attributetype SET TypeName = 'type' WHERE TypeName = ?", (gendb.TEXT_ATTRIBUTES[0],))
+        memo = cplx.SubtreeMemo()
+        merged = 0
+        for cplxAction in getCplxActions(dbfile):
+            walker = cplx.CplxAction(*cplxAction)
+            cplx.DbCplxAction(db_conn, recursive_query=False).getAction(walker)
+            expected = walker.buildTree()
+            merged += ", " in str(expected["type"])
+            hits = memo.stats()["hits"]
+            # built, then a memo hit of the root
+            for _ in range(2):
+                self.assertEqual(cplx.resolveCplxActionTree(dbfile, memo, None, *cplxAction), expected)
+            self.assertGreater(memo.stats()["hits"], hits)
+        self.assertTrue(merged)
+
+    def test_repeated_attributes_joined(self):
+        tree = {"type": "Serial"}
+        cplx.mergeAttributes(tree, [(("Delay", 5), ("Text", "a")), (("Delay", 7),), (("Text", "b"), ("type", "x"))])
+        self.assertEqual(tree, {"type": "Serial, x", "Delay": "5, 7", "Text": "a, b"})
+
+
+class CycleTests(CabTestCase):
+    ''' Complex action graphs with a cycle, or deeper than the maximum depth, are rejected by the recursive query and the walker '''
+
+    def test_cycle_rejected(self):
+        dbfile = self.makeDatabase()
+        root = addChain(dbfile, 3, cycle=True)
+        self.setSessionDbFile(dbfile)
+
+        response = self.postJson("getcplxaction", dict(zip(("actionId", "actionListId", "actionDetailId", "actionType", "mediaType"), root)))
+        self.assertIn("contains a cycle", json.loads(response.content)["exception"])
+
+        db_conn = sqlite3.connect(dbfile)
+        self.addCleanup(db_conn.close)
+        with self.assertRaisesRegex(database.DatabaseException, "contains a cycle"):
+            cplx.DbCplxAction(db_conn, recursive_query=False).getAction(cplx.CplxAction(*root))
+
+    def test_walker_depth_cap(self):
+        dbfile = self.makeDatabase()
+        deepest = addChain(dbfile, cplx.MAX_TREE_DEPTH + 1)
+        deeper = addChain(dbfile, cplx.MAX_TREE_DEPTH + 2)
+        db_conn = sqlite3.connect(dbfile)
+        self.addCleanup(db_conn.close)
+
+        root = cplx.CplxAction(*deepest)
+        cplx.DbCplxAction(db_conn, recursive_query=False).getAction(root)
+        self.assertEqual(getTreeDepth(root.buildTree()), cplx.MAX_TREE_DEPTH + 1)
+        with self.assertRaisesRegex(database.DatabaseException, "maximum tree depth"):
+            cplx.DbCplxAction(db_conn, recursive_query=False).getAction(cplx.CplxAction(*deeper))
+
+
+class FailingConnection():
+    ''' Connection which fails the recursive query of the complex action trees with the given error '''
+
+    def __init__(self, db_conn, message):
+        self.db_conn = db_conn
+        self.message = message
+
+    def execute(self, sql, *args):
+        if sql == db_queries.QUERY_COMPLEX_ACTION_TREE:
+            raise sqlite3.OperationalError(self.message)
+        return self.db_conn.execute(sql, *args)
+
+
+class RecursiveQueryTests(CabTestCase):
+    ''' The walker replaces the recursive query only when SQLite cannot prepare it '''
+
+    def setUp(self):
+        super().setUp()
+        self.dbfile = self.makeDatabase()
+        self.db_conn = sqlite3.connect(self.dbfile)
+        self.addCleanup(self.db_conn.close)
+        self.cplxAction = getCplxActions(self.dbfile, 1)[0]
+
+    def test_unsupported_query_falls_back(self):
+        walker = cplx.CplxAction(*self.cplxAction)
+        cplx.DbCplxAction(self.db_conn, recursive_query=False).getAction(walker)
+
+        db_cplx = cplx.DbCplxAction(FailingConnection(self.db_conn, 'near "RECURSIVE": syntax error'))
+        root = cplx.CplxAction(*self.cplxAction)
+        db_cplx.getAction(root)
+        self.assertFalse(db_cplx.recursive_query)
+        self.assertEqual(jsonresponse.dumps(root.buildTree()), jsonresponse.dumps(walker.buildTree()))
+
+    def test_other_errors_raised(self):
+        for message in ("interrupted", "database is locked", "disk I/O error"):
+            db_cplx = cplx.DbCplxAction(FailingConnection(self.db_conn, message))
+            with self.assertRaisesRegex(sqlite3.OperationalError, message):
+                db_cplx.getAction(cplx.CplxAction(*self.cplxAction))
+            self.assertTrue(db_cplx.recursive_query)
+
+
+class ParameterTests(CabTestCase):
+    ''' Request values are bound as statement parameters, never written into the SQL '''
+
+    def test_queries_have_no_formatted_values(self):
+        for name in dir(db_queries):
+            if name.startswith("QUERY_"):
+                query = getattr(db_queries, name).replace("{placeholders}", "")
+                self.assertNotIn("{", query, name)
+
+    def test_injected_ids_match_nothing(self):
+        dbfile = self.makeDatabase()
+        self.setSessionDbFile(dbfile)
+        actions = self.getJson(self.postJson("getactions", {"trainNumberId": 1}))
+        self.assertEqual(actions["trainNumberId"], 1)
+
+        for trainNumberId in ("1 OR 1=1", "1' OR '1'='1", "1; DROP TABLE action"):
+            response = self.postJson("getactions", {"trainNumberId": trainNumberId})
+            self.assertIn("exception", self.getJson(response))
+            response = self.postJson("getlinesection", {"lineId": trainNumberId, "lineSectionId": trainNumberId})
+            self.assertNotIn("events", json.loads(response.content))
+
+        db_conn = sqlite3.connect(dbfile)
+        self.addCleanup(db_conn.close)
+        self.assertGreater(db_conn.execute("SELECT count(*) FROM action").fetchone()[0], 0)
+
+
+class UploadTests(CabTestCase):
+    ''' Uploads which are no SQLite database are rejected and leave no file '''
+
+    def assertRejected(self, content):
+        response = self.client.post("/cab/uploaddb", {"dbfile": SimpleUploadedFile("bad.db", content)})
+        self.assertIn("is not a SQLite database", json.loads(response.content)["exception"])
+        self.assertEqual(os.listdir(upload.getUploadDir()), [])
+        self.assertNotIn("dbfile", self.client.session)
+
+    def test_not_sqlite_rejected(self):
+        self.assertRejected(b"PK\x03\x04" + b"\x00" * 100000)
+
+    def test_rejected_upload_drained(self):
+        upload_handler = upload.DbFileUploadHandler()
+        upload_handler.new_file("dbfile", "bad.db", "application/octet-stream", None)
+        with self.assertRaises(StopUpload) as stop:
+            upload_handler.receive_data_chunk(b"PK\x03\x04", 0)
+        # the connection is kept: the rest of the body is read and the error response is sent
+        self.assertFalse(stop.exception.connection_reset)
+        upload_handler.upload_interrupted()
+        self.assertEqual(os.listdir(upload.getUploadDir()), [])
+
+    def test_truncated_header_rejected(self):
+        self.assertRejected(upload.SQLITE_HEADER[:6])
+
+    def test_corrupt_database_fails(self):
+        dbfile = os.path.join(self.directory, "corrupt.db")
+        with open(dbfile, "wb") as file:
+            file.write(upload.SQLITE_HEADER + b"\xff" * 4096)
+        status = self.uploadDatabase(dbfile)
+        self.assertEqual(status["state"], uploadjobs.FAILED)
+
+
+class UploadJobTests(CabTestCase):
+    ''' The upload jobs report their state, step and progress, a job is cancelled by the next upload of its session '''
+
+    # a statement which only ends when interrupted (see database.checkInterrupt)
+    ENDLESS_QUERY = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c"
+
+    def setUp(self):
+        super().setUp()
+        # one worker: a job is queued while another one runs
+        settings_override = override_settings(CAB_UPLOAD_WORKERS=1)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        jobs = uploadjobs.UploadJobs()
+        jobs_patch = mock.patch.object(uploadjobs, "JOBS", jobs)
+        jobs_patch.start()
+        self.addCleanup(jobs_patch.stop)
+        self.addCleanup(lambda: jobs.executor and jobs.executor.shutdown())
+
+        # the first job running the train numbers step runs an endless statement (until cancelled)
+        self.running = threading.Event()
+        getTrainNumbers = uploadjobs.UploadJob.getTrainNumbers
+
+        def getTrainNumbersBlocked(job):
+            if not self.running.is_set():
+                self.running.set()
+                with database.Database(job.dbfile) as my_database:
+                    my_database.db_conn.execute(self.ENDLESS_QUERY).fetchall()
+            getTrainNumbers(job)
+
+        step_patch = mock.patch.object(uploadjobs.UploadJob, "getTrainNumbers", getTrainNumbersBlocked)
+        step_patch.start()
+        self.addCleanup(step_patch.stop)
+
+    def getStatus(self, status):
+        ''' The status of the upload job of the given status (uploadstatus) '''
+        return json.loads(self.client.get("/cab/uploadstatus", {"jobId": status["jobId"]}).content)
+
+    def test_states_and_progress(self):
+        dbfile = self.makeDatabase("a.db")
+        status = self.postUpload(dbfile)
+        self.assertIn(status["state"], (uploadjobs.QUEUED, uploadjobs.RUNNING))
+        self.assertTrue(self.running.wait(JOB_TIMEOUT))
+
+        steps = [step for step, _ in uploadjobs.JOBS.get(status["jobId"]).steps]
+        self.assertEqual(self.getStatus(status), {"jobId": status["jobId"], "state": uploadjobs.RUNNING, "step": "trainnumbers",
+                                                  "progress": round(steps.index("trainnumbers") / len(steps), 2)})
+
+        # another session: queued behind the running job
+        other_client = Client()
+        other_status = self.postUpload(self.makeDatabase("b.db", trainnumbers=4), other_client)
+        self.assertEqual(self.getStatus(other_status), {"jobId": other_status["jobId"], "state": uploadjobs.QUEUED, "step": None, "progress": 0.0})
+
+        # the second upload of the session cancels the running job (its statement is interrupted)
+        next_status = self.postUpload(self.makeDatabase("c.db", trainnumbers=5))
+        self.assertEqual(self.waitForJob(status), {"jobId": status["jobId"], "state": uploadjobs.CANCELLED, "step": "trainnumbers",
+                                                   "progress": round(steps.index("trainnumbers") / len(steps), 2)})
+
+        other_status = self.waitForJob(other_status)
+        self.assertEqual((other_status["state"], other_status["step"], other_status["progress"]), (uploadjobs.DONE, None, 1.0))
+        self.assertEqual(len(other_status["trainNumbers"]), 4)
+        next_status = self.waitForJob(next_status)
+        self.assertEqual(next_status["state"], uploadjobs.DONE)
+        self.assertEqual(len(next_status["trainNumbers"]), 5)
+        self.assertEqual(next_status["dbHash"], upload.getDigest(self.client.session["dbfile"]))
+
+    def test_queued_job_cancelled(self):
+        status = self.postUpload(self.makeDatabase("a.db"))
+        self.assertTrue(self.running.wait(JOB_TIMEOUT))
+        other_client = Client()
+        other_status = self.postUpload(self.makeDatabase("b.db", trainnumbers=4), other_client)
+
+        # cancelled before it runs: not run at all
+        self.postUpload(self.makeDatabase("c.db", trainnumbers=5), other_client)
+        self.assertEqual(uploadjobs.getJobStatus(other_status["jobId"])["state"], uploadjobs.CANCELLED)
+
+        uploadjobs.endSession(None, job_id=status["jobId"])
+        self.assertEqual(self.waitForJob(status)["state"], uploadjobs.CANCELLED)
+        self.assertEqual(self.waitForJob(other_status)["progress"], 0.0)
+
+    def test_unknown_job(self):
+        self.assertIn("unknown upload job", self.getStatus({"jobId": "0"})["exception"])
+
+
+class StoreTests(CabTestCase):
+    ''' Identical uploads share one stored file, removed when the last session releases it '''
+
+    def test_identical_uploads_shared(self):
+        dbfile = self.makeDatabase()
+        other_client = Client()
+        status = self.uploadDatabase(dbfile)
+        other_status = self.uploadDatabase(dbfile, other_client)
+        self.assertEqual(status["state"], uploadjobs.DONE)
+        with open(dbfile, "rb") as file:
+            self.assertEqual(status["dbHash"], hashlib.sha256(file.read()).hexdigest())
+        self.assertEqual(other_status["dbHash"], status["dbHash"])
+
+        stored = self.client.session["dbfile"]
+        self.assertEqual(other_client.session["dbfile"], stored)
+        self.assertEqual(os.listdir(upload.getUploadDir()), [os.path.basename(stored)])
+        self.assertEqual(upload.STORE.stats(), {"hits": 1, "misses": 1, "contents": 1, "sessions": 2})
+
+        # released by the end of the sessions (flush), removed with the last one
+        self.client.logout()
+        self.assertTrue(os.path.exists(stored))
+        other_client.logout()
+        self.assertFalse(os.path.exists(stored))
+        self.assertEqual(upload.STORE.stats()["contents"], 0)
+
+    def test_reupload_releases_previous(self):
+        dbfile = self.makeDatabase()
+        other_dbfile = self.makeDatabase("other.db", trainnumbers=4)
+        self.uploadDatabase(dbfile)
+        stored = self.client.session["dbfile"]
+        self.uploadDatabase(other_dbfile)
+        self.assertFalse(os.path.exists(stored))
+        self.assertEqual(os.listdir(upload.getUploadDir()), [os.path.basename(self.client.session["dbfile"])])
+
+
+@override_settings(CAB_RESULT_CACHE_BYTES=100)
+class ResultCacheTests(CabTestCase):
+    ''' The results served to a session are cached by database content, the least recently served evicted first, dropped when the session ends '''
+
+    # a database stored by content (see upload.getDigest)
+    DBFILE = os.path.join("uploads", "a" * 64 + ".db")
+
+    def getResult(self, name, session_key="s1", dbfile=DBFILE):
+        ''' The result of the request of the given name of a session '''
+        return resultcache.SessionResult(session_key, dbfile, name)
+
+    def putResult(self, name, nbytes, session_key="s1"):
+        ''' Cache a result of the given size for a session '''
+        self.getResult(name, session_key).put({"name": name}, name.encode("utf-8") * (nbytes // len(name)))
+
+    def getIndex(self, session_key="s1"):
+        ''' The names and sizes of the cached results of a session, least recently served first '''
+        keys = {self.getResult(name, session_key).key: name for name in ("r1", "r2", "r3", "r4")}
+        return [(keys[key], nbytes) for key, nbytes in resultcache.getCache().get(resultcache.getIndexKey(session_key), [])]
+
+    def test_lru_eviction(self):
+        self.putResult("r1", 40)
+        self.putResult("r2", 40)
+        # r1 served again: r2 is the least recently served
+        self.assertEqual(self.getResult("r1").get(), b"r1" * 20)
+        self.putResult("r3", 40)
+        self.assertEqual(self.getIndex(), [("r1", 40), ("r3", 40)])
+        self.assertIsNone(self.getResult("r2").get())
+
+        # bigger than the budget: not cached, nothing evicted
+        self.putResult("r4", 102)
+        self.assertIsNone(self.getResult("r4").get())
+        self.assertEqual(self.getIndex(), [("r1", 40), ("r3", 40)])
+
+        # other sessions have their own budget
+        self.putResult("r1", 80, "s2")
+        self.assertEqual(self.getIndex(), [("r1", 40), ("r3", 40)])
+        self.assertEqual(self.getIndex("s2"), [("r1", 80)])
+
+    def test_not_cached(self):
+        # an error, a database not stored by content, no session
+        self.getResult("r1").put({"exception": "x"}, b"{}")
+        self.assertIsNone(self.getResult("r1").get())
+        self.assertIsNone(self.getResult("r1", dbfile="cab.db").key)
+        self.assertIsNone(self.getResult("r1", session_key=None).key)
+        # another database: another result
+        self.putResult("r1", 40)
+        self.assertIsNone(self.getResult("r1", dbfile=os.path.join("uploads", "b" * 64 + ".db")).get())
+
+    def test_clear_results(self):
+        self.putResult("r1", 40)
+        self.putResult("r1", 40, "s2")
+        resultcache.clearResults("s1")
+        self.assertEqual(self.getIndex(), [])
+        self.assertIsNone(self.getResult("r1").get())
+        self.assertIsNotNone(self.getResult("r1", "s2").get())
+
+    @override_settings(CAB_RESULT_CACHE_BYTES=1024 * 1024)
+    def test_served_from_cache_until_flushed(self):
+        self.uploadDatabase(self.makeDatabase())
+        session_key = self.client.session.session_key
+        with mock.patch.object(views, "getActionsData", wraps=views.getActionsData) as getActionsData:
+            expected = self.getJson(self.postJson("getactions", {"trainNumberId": 1}))
+            response = self.postJson("getactions", {"trainNumberId": 1})
+        self.assertEqual(getActionsData.call_count, 1)
+        self.assertFalse(response.streaming)
+        self.assertEqual(json.loads(response.content), expected)
+        self.assertEqual(len(resultcache.getCache().get(resultcache.getIndexKey(session_key))), 1)
+
+        # the session engine drops the results of a flushed session (e.g. logout)
+        self.client.logout()
+        self.assertIsNone(resultcache.getCache().get(resultcache.getIndexKey(session_key)))
+
+    def test_async_flush(self):
+        store = sessions.SessionStore()
+        store.update({"dbfile": self.DBFILE, "uploadJob": "job"})
+        store.save()
+        session_key = store.session_key
+        self.putResult("r1", 40, session_key)
+        with mock.patch.object(uploadjobs, "endSession") as endSession:
+            asyncio.run(store.aflush())
+        endSession.assert_called_once_with(session_key, self.DBFILE, "job")
+        self.assertIsNone(self.getResult("r1", session_key).get())
+
+
+class CacheableTests(CabTestCase):
+    ''' The GET endpoints of a stored database send ETags and answer a matching If-None-Match with 304, without reading the database '''
+
+    def test_etag_and_not_modified(self):
+        digest = self.uploadDatabase(self.makeDatabase())["dbHash"]
+        url = "/cab/db/{}/actions/1".format(digest)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.getJson(response)["trainNumberId"], 1)
+        etag = response["ETag"]
+        self.assertIn("immutable", response["Cache-Control"])
+
+        with mock.patch.object(views, "getActionsData", side_effect=AssertionError("database read")):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+        response = self.client.get("/cab/db/{}/actions/2".format(digest), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_unknown_database_not_cached(self):
+        response = self.client.get("/cab/db/{}/actions/1".format("0" * 64))
+        self.assertIn("exception", json.loads(response.content))
+        self.assertIn("no-cache", response["Cache-Control"])
+
+
+class DiffTests(CabTestCase):
+    ''' A database compared with itself (or an identical copy) has no differences, a removed train number and a changed
+    complex action are found (the changed subtrees down to the changed node), a cycle is hashed alike from any of its actions '''
+
+    def assertNoDifferences(self, differences, count):
+        self.assertEqual(differences["trainNumbers"], {"base": count, "other": count, "unchanged": count, "removed": 0, "added": 0, "changed": 0})
+        self.assertEqual((differences["removed"], differences["added"], differences["changed"]), ([], [], []))
+
+    def makeCopy(self, dbfile, *statements):
+        ''' Copy a database and change the copy with the given statements (with their parameters), return the copy '''
+        copy = os.path.join(self.directory, "copy.db")
+        shutil.copyfile(dbfile, copy)
+        self.addCleanup(upload.removeDbFile, copy)
+        db_conn = sqlite3.connect(copy)
+        with db_conn:
+            for statement in statements:
+                db_conn.execute(*statement)
+        db_conn.close()
+        return copy
+
+    def getChangePaths(self, differences, path=()):
+        ''' The paths of the differences (list of differences from the train number to the innermost difference) '''
+        paths = []
+        for difference in differences:
+            if difference.get("children"):
+                paths.extend(self.getChangePaths(difference["children"], path + (difference,)))
+            else:
+                paths.append(path + (difference,))
+        return paths
+
+    def test_self_diff(self):
+        dbfile = self.makeDatabase()
+        copy = self.makeCopy(dbfile)
+        self.assertNoDifferences(diff.getDiff(dbfile, dbfile), TEST_KNOBS["trainnumbers"])
+        self.assertNoDifferences(diff.getDiff(dbfile, copy), TEST_KNOBS["trainnumbers"])
+
+        digest = self.uploadDatabase(dbfile)["dbHash"]
+        response = self.client.get("/cab/diff/{}/{}".format(digest, digest))
+        self.assertNoDifferences(json.loads(response.content), TEST_KNOBS["trainnumbers"])
+
+    def test_removed_train_number(self):
+        dbfile = self.makeDatabase()
+        differences = diff.getDiff(dbfile, self.makeCopy(dbfile, ("DELETE FROM trainnumber WHERE TrainNumberID = 2",)))
+        self.assertEqual(differences["trainNumbers"]["removed"], 1)
+        self.assertEqual(differences["trainNumbers"]["unchanged"], TEST_KNOBS["trainnumbers"] - 1)
+        self.assertEqual([trainNumber["trainNumberId"] for trainNumber in differences["removed"]], [2])
+
+    def test_changed_complex_action(self):
+        dbfile = self.makeDatabase()
+        db_conn = sqlite3.connect(dbfile)
+        self.addCleanup(db_conn.close)
+        # a complex action child of a complex action, and the type of its rule
+        actionId, cplxId, ruleTypeId = db_conn.execute(
+            "SELECT a.ActionID, a.ActionDetailID, er.ExecutionRuleTypeID FROM complexactionchildlist cacl "
+            "JOIN action a ON a.ActionID = cacl.ActionID JOIN actiontype aty ON aty.ActionTypeID = a.ActionTypeID "
+            "JOIN complexaction ca ON ca.ComplexActionID = a.ActionDetailID JOIN executionrule er ON er.ExecutionRuleID = ca.ExecutionRuleID "
+            "WHERE aty.ShortName IN ('CAStatic', 'CANonstatic') ORDER BY a.ActionID LIMIT 1").fetchone()
+        # the copy: another rule type for this complex action (see gendb: rule type ids in the order of RULE_TYPES)
+        otherTypeId = ruleTypeId % len(gendb.RULE_TYPES) + 1
+        baseType, otherType = gendb.RULE_TYPES[ruleTypeId - 1], gendb.RULE_TYPES[otherTypeId - 1]
+        copy = self.makeCopy(dbfile, ("INSERT INTO executionrule VALUES (NULL, ?, NULL)", (otherTypeId,)),
+                             ("UPDATE complexaction SET ExecutionRuleID = last_insert_rowid() WHERE ComplexActionID = ?", (cplxId,)))
+        differences = diff.getDiff(dbfile, copy)
+        counts = differences["trainNumbers"]
+        self.assertGreater(counts["changed"], 0)
+        self.assertEqual((counts["removed"], counts["added"], counts["unchanged"] + counts["changed"]), (0, 0, TEST_KNOBS["trainnumbers"]))
+
+        paths = self.getChangePaths(differences["changed"])
+        self.assertTrue(paths)
+        for path in paths:
+            # train number, line section, line event, complex actions down to the changed one: all paired as changed
+            self.assertEqual({difference["change"] for difference in path}, {"changed"})
+            self.assertEqual([key in path[index]["base"] for index, key in enumerate(("trainNumberId", "lineSectionId", "eventId"))], [True] * 3)
+            changed = path[-1]
+            self.assertEqual((changed["base"]["actionId"], changed["other"]["actionId"]), (actionId, actionId))
+            self.assertEqual((changed["base"]["type"], changed["other"]["type"]), (baseType, otherType))
+            # the complex actions above it: same type and attributes, changed children
+            for difference in path[3:-1]:
+                self.assertEqual(difference["base"], difference["other"])
+                self.assertIn(difference["other"]["actionType"], cplx.CA_ACTION_TYPES)
+
+    def test_cycle_digest(self):
+        dbfile = self.makeDatabase()
+        # A -> B -> A, reached by a line event
+        first = addChain(dbfile, 2, cycle=True, actionListId=1)
+        cplxIds = (first[2], first[2] + 1)
+        # hashed from A, then from B
+        digests = []
+        for order in (cplxIds, cplxIds[::-1]):
+            db_digests = diff.DbDigests(dbfile)
+            db_digests.read()
+            db_digests.cplxDigests.clear()
+            db_digests.cyclic.clear()
+            digests.append({cplxId: db_digests.getCplxDigest(cplxId) for cplxId in order})
+            self.assertEqual(db_digests.cyclic, set(cplxIds))
+        self.assertEqual(digests[0], digests[1])
+        self.assertNotIn(None, digests[0].values())
+
+        # a complex action of the cycle changed: found, its children (the cycle) are not compared
+        copy = self.makeCopy(dbfile, ("UPDATE complexaction SET AttributeListID = 1 WHERE ComplexActionID = ?", (cplxIds[0],)))
+        differences = diff.getDiff(dbfile, copy)
+        self.assertGreater(differences["trainNumbers"]["changed"], 0)
+        changed = [path[-1] for path in self.getChangePaths(differences["changed"])]
+        self.assertIn(first[0], [difference["base"].get("actionId") for difference in changed])
+        self.assertTrue(all("children" not in difference for difference in changed))
+
+
+class SnapshotTests(CabTestCase):
+    ''' The snapshots are kept within their byte budget, the least recently used evicted first '''
+
+    def makeSnapshot(self, dbfile, nbytes):
+        ''' A snapshot stand-in of the given size '''
+        return mock.Mock(dbfile=dbfile, nbytes=nbytes)
+
+    def test_lru_eviction(self):
+        snapshots = snapshot.SnapshotCache(max_bytes=100)
+        for name in ("a", "b", "c"):
+            snapshots.put(self.makeSnapshot(name, 40))
+        # 'a' evicted: 120 bytes > 100
+        self.assertEqual(list(snapshots.snapshots), ["b", "c"])
+        self.assertEqual(snapshots.nbytes, 80)
+
+        # 'b' used last: 'c' is evicted next
+        self.assertIsNotNone(snapshots.get("b"))
+        snapshots.put(self.makeSnapshot("d", 40))
+        self.assertEqual(list(snapshots.snapshots), ["b", "d"])
+        self.assertEqual(snapshots.nbytes, 80)
+
+    def test_byte_accounting(self):
+        snapshots = snapshot.SnapshotCache(max_bytes=100)
+        snapshots.put(self.makeSnapshot("a", 30))
+        # replaced: counted once
+        snapshots.put(self.makeSnapshot("a", 50))
+        self.assertEqual(snapshots.nbytes, 50)
+        # too large: not kept, the others stay
+        snapshots.put(self.makeSnapshot("b", 101))
+        self.assertIsNone(snapshots.get("b"))
+        self.assertEqual(snapshots.nbytes, 50)
+        snapshots.remove("a")
+        snapshots.remove("a")
+        self.assertEqual((snapshots.nbytes, len(snapshots.snapshots)), (0, 0))
+
+    def test_snapshot_of_database(self):
+        dbfile = self.makeDatabase()
+        before = snapshot.SNAPSHOTS.nbytes
+        my_snapshot = snapshot.buildSnapshot(dbfile)
+        self.assertGreater(my_snapshot.nbytes, 0)
+        self.assertIs(snapshot.getSnapshot(dbfile), my_snapshot)
+        self.assertEqual(snapshot.SNAPSHOTS.nbytes, before + my_snapshot.nbytes)
+
+        # dropped with the database
+        upload.removeDbFile(dbfile)
+        self.assertIsNone(snapshot.getSnapshot(dbfile))
+        self.assertEqual(snapshot.SNAPSHOTS.nbytes, before)
+
+
+class PoolTests(CabTestCase):
+    ''' Idle connections are reused, closed after the idle timeout, and closed when their database is discarded '''
+
+    def setUp(self):
+        super().setUp()
+        self.dbfile = self.makeDatabase()
+        self.pool = database.ConnectionPool(idle_timeout=60, max_idle=2)
+        self.addCleanup(self.pool.discard, self.dbfile)
+        # the clock of the pool
+        self.now = 1000.0
+        clock_patch = mock.patch.object(database, "time", mock.Mock(monotonic=lambda: self.now, perf_counter=time.perf_counter))
+        clock_patch.start()
+        self.addCleanup(clock_patch.stop)
+
+    def assertClosed(self, db_conn):
+        with self.assertRaises(sqlite3.ProgrammingError):
+            db_conn.execute("SELECT 1")
+
+    def test_hits_and_misses(self):
+        db_conn = self.pool.acquire(self.dbfile)
+        self.assertEqual(self.pool.stats(), {"hits": 0, "misses": 1, "idle": 0, "inUse": 1})
+        self.pool.release(self.dbfile, db_conn)
+        self.assertIs(self.pool.acquire(self.dbfile), db_conn)
+        other_conn = self.pool.acquire(self.dbfile)
+        self.assertIsNot(other_conn, db_conn)
+        self.assertEqual(self.pool.stats(), {"hits": 1, "misses": 2, "idle": 0, "inUse": 2})
+
+        # at most max_idle idle connections
+        third_conn = self.pool.acquire(self.dbfile)
+        for conn in (db_conn, other_conn, third_conn):
+            self.pool.release(self.dbfile, conn)
+        self.assertEqual(self.pool.stats()["idle"], 2)
+        self.assertClosed(third_conn)
+
+    def test_idle_timeout(self):
+        db_conn = self.pool.acquire(self.dbfile)
+        self.pool.release(self.dbfile, db_conn)
+        self.now += 61
+        other_conn = self.pool.acquire(self.dbfile)
+        self.assertIsNot(other_conn, db_conn)
+        self.assertClosed(db_conn)
+        self.pool.release(self.dbfile, other_conn)
+
+    def test_discard(self):
+        idle_conn = self.pool.acquire(self.dbfile)
+        used_conn = self.pool.acquire(self.dbfile)
+        self.pool.release(self.dbfile, idle_conn)
+        self.pool.discard(self.dbfile)
+        self.assertClosed(idle_conn)
+        self.assertEqual(self.pool.stats()["inUse"], 0)
+
+        # a connection in use is closed when released
+        used_conn.execute("SELECT 1")
+        self.pool.release(self.dbfile, used_conn)
+        self.assertClosed(used_conn)
+        self.assertEqual(self.pool.stats()["idle"], 0)
+
+
+class LazyActionsTests(CabTestCase):
+    ''' Lazy action trees: the line sections with the number of their events and actions, each section loaded on demand '''
+
+    def assertLazyTree(self):
+        for trainNumberId in range(1, TEST_KNOBS["trainnumbers"] + 1):
+            full = self.getJson(self.postJson("getactions", {"trainNumberId": trainNumberId}))
+            lazy = self.getJson(self.postJson("getactions", {"trainNumberId": trainNumberId, "lazy": True}))
+            self.assertEqual(len(lazy["children"]), len(full["children"]))
+            for lazySection, section in zip(lazy["children"], full["children"]):
+                self.assertEqual(lazySection["children"], [])
+                self.assertEqual(lazySection["eventCount"], len(section["children"]))
+                self.assertEqual(lazySection["actionCount"], sum(len(event["children"]) for event in section["children"]))
+
+                response = self.postJson("getlinesection", {"lineId": full["lineId"], "lineSectionId": section["lineSectionId"]})
+                self.assertEqual(json.loads(response.content), section)
+
+    def test_lazy_tree(self):
+        self.setSessionDbFile(self.makeDatabase())
+        self.assertLazyTree()
+
+    def test_lazy_tree_from_snapshot(self):
+        dbfile = self.makeDatabase()
+        snapshot.buildSnapshot(dbfile)
+        self.setSessionDbFile(dbfile)
+        self.assertLazyTree()
+
+    def test_unknown_line_section(self):
+        self.setSessionDbFile(self.makeDatabase())
+        response = self.postJson("getlinesection", {"lineId": 1, "lineSectionId": 999999})
+        self.assertIn("has no line section", json.loads(response.content)["exception"])
+
+
+class WorkingCopyTests(CabTestCase):
+    ''' The working copies (in memory, scratch file) hold the database with the indexes of the lookups, made once, dropped on removal '''
+
+    MODES = ("memory", "scratch")
+
+    def setUp(self):
+        super().setUp()
+        # large enough for the query planner to prefer the indexes to scans
+        self.dbfile = self.makeDatabase(trainnumbers=20, sections=10, events=3, actions=4)
+        self.copies = workingcopy.WorkingCopies()
+        self.addCleanup(self.copies.remove, self.dbfile)
+        scratch_patch = mock.patch.object(workingcopy, "SCRATCH_DIR", os.path.join(self.directory, "scratch"))
+        scratch_patch.start()
+        self.addCleanup(scratch_patch.stop)
+
+    def getScratchFiles(self):
+        ''' The files in the directory of the scratch copies '''
+        return os.listdir(workingcopy.getScratchDir())
+
+    def test_copy_has_lookup_indexes(self):
+        db_conn = sqlite3.connect(self.dbfile)
+        self.addCleanup(db_conn.close)
+        original_scans = sum(len(workingcopy.findScans(plan)) for plan in workingcopy.explainQueries(db_conn).values())
+        self.assertGreater(original_scans, 0)
+        for mode in self.MODES:
+            with self.subTest(mode=mode), mock.patch.object(workingcopy, "MODE", mode):
+                uri = self.copies.getUri(self.dbfile)
+                self.assertIsNotNone(uri)
+                # made once
+                self.assertEqual(self.copies.getUri(self.dbfile), uri)
+                self.assertEqual(self.copies.stats()["copies"], 1)
+                self.assertGreater(self.copies.stats()["bytes"], 0)
+                self.assertEqual(len(self.getScratchFiles()), 1 if mode == "scratch" else 0)
+
+                copy_conn = sqlite3.connect(uri, uri=True)
+                query = "SELECT count(*), sum(ActionID) FROM action"
+                self.assertEqual(copy_conn.execute(query).fetchone(), db_conn.execute(query).fetchone())
+                for query_name, plan in workingcopy.explainQueries(copy_conn).items():
+                    self.assertEqual(workingcopy.findScans(plan), [], query_name)
+                copy_conn.close()
+
+                self.copies.remove(self.dbfile)
+                self.assertEqual(self.copies.stats(), {"copies": 0, "bytes": 0})
+                self.assertEqual(self.getScratchFiles(), [])
+
+    def test_find_scans(self):
+        plan = ["SCAN action", "SCAN nodes", "SCAN tp", "SCAN a USING INDEX idx", "SCAN b USING COVERING INDEX idx",
+                "SEARCH c USING INTEGER PRIMARY KEY (rowid=?)", "SCAN CONSTANT ROW", "SCAN lineevent"]
+        self.assertEqual(workingcopy.findScans(plan), ["SCAN action", "SCAN lineevent"])
+
+    def test_removed_while_copied(self):
+        makeWorkingCopy = workingcopy.makeWorkingCopy
+        made = []
+
+        def makeWorkingCopyRemoved(db_name, name, mode, interrupt=None):
+            made.append(makeWorkingCopy(db_name, name, mode, interrupt))
+            # e.g. the database expired meanwhile
+            self.copies.remove(db_name)
+            return made[-1]
+
+        for mode in self.MODES:
+            with self.subTest(mode=mode), mock.patch.object(workingcopy, "MODE", mode), \
+                 mock.patch.object(workingcopy, "makeWorkingCopy", makeWorkingCopyRemoved):
+                self.assertIsNone(self.copies.getUri(self.dbfile))
+                self.assertEqual(self.copies.stats(), {"copies": 0, "bytes": 0})
+                # dropped: the in-memory copy is no longer kept alive, the scratch file is removed
+                self.assertEqual((made[-1].keeper, made[-1].path), (None, None))
+                self.assertEqual(self.getScratchFiles(), [])
+            # made again on next use
+            with mock.patch.object(workingcopy, "MODE", mode):
+                self.assertIsNotNone(self.copies.getUri(self.dbfile))
+                self.copies.remove(self.dbfile)
+
+    def test_interrupted_copy_not_kept(self):
+        with mock.patch.object(workingcopy, "MODE", "scratch"):
+            self.assertIsNone(self.copies.getUri(self.dbfile, lambda: True))
+            self.assertEqual((self.copies.stats()["copies"], self.getScratchFiles()), (0, []))
+            self.assertIsNotNone(self.copies.getUri(self.dbfile))
+
+
+class ServerTimingTests(CabTestCase):
+    ''' Each request sends its statements, time in SQLite and phases as Server-Timing header, logs them, and samples slow requests '''
+
+    def setUp(self):
+        super().setUp()
+        self.dbfile = self.makeDatabase()
+        self.setSessionDbFile(self.dbfile)
+        self.cplxAction = dict(zip(("actionId", "actionListId", "actionDetailId", "actionType", "mediaType"), getCplxActions(self.dbfile, 1)[0]))
+
+    def getMetrics(self, response):
+        '''
+        The metrics of the Server-Timing header of a response
+        return dictionary: name -> (duration, description or None)
+        '''
+        metrics = dict()
+        for metric in response["Server-Timing"].split(", "):
+            name, *parameters = metric.split(";")
+            parameters = dict(parameter.split("=", 1) for parameter in parameters)
+            metrics[name] = (float(parameters["dur"]), parameters.get("desc"))
+        return metrics
+
+    def test_header(self):
+        metrics = self.getMetrics(self.postJson("getcplxaction", self.cplxAction))
+        self.assertEqual(list(metrics), ["sql", *middleware.PHASES, "total"])
+        statements = int(metrics["sql"][1].strip('"').split()[0])
+        self.assertGreater(statements, 0)
+        self.assertLessEqual(metrics["fetch"][0], metrics["total"][0])
+
+        # memoized and cached for the session: no statement
+        metrics = self.getMetrics(self.postJson("getcplxaction", self.cplxAction))
+        self.assertEqual(metrics["sql"], (0.0, '"0 statements"'))
+
+    def test_log_line(self):
+        with self.assertLogs("cab.middleware", "INFO") as logs:
+            response = self.postJson("getactions", {"trainNumberId": 1})
+            # streamed: logged once sent
+            self.assertEqual(logs.records, [])
+            self.getJson(response)
+        summary = logs.records[0].cab
+        self.assertEqual((len(logs.records), summary["path"], summary["status"]), (1, "/cab/getactions", 200))
+        self.assertGreater(summary["statements"], 0)
+        self.assertGreater(summary["json"], 0)
+        # the tree is loaded before the header is sent, serialized after
+        self.assertEqual(self.getMetrics(response)["sql"][1], '"{} statements"'.format(summary["statements"]))
+
+    @override_settings(CAB_SLOW_REQUEST_MS=0)
+    def test_slow_request_sampled(self):
+        with self.assertLogs("cab.middleware", "WARNING") as logs:
+            self.postJson("getcplxaction", self.cplxAction)
+        self.assertEqual(len(logs.records), 1)
+        message = logs.records[0].getMessage()
+        self.assertTrue(message.startswith("slow request /cab/getcplxaction"), message)
+        self.assertIn("SELECT", message)
+
+
+class StreamingTests(CabTestCase):
+    ''' The actions trees are sent in chunks while they are serialized: the first chunk is made before the tree is serialized '''
+
+    def setUp(self):
+        super().setUp()
+        self.dbfile = self.makeDatabase()
+        self.setSessionDbFile(self.dbfile)
+
+    def test_chunks_made_while_sent(self):
+        fragments = []
+        iterJson = act.iterJson
+
+        def iterJsonCounted(node, encode):
+            for fragment in iterJson(node, encode):
+                fragments.append(fragment)
+                yield fragment
+
+        # small chunks: a tree of the test database is sent in several
+        with mock.patch.object(jsonresponse, "joinChunks", functools.partial(jsonresponse.joinChunks, chunk_size=256)), \
+             mock.patch.object(act, "iterJson", iterJsonCounted):
+            response = self.postJson("getactions", {"trainNumberId": 1})
+            self.assertTrue(response.streaming)
+            self.assertFalse(response.has_header("Content-Length"))
+            chunks = iter(response.streaming_content)
+            first = next(chunks)
+            made = len(fragments)
+            rest = list(chunks)
+
+        self.assertGreaterEqual(len(first), 256)
+        self.assertLess(made, len(fragments))
+        self.assertTrue(rest)
+        self.assertEqual(json.loads(b"".join([first] + rest)), act.getActions(self.dbfile, 1, False))
+
+    @override_settings(ALLOWED_HOSTS=["127.0.0.1"])
+    def test_streamed_over_http(self):
+        server = ThreadedWSGIServer(("127.0.0.1", 0), WSGIRequestHandler)
+        server.set_app(WSGIHandler())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=JOB_TIMEOUT)
+        self.addCleanup(connection.close)
+        session_cookie = "{}={}".format(settings.SESSION_COOKIE_NAME, self.client.session.session_key)
+        for trainNumberId in range(1, TEST_KNOBS["trainnumbers"] + 1):
+            connection.request("POST", "/cab/getactions", json.dumps({"trainNumberId": trainNumberId}),
+                               {"Content-Type": "application/json", "Cookie": session_cookie})
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            # no length: the body ends with the connection
+            self.assertIsNone(response.getheader("Content-Length"))
+            self.assertIn("statements", response.getheader("Server-Timing"))
+            self.assertEqual(json.loads(response.read()), act.getActions(self.dbfile, trainNumberId, False))
+            connection.close()
+
+    @override_settings(CAB_STREAM_JSON=False)
+    def test_not_streamed(self):
+        response = self.postJson("getactions", {"trainNumberId": 1})
+        self.assertFalse(response.streaming)
+        self.assertEqual(json.loads(response.content), act.getActions(self.dbfile, 1, False))
+
+
+class ColumnarUploadTests(CabTestCase):
+    ''' The columnar train numbers of an upload hold the fields of the train number dictionaries, one list per field '''
+
+    def assertColumnar(self, dbfile):
+        rows = self.uploadDatabase(dbfile, Client())["trainNumbers"]
+        columns = self.uploadDatabase(dbfile, Client(), "columnar")["trainNumbers"]
+        self.assertEqual(len(rows), TEST_KNOBS["trainnumbers"])
+        self.assertEqual(list(columns), list(rows[0]))
+        self.assertEqual([dict(zip(columns, values)) for values in zip(*columns.values())], rows)
+
+    def test_columnar_train_numbers(self):
+        self.assertColumnar(self.makeDatabase())
+
+    @override_settings(CAB_SNAPSHOT_INDEX=True)
+    def test_columnar_train_numbers_from_snapshot(self):
+        self.assertColumnar(self.makeDatabase())
+
+
+class MemoTests(CabTestCase):
+    ''' The subtree memo counts its hits and misses, and keeps its most recently used subtrees (the root evicted first) '''
+
+    def setUp(self):
+        super().setUp()
+        self.dbfile = self.makeDatabase()
+        # A -> B -> C
+        self.root = addChain(self.dbfile, 3)
+        self.memo = cplx.SubtreeMemo(max_entries=2)
+
+    def resolve(self, index):
+        '''
+        Resolve the tree of a complex action of the chain through the memo
+        index: position of the complex action in the chain (0: A)
+        return (tree, number of statements executed)
+        '''
+        act_id, act_list_id, act_det_id, act_typ, med_typ = self.root
+        with database.profiling(database.Profile()) as profile:
+            tree = cplx.resolveCplxActionTree(self.dbfile, self.memo, None, act_id + index, act_list_id, act_det_id + index, act_typ, med_typ)
+        return tree, profile.statements
+
+    def test_hits_and_misses(self):
+        tree, statements = self.resolve(0)
+        self.assertGreater(statements, 0)
+        # A, B and C read
+        self.assertEqual(self.memo.stats(), {"hits": 0, "misses": 3, "entries": 2})
+
+        # C: a hit, not read again
+        self.assertEqual(self.resolve(2), (tree["children"][0]["children"][0], 0))
+        self.assertEqual(self.memo.stats(), {"hits": 1, "misses": 3, "entries": 2})
+
+    def test_lru_eviction(self):
+        A, B, C = range(self.root[0], self.root[0] + 3)
+        self.resolve(0)
+        # the root is put first: evicted first
+        self.assertEqual(list(self.memo.subtrees), [B, C])
+
+        # A read again (B taken from the memo): C is the least recently used
+        self.resolve(0)
+        self.assertEqual(list(self.memo.subtrees), [B, A])
+        self.assertEqual(self.memo.stats(), {"hits": 1, "misses": 4, "entries": 2})
+
+        self.assertEqual(self.resolve(0)[1], 0)
+        self.assertEqual(self.resolve(1)[1], 0)
+        self.assertGreater(self.resolve(2)[1], 0)
+        self.assertEqual(self.memo.stats(), {"hits": 3, "misses": 5, "entries": 2})
+
+
+class InFlightTests(CabTestCase):
+    ''' A subtree shared by complex actions resolved at the same time is read and built once: the other resolvers wait for it '''
+
+    def setUp(self):
+        super().setUp()
+        self.dbfile = self.makeDatabase()
+        # R1 -> B -> C, and R2 -> B
+        self.root = addChain(self.dbfile, 3)
+        self.other = addChain(self.dbfile, 1)
+        db_conn = sqlite3.connect(self.dbfile)
+        with db_conn:
+            db_conn.execute("INSERT INTO complexactionchildlist VALUES (NULL, ?, ?, 0)", (self.other[2], self.root[0] + 1))
+        db_conn.close()
+
+    def resolve(self, cplxAction, memo, inflight):
+        ''' Resolve the tree of a complex action, return (tree, number of statements executed) '''
+        with database.profiling(database.Profile()) as profile:
+            tree = cplx.resolveCplxActionTree(self.dbfile, memo, None, *cplxAction, inflight=inflight)
+        return tree, profile.statements
+
+    def test_shared_subtree_read_once(self):
+        act_id, act_list_id, act_det_id, act_typ, med_typ = self.root
+        shared = (act_id + 1, act_list_id, act_det_id + 1, act_typ, med_typ)
+        # not waited for: read again
+        self.assertGreater(self.resolve(shared, cplx.SubtreeMemo(), cplx.InFlight())[1], 0)
+
+        memo = cplx.SubtreeMemo()
+        inflight = cplx.InFlight()
+        registered = threading.Event()
+        released = threading.Event()
+        putTree = memo.putTree
+        register = inflight.register
+        wait = inflight.wait
+
+        def registerRead(action):
+            event = register(action)
+            registered.set()
+            return event
+
+        def putTreeReleased(action, tree):
+            # R1 read and registered, built: memoized once another resolver waits for it
+            self.assertTrue(released.wait(JOB_TIMEOUT))
+            putTree(action, tree)
+
+        def waitReleasing(act_id):
+            released.set()
+            return wait(act_id)
+
+        results = []
+        with mock.patch.object(inflight, "register", registerRead), mock.patch.object(memo, "putTree", putTreeReleased), \
+             mock.patch.object(inflight, "wait", waitReleasing):
+            resolver = threading.Thread(target=lambda: results.append(self.resolve(self.root, memo, inflight)))
+            resolver.start()
+            self.assertTrue(registered.wait(JOB_TIMEOUT))
+
+            # the shared subtree as root: waited for, not read
+            tree, statements = self.resolve(shared, memo, inflight)
+            resolver.join(JOB_TIMEOUT)
+
+        self.assertEqual(statements, 0)
+        self.assertEqual(tree, results[0][0]["children"][0])
+        self.assertGreater(results[0][1], 0)
+
+        # R2: the shared subtree taken from the memo
+        hits = memo.stats()["hits"]
+        tree, statements = self.resolve(self.other, memo, inflight)
+        self.assertEqual(tree["children"], results[0][0]["children"])
+        self.assertEqual(memo.stats()["hits"], hits + 1)
+
+
+# the cab urls served by the async views (as under ASGI with CAB_ASYNC_VIEWS), see AsyncViewsTests
+urlpatterns = [path("cab/", include(urls.getUrlPatterns(asyncviews)))]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncViewsTests(CabTestCase):
+    ''' The async views answer as the sync views: upload, search, actions (streamed), complex actions, cacheable urls '''
+
+    async def agetJson(self, response):
+        ''' The JSON data of a response of the async client (also streamed) '''
+        if response.streaming:
+            return json.loads(b"".join([chunk async for chunk in response.streaming_content]))
+        return json.loads(response.content)
+
+    async def apostJson(self, client, name, data):
+        ''' Post JSON data to a cab endpoint with the async client, return the response '''
+        return await client.post("/cab/" + name, json.dumps(data), content_type="application/json")
+
+    async def test_views_match_sync_views(self):
+        dbfile = self.makeDatabase()
+        client = AsyncClient()
+        with open(dbfile, "rb") as file:
+            status = json.loads((await client.post("/cab/uploaddb", {"dbfile": file})).content)
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while status["state"] not in (uploadjobs.DONE, uploadjobs.FAILED, uploadjobs.CANCELLED):
+            self.assertLess(time.monotonic(), deadline, "upload job not finished")
+            await asyncio.sleep(0.02)
+            status = json.loads((await client.get("/cab/uploadstatus", {"jobId": status["jobId"]})).content)
+        self.assertEqual(status["state"], uploadjobs.DONE)
+        self.assertEqual(len(status["trainNumbers"]), TEST_KNOBS["trainnumbers"])
+        stored = upload.findDbFile(status["dbHash"])
+
+        response = await client.get("/cab/searchtrainnumbers", {"q": "", "limit": 2})
+        self.assertEqual(json.loads(response.content), search.searchTrainNumbers(stored, "", limit=2))
+        response = await client.get("/cab/searchtrainnumbers", {"after": "0:1"})
+        self.assertEqual(response.status_code, 400)
+
+        for trainNumberId in range(1, TEST_KNOBS["trainnumbers"] + 1):
+            expected = act.getActions(stored, trainNumberId, False)
+            # built, then from the result cache
+            for _ in range(2):
+                self.assertEqual(await self.agetJson(await self.apostJson(client, "getactions", {"trainNumberId": trainNumberId})), expected)
+            section = expected["children"][0]
+            response = await self.apostJson(client, "getlinesection", {"lineId": expected["lineId"], "lineSectionId": section["lineSectionId"]})
+            self.assertEqual(json.loads(response.content), section)
+            response = await client.get("/cab/db/{}/actions/{}".format(status["dbHash"], trainNumberId))
+            self.assertEqual(await self.agetJson(response), expected)
+
+            expected = cplx.getCplxActionTrees(stored, trainNumberId)
+            response = await self.apostJson(client, "getcplxactions", {"trainNumberId": trainNumberId})
+            self.assertEqual(json.loads(response.content), expected)
+
+        for cplxAction in getCplxActions(stored, 5):
+            expected = cplx.getCplxActionTree(stored, *cplxAction)
+            response = await self.apostJson(client, "getcplxaction", dict(zip(("actionId", "actionListId", "actionDetailId", "actionType", "mediaType"), cplxAction)))
+            self.assertEqual(json.loads(response.content), expected)
+
+        response = await client.get("/cab/diff/{0}/{0}".format(status["dbHash"]))
+        self.assertEqual(json.loads(response.content), diff.getDiff(stored, stored))
+
+    async def test_unknown_database(self):
+        self.assertIs(resolve("/cab/db/{}/actions/1".format("0" * 64)).func, asyncviews.dbactions)
+        response = await AsyncClient().get("/cab/db/{}/actions/1".format("0" * 64))
+        self.assertIn("no database stored", json.loads(response.content)["exception"])
+
+
+class SearchTests(CabTestCase):
+    ''' Train numbers are searched by short name: prefix matches, then substring matches, paged by cursor '''
+
+    # short names of the train numbers: 'ab' is the prefix of 4 names, in 3 others only
+    NAMES = ["AB2", "xab", "ab1", "zz", "abab", "cab", "Ab3", "yab"]
+
+    def setUp(self):
+        super().setUp()
+        self.dbfile = self.makeDatabase(trainnumbers=len(self.NAMES))
+        db_conn = sqlite3.connect(self.dbfile)
+        with db_conn:
+            db_conn.executemany("UPDATE trainnumber SET ShortName = ? WHERE TrainNumberID = ?",
+                                [(name, index + 1) for index, name in enumerate(self.NAMES)])
+        db_conn.close()
+        self.setSessionDbFile(self.dbfile)
+
+    def searchPages(self, query, limit):
+        ''' Search all pages of the query (by the view), return the short names of each page '''
+        pages = []
+        params = {"q": query, "limit": limit}
+        while True:
+            response = self.client.get("/cab/searchtrainnumbers", params)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content)
+            self.assertEqual(data["count"], len(self.NAMES))
+            pages.append([trainNumber["trainNumberShortName"] for trainNumber in data["trainNumbers"]])
+            if data["next"] is None:
+                return pages
+            params["after"] = data["next"]
+
+    def test_prefix_then_substring(self):
+        pages = self.searchPages("aB", 100)
+        self.assertEqual(pages, [["ab1", "AB2", "Ab3", "abab", "cab", "xab", "yab"]])
+        self.assertEqual(self.searchPages("", 100), [sorted(self.NAMES, key=str.casefold)])
+        self.assertEqual(self.searchPages("b1", 100), [["ab1"]])
+        self.assertEqual(self.searchPages("q", 100), [[]])
+
+    def test_pages_across_prefix_and_substring(self):
+        # the second page starts with prefix matches and ends with substring matches
+        self.assertEqual(self.searchPages("ab", 3), [["ab1", "AB2", "Ab3"], ["abab", "cab", "xab"], ["yab"]])
+        # a page ends with the last prefix match: the next page holds the substring matches only
+        self.assertEqual(self.searchPages("ab", 4), [["ab1", "AB2", "Ab3", "abab"], ["cab", "xab", "yab"]])
+        self.assertEqual(self.searchPages("ab", 1), [[name] for name in ["ab1", "AB2", "Ab3", "abab", "cab", "xab", "yab"]])
+
+    def test_cursor_round_trip(self):
+        data = search.searchTrainNumbers(self.dbfile, "ab", limit=4)
+        # kind:id:row:name of the last train number of the page (the name may hold ':')
+        self.assertEqual(data["next"], "{}:5:4:abab".format(search.PREFIX))
+        self.assertEqual(search.decodeCursor(data["next"]), (search.PREFIX, ("abab", 5, 4)))
+        match = (search.SUBSTRING, ("a:b", 12, 7))
+        self.assertEqual(search.decodeCursor(search.encodeCursor(match)), match)
+
+    def test_limit_clamped(self):
+        # as sent by the view (text)
+        self.assertEqual(len(search.searchTrainNumbers(self.dbfile, "", limit="0")["trainNumbers"]), 1)
+        self.assertEqual(len(search.searchTrainNumbers(self.dbfile, "", limit="-5")["trainNumbers"]), 1)
+        self.assertEqual(len(search.searchTrainNumbers(self.dbfile, "")["trainNumbers"]), len(self.NAMES))
+        with mock.patch.object(search.TrainNumberIndex, "search", autospec=True, return_value=([], False)) as search_mock:
+            search.searchTrainNumbers(self.dbfile, "", limit=100000)
+            search.searchTrainNumbers(self.dbfile, "")
+        self.assertEqual([call.args[3] for call in search_mock.call_args_list], [search.MAX_PAGE_SIZE, search.PAGE_SIZE])
+
+    def assertInvalid(self, params, message):
+        response = self.client.get("/cab/searchtrainnumbers", params)
+        self.assertEqual(response.status_code, 400)
+        exception = json.loads(response.content)["exception"]
+        self.assertTrue(exception.startswith(search.INVALID_REQUEST), exception)
+        self.assertIn(message, exception)
+
+    def test_malformed_request_rejected(self):
+        for cursor in ("0", "0:1:2", "x:5:4:abab", "0:five:4:abab", "0:5:four:abab"):
+            self.assertInvalid({"q": "ab", "after": cursor}, "malformed cursor")
+        self.assertInvalid({"q": "ab", "limit": "ten"}, "invalid literal")
+
+    def test_stale_cursor_rejected(self):
+        # of another database: no such train number (id, row, name)
+        self.assertInvalid({"q": "ab", "after": "0:5:4:other"}, "stale cursor")
+        self.assertInvalid({"q": "ab", "after": "0:5:99:abab"}, "stale cursor")
+        # of another query, or of another match kind
+        self.assertInvalid({"q": "ca", "after": "0:5:4:abab"}, "stale cursor")
+        self.assertInvalid({"q": "ab", "after": "1:5:4:abab"}, "stale cursor")
+        self.assertInvalid({"q": "ab", "after": "2:5:4:abab"}, "stale cursor")
@@ -0,0 +1,355 @@
+''' Module to handle database uploads: streamed straight into the upload directory, stored by content, removed with the sessions '''
+
+
+import os
+import re
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+
+from cab.dbaccess import database
+from cab.dbaccess import cplxaction as cplx
+from cab.dbaccess import search
+from cab.dbaccess import snapshot
+from cab.dbaccess import trainnumber as tn
+from cab.dbaccess import workingcopy
+
+
+logger = logging.getLogger(__name__)
+
+
+# every SQLite database file starts with this header
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def getUploadDir():
+    ''' The directory of the uploaded databases (created if needed) '''
+    upload_dir = settings.CAB_UPLOAD_DIR or os.path.join(tempfile.gettempdir(), "cab-uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+    # the databases of expired sessions are removed periodically once the uploads are used
+    SWEEPER.start()
+    return upload_dir
+
+
+class UploadedDbFile(UploadedFile):
+    ''' Class to hold an uploaded database, already written (and closed) at its final location '''
+
+    def __init__(self, path, name, content_type, size, sha256):
+        '''
+        Constructor
+        path: database file (complete file name with path)
+        name: file name given by the client
+        content_type: content type given by the client
+        size: file size (bytes)
+        sha256: SHA-256 of the file content (hex)
+        '''
+        super().__init__(None, name, content_type, size)
+        self.path = path
+        self.sha256 = sha256
+
+
+class DbFileUploadHandler(FileUploadHandler):
+    '''
+    Upload handler which streams the 'dbfile' field straight into its final file (one pass, no spooling),
+    rejects uploads which are no SQLite database after the first bytes,
+    hashes the content on the way (SHA-256), and syncs and closes the file before it is handed to the view.
+    '''
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.chunk_size = settings.CAB_UPLOAD_CHUNK_SIZE
+        self.file = None
+        self.path = None
+        self.header = b""
+        self.hash = None
+        self.error = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name != "dbfile":
+            return
+        fd, self.path = tempfile.mkstemp(suffix=".db", dir=getUploadDir())
+        self.file = os.fdopen(fd, "wb")
+        self.header = b""
+        self.hash = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.file is None:
+            return None
+
+        # check the header as soon as its bytes are there
+        if len(self.header) < len(SQLITE_HEADER):
+            self.header += raw_data[:len(SQLITE_HEADER) - len(self.header)]
+            if not SQLITE_HEADER.startswith(self.header):
+                self.error = "'{}' is not a SQLite database".format(self.file_name)
+                # nothing more is written, the rest of the body is read (not stored): the client gets the error response
+                raise StopUpload(connection_reset=False)
+
+        self.file.write(raw_data)
+        self.hash.update(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.file is None:
+            return None
+        if self.header != SQLITE_HEADER:
+            self.error = "'{}' is not a SQLite database".format(self.file_name)
+            self.upload_interrupted()
+            return None
+
+        # the data must be on disk before SQLite opens the file
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        return UploadedDbFile(self.path, self.file_name, self.content_type, file_size, self.hash.hexdigest())
+
+    def upload_interrupted(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+def getDigest(dbfile):
+    '''
+    The content hash (SHA-256) of a stored database, taken from its file name
+    dbfile: database file
+    return SHA-256 (hex), None if the file is not stored by content
+    '''
+    name, extension = os.path.splitext(os.path.basename(dbfile))
+    if (extension == ".db") and (len(name) == 64):
+        return name
+    return None
+
+
+def findDbFile(digest):
+    '''
+    The stored database of a content hash (see the cacheable endpoints)
+    digest: SHA-256 (hex) of the content
+    return database file, None if no database of this content is stored
+    '''
+    if re.fullmatch("[0-9a-f]{64}", digest) is None:
+        return None
+    path = os.path.join(getUploadDir(), digest + ".db")
+    return path if os.path.exists(path) else None
+
+
+class DbFileStore():
+    '''
+    Class to hold the uploaded databases by content (process-wide, thread-safe):
+    identical uploads share one file ('<sha256>.db' in the upload directory) and one train number list.
+    A file is referenced by the sessions which uploaded it and removed when the last one releases it.
+    Files whose references are not known (e.g. after a restart) are removed when they expire.
+    '''
+
+    def __init__(self):
+        ''' Constructor '''
+        self.sessions = dict()       # sha256 -> set of session keys
+        self.trainnumbers = dict()   # (sha256, columnar) -> train numbers
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def add(self, dbfile, session_key):
+        '''
+        Store an uploaded database for the given session (the uploaded file is moved or, if the content is
+        already stored, removed).
+        dbfile: uploaded database (UploadedDbFile)
+        session_key: key of the session
+        return database file of the stored content
+        '''
+        path = os.path.join(getUploadDir(), dbfile.sha256 + ".db")
+        with self.lock:
+            if os.path.exists(path):
+                os.remove(dbfile.path)
+                # the expiry counts from the last upload
+                os.utime(path)
+                self.hits += 1
+                logger.info("db {} already stored".format(path))
+            else:
+                os.replace(dbfile.path, path)
+                self.misses += 1
+            self.sessions.setdefault(dbfile.sha256, set()).add(session_key)
+        dbfile.path = path
+        return path
+
+    def release(self, dbfile, session_key):
+        '''
+        Release the database of the given session: it is removed if no other session references it.
+        dbfile: database file
+        session_key: key of the session
+        '''
+        digest = getDigest(dbfile)
+        with self.lock:
+            sessions = self.sessions.get(digest)
+            if sessions is None:
+                # not known (stored before a restart, or not by content): removed when it expires
+                return
+            sessions.discard(session_key)
+            if sessions:
+                return
+            # removed under the lock: an upload of the same content (see add) either finds the file referenced, or
+            # not stored and stores its own
+            self.forget(digest)
+            removeDbFile(dbfile)
+
+    def forget(self, digest):
+        ''' Drop the references and the cached train numbers of a content (lock must be held) '''
+        self.sessions.pop(digest, None)
+        self.trainnumbers.pop((digest, False), None)
+        self.trainnumbers.pop((digest, True), None)
+
+    def getTrainNumbers(self, dbfile, columnar=False):
+        '''
+        Retrieve all train numbers (lines) from the given database, once per stored content.
+        dbfile: database file
+        columnar: one list per field instead of one dictionary per line
+        return train numbers (lines) as json
+        '''
+        digest = getDigest(dbfile)
+        with self.lock:
+            trainnumbers = self.trainnumbers.get((digest, columnar))
+        if trainnumbers is not None:
+            return trainnumbers
+
+        trainnumbers = tn.getTrainNumbers(dbfile, columnar)
+        if (digest is not None) and ("exception" not in trainnumbers):
+            with self.lock:
+                if digest in self.sessions:
+                    self.trainnumbers[(digest, columnar)] = trainnumbers
+        return trainnumbers
+
+    def stats(self):
+        ''' Store counters (hits, misses, stored contents and referencing sessions) '''
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "contents": len(self.sessions),
+                "sessions": sum(len(sessions) for sessions in self.sessions.values())
+            }
+
+
+# the process-wide store of the uploaded databases
+STORE = DbFileStore()
+
+
+def storeDbFile(dbfile, session_key, previous_dbfile=None):
+    '''
+    Store an uploaded database for the given session: identical uploads share one file (stored by content hash),
+    the previously uploaded database of the session and those of expired sessions are released.
+    dbfile: uploaded database (UploadedDbFile)
+    session_key: key of the session
+    previous_dbfile: database file uploaded before by the session, or None
+    return database file of the stored content
+    '''
+    dbfile_path = STORE.add(dbfile, session_key)
+    logger.info("db saved into {}".format(dbfile_path))
+
+    if (previous_dbfile is not None) and (previous_dbfile != dbfile_path):
+        STORE.release(previous_dbfile, session_key)
+    removeExpiredDbFiles()
+    return dbfile_path
+
+
+def getUploadResponse(dbfile, upload_format=None):
+    '''
+    Retrieve the train numbers (lines) of an uploaded database, in the requested format
+    dbfile: database file
+    upload_format: 'page': the number of train numbers and the first page (see searchtrainnumbers),
+                   'columnar': one list per field, otherwise: one dictionary per train number
+    return train numbers (lines) as json
+    '''
+    if upload_format == "page":
+        return search.searchTrainNumbers(dbfile, "")
+    # cached per stored content
+    return STORE.getTrainNumbers(dbfile, upload_format == "columnar")
+
+
+def removeDbFile(dbfile):
+    '''
+    Remove an uploaded database: its snapshot, its train number index, its complex action memo,
+    its pooled connections, its working copy and the file itself
+    (only files in the upload directory are removed).
+    dbfile: database file
+    '''
+    snapshot.SNAPSHOTS.remove(dbfile)
+    search.INDEXES.remove(dbfile)
+    cplx.removeMemo(dbfile)
+    database.POOL.discard(dbfile)
+    workingcopy.COPIES.remove(dbfile)
+    if os.path.dirname(os.path.abspath(dbfile)) == os.path.abspath(getUploadDir()):
+        try:
+            os.remove(dbfile)
+            logger.info("db {} removed".format(dbfile))
+        except FileNotFoundError:
+            pass
+
+
+def removeExpiredDbFiles():
+    '''
+    Remove the uploaded databases of expired sessions (on each upload and periodically, see ExpirySweeper):
+    a session expires SESSION_COOKIE_AGE after its last upload, and each upload of a content touches its file,
+    so older files are no longer used by any session.
+    '''
+    upload_dir = getUploadDir()
+    expired = time.time() - settings.SESSION_COOKIE_AGE
+    for name in os.listdir(upload_dir):
+        dbfile = os.path.join(upload_dir, name)
+        try:
+            # under the store lock: an upload of the same content may touch the file meanwhile
+            with STORE.lock:
+                if os.path.getmtime(dbfile) < expired:
+                    STORE.forget(getDigest(dbfile))
+                    removeDbFile(dbfile)
+        except OSError:
+            pass
+
+
+class ExpirySweeper():
+    '''
+    Class to remove the uploaded databases of expired sessions every CAB_UPLOAD_SWEEP_INTERVAL (daemon thread, started
+    on first use of the upload directory): the expiry of a cache session is not noticed, and without further uploads
+    the databases of expired sessions would be kept
+    '''
+
+    def __init__(self):
+        ''' Constructor '''
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        ''' Start the sweeping thread (once) '''
+        if (self.thread is not None) or (settings.CAB_UPLOAD_SWEEP_INTERVAL <= 0):
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="cab-upload-sweep", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        ''' Sweep forever '''
+        while True:
+            time.sleep(settings.CAB_UPLOAD_SWEEP_INTERVAL)
+            try:
+                removeExpiredDbFiles()
+            except Exception as e:
+                logger.error("removing the expired databases failed: {}".format(str(e)))
+
+
+# the process-wide sweeper of the expired databases
+SWEEPER = ExpirySweeper()
@@ -0,0 +1,248 @@
+''' Module to process the uploaded databases in the background: validation, train number extraction and cache warm-up '''
+
+
+import time
+import uuid
+import logging
+import threading
+import concurrent.futures
+
+
+from django.conf import settings
+
+
+from cab import upload
+from cab.dbaccess import database
+from cab.dbaccess import search
+from cab.dbaccess import snapshot
+from cab.dbaccess import workingcopy
+
+
+logger = logging.getLogger(__name__)
+
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# finished jobs are kept (for their status) this time (seconds)
+JOB_KEEP = 600
+
+
+class UploadJob():
+    '''
+    Class to hold the processing of one uploaded database, run by a worker thread.
+    The job is cancelled between its steps, and within a step by interrupting the running statement.
+    '''
+
+    def __init__(self, dbfile, upload_format=None):
+        '''
+        Constructor
+        dbfile: database file (stored)
+        upload_format: format of the train numbers (see upload.getUploadResponse)
+        '''
+        self.id = uuid.uuid4().hex
+        self.dbfile = dbfile
+        self.upload_format = upload_format
+        self.state = QUEUED
+        self.step = None
+        self.steps = self.makeSteps()
+        self.done_steps = 0
+        self.result = None
+        self.error = None
+        self.finished = None
+        self.cancelled = threading.Event()
+
+    def makeSteps(self):
+        ''' The steps of the job: list of (name, function) '''
+        steps = [("validating", self.validate)]
+        if workingcopy.MODE is not None:
+            steps.append(("workingcopy", self.makeWorkingCopy))
+        if settings.CAB_SNAPSHOT_INDEX:
+            # built first: the train numbers are then read from memory
+            steps.append(("snapshot", self.buildSnapshot))
+        steps.append(("trainnumbers", self.getTrainNumbers))
+        if settings.CAB_UPLOAD_WARMUP and (self.upload_format != "page"):
+            steps.append(("warmup", self.warmUp))
+        return steps
+
+    def validate(self):
+        database.checkDatabase(self.dbfile)
+
+    def makeWorkingCopy(self):
+        workingcopy.COPIES.getUri(self.dbfile, database.checkInterrupt)
+
+    def buildSnapshot(self):
+        if snapshot.getSnapshot(self.dbfile) is None:
+            snapshot.buildSnapshot(self.dbfile)
+
+    def getTrainNumbers(self):
+        self.result = upload.getUploadResponse(self.dbfile, self.upload_format)
+        if "exception" in self.result:
+            raise database.DatabaseException(self.result["exception"])
+
+    def warmUp(self):
+        # the train number index (searchtrainnumbers)
+        search.getIndex(self.dbfile)
+
+    def run(self):
+        ''' Run the steps of the job (in a worker thread): its statements are interrupted once the job is cancelled '''
+        token = database.INTERRUPT.set(self.cancelled)
+        start = time.perf_counter()
+        try:
+            self.state = RUNNING
+            for step, function in self.steps:
+                if self.cancelled.is_set():
+                    break
+                self.step = step
+                function()
+                self.done_steps += 1
+            if self.cancelled.is_set():
+                self.state = CANCELLED
+            else:
+                self.step = None
+                self.state = DONE
+
+        except Exception as e:
+            if self.cancelled.is_set():
+                self.state = CANCELLED
+            else:
+                self.error = str(e)
+                self.state = FAILED
+                logger.error("upload job {} failed ({}): {}".format(self.id, self.step, self.error))
+
+        finally:
+            database.INTERRUPT.reset(token)
+            self.finished = time.monotonic()
+            logger.info("upload job {} {} in {:.1f} ms ({})".format(self.id, self.state, (time.perf_counter() - start) * 1000, self.dbfile))
+
+    def cancel(self):
+        ''' Cancel the job: a queued job is not run, a running one stops at its next statement '''
+        self.cancelled.set()
+        if self.state == QUEUED:
+            self.state = CANCELLED
+            self.finished = time.monotonic()
+
+    def getStatus(self):
+        '''
+        The status of the job
+        return json: job id, state, current step, progress (0..1), train numbers and content hash of the database
+                     (see the cacheable endpoints) once done, exception once failed
+        '''
+        status = {
+            "jobId": self.id,
+            "state": self.state,
+            "step": self.step,
+            "progress": round(self.done_steps / len(self.steps), 2)
+        }
+        if self.state == DONE:
+            status["trainNumbers"] = self.result
+            status["dbHash"] = upload.getDigest(self.dbfile)
+        elif self.state == FAILED:
+            status["exception"] = self.error
+        return status
+
+
+class UploadJobs():
+    '''
+    Class to hold the upload jobs (process-wide, thread-safe).
+    The job ids are random: the status of a job is given to whoever knows its id (the session which uploaded).
+    '''
+
+    def __init__(self):
+        ''' Constructor '''
+        self.jobs = dict()       # job id -> job
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def getExecutor(self):
+        ''' The executor of the jobs, created on first use (lock must be held) '''
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.CAB_UPLOAD_WORKERS, thread_name_prefix="cab-upload")
+        return self.executor
+
+    def cancel(self, job_id):
+        '''
+        Cancel a job (if still running)
+        job_id: id of the job, None: none
+        '''
+        job = self.get(job_id)
+        if (job is not None) and (job.finished is None):
+            job.cancel()
+            logger.info("upload job {} cancelled".format(job.id))
+
+    def start(self, dbfile, upload_format=None):
+        '''
+        Start processing an uploaded database
+        dbfile: database file (stored)
+        upload_format: format of the train numbers (see upload.getUploadResponse)
+        return job
+        '''
+        job = UploadJob(dbfile, upload_format)
+        with self.lock:
+            self.prune(time.monotonic())
+            self.jobs[job.id] = job
+            self.getExecutor().submit(job.run)
+        return job
+
+    def get(self, job_id):
+        '''
+        Get a job
+        job_id: id of the job
+        return job, None if not found
+        '''
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def prune(self, now):
+        ''' Drop the jobs finished longer than JOB_KEEP ago (lock must be held) '''
+        for job_id, job in list(self.jobs.items()):
+            if (job.finished is not None) and (now - job.finished > JOB_KEEP):
+                del self.jobs[job_id]
+
+
+# the process-wide upload jobs
+JOBS = UploadJobs()
+
+
+def startUpload(dbfile, session_key, previous_dbfile=None, previous_job_id=None, upload_format=None):
+    '''
+    Store an uploaded database for the given session and start processing it in the background
+    (the job of the previous upload of the session is cancelled before its database is released).
+    dbfile: uploaded database (UploadedDbFile)
+    session_key: key of the session
+    previous_dbfile: database file uploaded before by the session, or None
+    previous_job_id: id of the upload job started before by the session, or None
+    upload_format: format of the train numbers (see upload.getUploadResponse)
+    return job (its dbfile is the stored database)
+    '''
+    JOBS.cancel(previous_job_id)
+    dbfile_path = upload.storeDbFile(dbfile, session_key, previous_dbfile)
+    return JOBS.start(dbfile_path, upload_format)
+
+
+def getJobStatus(job_id):
+    '''
+    The status of an upload job
+    job_id: id of the job
+    return json: status of the job (see UploadJob.getStatus)
+    '''
+    job = JOBS.get(job_id)
+    if job is None:
+        return {"exception": "unknown upload job '{}'".format(job_id)}
+    return job.getStatus()
+
+
+def endSession(session_key, dbfile=None, job_id=None):
+    '''
+    Release the upload of a session which ends (e.g. flushed): its job is cancelled, its database released
+    session_key: key of the session
+    dbfile: database file uploaded by the session, or None
+    job_id: id of the upload job started by the session, or None
+    '''
+    JOBS.cancel(job_id)
+    if (session_key is not None) and (dbfile is not None):
+        upload.STORE.release(dbfile, session_key)
@@ -1,13 +1,35 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
-urlpatterns = [
-    path("", views.index, name="index"),
-    path("cab", views.cab, name="cab"),
-    path("cplxaction", views.cplxaction, name="cplxaction"),
-    path("uploaddb", views.uploaddb, name="uploaddb"),
-    path("getactions", views.getactions, name="getactions"),
-    path("loadcplxaction", views.loadcplxaction, name="loadcplxaction"),
-    path("getcplxaction", views.getcplxaction, name="getcplxaction")
-]
\ No newline at end of file
+# the database endpoints: async views under ASGI (CAB_ASYNC_VIEWS), sync views otherwise
+if settings.CAB_ASYNC_VIEWS:
+    from . import asyncviews as dbviews
+else:
+    dbviews = views
+
+def getUrlPatterns(dbviews):
+    '''
+    The url patterns of the cab
+    dbviews: module of the views of the database endpoints (views, or asyncviews)
+    '''
+    return [
+        path("", views.index, name="index"),
+        path("cab", views.cab, name="cab"),
+        path("cplxaction", views.cplxaction, name="cplxaction"),
+        path("uploaddb", dbviews.uploaddb, name="uploaddb"),
+        path("uploadstatus", dbviews.uploadstatus, name="uploadstatus"),
+        path("searchtrainnumbers", dbviews.searchtrainnumbers, name="searchtrainnumbers"),
+        path("getactions", dbviews.getactions, name="getactions"),
+        # cacheable variants (GET): the url carries the content hash of the database (dbHash of the upload status)
+        path("db/<str:digest>/actions/<int:trainNumberId>", dbviews.dbactions, name="dbactions"),
+        path("db/<str:digest>/cplxaction/<str:actionId>", dbviews.dbcplxaction, name="dbcplxaction"),
+        path("diff/<str:base>/<str:other>", dbviews.dbdiff, name="dbdiff"),
+        path("getlinesection", dbviews.getlinesection, name="getlinesection"),
+        path("loadcplxaction", views.loadcplxaction, name="loadcplxaction"),
+        path("getcplxaction", dbviews.getcplxaction, name="getcplxaction"),
+        path("getcplxactions", dbviews.getcplxactions, name="getcplxactions")
+    ]
+
+urlpatterns = getUrlPatterns(dbviews)
@@ -1,21 +1,66 @@
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.template import loader
-from django.http import JsonResponse
 from django.urls import reverse
+from django.conf import settings
 import logging
-import tempfile
 import json
 
 
-from cab.dbaccess import trainnumber as tn
+from cab import upload
+from cab import uploadjobs
+from cab import cacheable
+from cab import resultcache
+from cab.requestlog import RequestLog
+from cab import jsonresponse
+from cab.jsonresponse import CabJsonResponse
 from cab.dbaccess import action as act
 from cab.dbaccess import cplxaction as cplx
+from cab.dbaccess import search
+from cab.dbaccess import diff
 
 
 logger = logging.getLogger(__name__)
 
 
+def getActionsData(dbfile, trainNumberId, lazy):
+    '''
+    Get the actions of a train number: as tree of objects, serialized while sent (CAB_STREAM_JSON), as json otherwise
+    return line object, or json
+    '''
+    if settings.CAB_STREAM_JSON:
+        return act.getActionTree(dbfile, trainNumberId, lazy)
+    return act.getActions(dbfile, trainNumberId, lazy)
+
+def makeActionsResponse(response_data, makeResponse=CabJsonResponse, session_result=None, wrapChunks=None):
+    '''
+    Make the response of the actions of a train number: streamed for a tree of objects (see getActionsData)
+    makeResponse: function making the response of json data
+    session_result: result of the session to cache the response in (see resultcache), or None
+    wrapChunks: function wrapping the chunks of a streamed response (e.g. asyncviews.iterChunks), or None
+    '''
+    if isinstance(response_data, act.Line):
+        chunks = jsonresponse.joinChunks(act.iterJson(response_data, jsonresponse.dumps))
+        if session_result is not None:
+            # stored by the last chunk
+            chunks = session_result.cacheChunks(chunks)
+        if wrapChunks is not None:
+            chunks = wrapChunks(chunks)
+        return jsonresponse.CabStreamingJsonResponse(chunks)
+    return makeSessionResponse(response_data, session_result, makeResponse)
+
+def makeSessionResponse(response_data, session_result, makeResponse=CabJsonResponse):
+    '''
+    Make the response of json data and cache it for the session
+    session_result: result of the session to cache the response in (see resultcache), or None
+    makeResponse: function making the response of json data
+    '''
+    response = makeResponse(response_data)
+    if session_result is not None:
+        session_result.put(response_data, response.content)
+    return response
+
+
 # Create your views here.
 
 def index(request):
@@ -36,25 +81,63 @@ def cplxaction(request):
 def uploaddb(request):
     ''' open and read the database uploaded in the request '''
     if request.method == 'POST':
-        # Retrieve the database file name
-        dbfile = request.FILES["dbfile"]
+        request_log = RequestLog(logger, "uploaddb")
+
+        # stream the upload straight into its final file (must be set before request.FILES is accessed)
+        upload_handler = upload.DbFileUploadHandler(request)
+        request.upload_handlers = [upload_handler]
+
+        # Retrieve the database file (already written, synced and closed)
+        dbfile = request.FILES.get("dbfile")
         #print(dbfile)
+        if dbfile is None:
+            # Django does not call upload_interrupted() on StopUpload: remove the partial file here
+            upload_handler.upload_interrupted()
+            response_data = {"exception": upload_handler.error or "no database uploaded"}
+            logger.error("upload rejected: {}".format(response_data["exception"]))
+            return request_log.done(CabJsonResponse(response_data), response_data)
+
+        # the references to the stored databases are kept by session key
+        if request.session.session_key is None:
+            request.session.save()
+        session_key = request.session.session_key
+        # the results of the previous database are dropped (a result is keyed by the content of its database)
+        resultcache.clearResults(session_key)
+
+        # identical uploads share one file, the previously uploaded database of this session is released
+        # validation and train numbers in the background, in the requested format (see uploadstatus)
+        job = uploadjobs.startUpload(dbfile, session_key, request.session.get('dbfile'), request.session.get('uploadJob'),
+                                     request.POST.get("format"))
+        request.session['dbfile'] = job.dbfile
+        request.session['uploadJob'] = job.id
+
+        # Send the job (as JSON) back
+        response_data = job.getStatus()
+        return request_log.done(CabJsonResponse(response_data), response_data)
+
+def uploadstatus(request):
+    ''' get the status of the upload job contained in the request: progress, train numbers once done '''
+    if request.method == 'GET':
+        jobId = request.GET.get("jobId")
+
+        request_log = RequestLog(logger, "uploadstatus", jobId=jobId)
+        response_data = uploadjobs.getJobStatus(jobId)
+
+        # Send the job status (as JSON) back
+        return request_log.done(CabJsonResponse(response_data), response_data)
 
-        # save the file (chunks) in a temporary file
-        tmp_dbfile = tempfile.NamedTemporaryFile(delete=False)
-        request.session['dbfile'] = tmp_dbfile.name
-        #print(tmp_dbfile.name)
-        logger.info("db saved into {}".format(tmp_dbfile.name))
-        for chunk in dbfile.chunks():
-            tmp_dbfile.write(chunk)
+def searchtrainnumbers(request):
+    ''' search the train numbers by short name (prefix matches first, then substring matches), one page '''
+    if request.method == 'GET':
+        query = request.GET.get("q", "")
+        after = request.GET.get("after")
+        limit = request.GET.get("limit")
 
-        # retrieve all train numbers (lines) from the given database
-        response_data = tn.getTrainNumbers(request.session['dbfile'])
-        logger.info("train numbers: {}".format(response_data))
-        #print(response_data)
+        request_log = RequestLog(logger, "searchtrainnumbers", q=query)
+        response_data = search.searchTrainNumbers(request.session['dbfile'], query, after, limit)
 
         # Send train numbers (as JSON) back
-        return JsonResponse(json.dumps(response_data), safe=False)
+        return request_log.done(CabJsonResponse(response_data, status=search.getStatus(response_data)), response_data)
 
 def getactions(request):
     ''' get actions of the train number id contained in the request '''
@@ -63,13 +146,56 @@ def getactions(request):
         data = json.loads(request.body)
 
         trainNumberId = data["trainNumberId"]
+        # lazy: line sections only (with their number of events and actions), see getlinesection
+        lazy = data.get("lazy", False)
         #print(trainNumberId)
 
-        response_data = act.getActions(request.session['dbfile'], trainNumberId)
-        logger.info("actions for trainNumberId {}: {}".format(trainNumberId, response_data))
+        request_log = RequestLog(logger, "getactions", trainNumberId=trainNumberId, lazy=lazy)
+        dbfile = request.session['dbfile']
+
+        # served before to this session: sent as cached
+        session_result = resultcache.SessionResult(request.session.session_key, dbfile, "getactions", trainNumberId, lazy)
+        content = session_result.get()
+        if content is not None:
+            request_log.fields["cached"] = True
+            return request_log.done(resultcache.makeResponse(content), None)
+
+        response_data = getActionsData(dbfile, trainNumberId, lazy)
         
         # Send actions (as JSON) back
-        return JsonResponse(json.dumps(response_data), safe=False)
+        return request_log.done(makeActionsResponse(response_data, session_result=session_result), response_data)
+
+@cacheable.cacheable
+def dbactions(request, digest, trainNumberId):
+    ''' get actions of the train number id in the url, from the database of the content hash in the url (cacheable) '''
+    if request.method == 'GET':
+        # lazy: line sections only (with their number of events and actions), see getlinesection
+        lazy = request.GET.get("lazy") in ("1", "true")
+
+        request_log = RequestLog(logger, "dbactions", trainNumberId=trainNumberId, lazy=lazy)
+        dbfile = upload.findDbFile(digest)
+        if dbfile is None:
+            response_data = cacheable.unknownDatabase(digest)
+        else:
+            response_data = getActionsData(dbfile, trainNumberId, lazy)
+
+        # Send actions (as JSON) back
+        return request_log.done(makeActionsResponse(response_data, cacheable.makeResponse), response_data)
+
+def getlinesection(request):
+    ''' get the events and actions of the line section contained in the request (lazy action tree) '''
+    if request.method == 'POST':
+        # Parse the JSON data from the request body
+        data = json.loads(request.body)
+
+        lineId = data["lineId"]
+        lineSectionId = data["lineSectionId"]
+
+        request_log = RequestLog(logger, "getlinesection", lineId=lineId, lineSectionId=lineSectionId)
+        response_data = act.getLineSection(request.session['dbfile'], lineId, lineSectionId)
+
+        # Send line section (as JSON) back
+        return request_log.done(CabJsonResponse(response_data), response_data)
     
 def loadcplxaction(request):
     if request.method == 'POST':
@@ -79,7 +205,7 @@ def loadcplxaction(request):
                 "new_tab": reverse('cplxaction')
             }
         
-        return JsonResponse(json.dumps(response_data), safe=False)
+        return CabJsonResponse(response_data)
     
 def getcplxaction(request):
     ''' get the actions tree of the complex action contained in the request '''
@@ -93,14 +219,85 @@ def getcplxaction(request):
         actionType = data["actionType"]
         mediaType = data["mediaType"]
 
-        response_data = cplx.getCplxActionTree(request.session['dbfile'], 
+        request_log = RequestLog(logger, "getcplxaction", actionId=actionId)
+        dbfile = request.session['dbfile']
+
+        # served before to this session: sent as cached
+        session_result = resultcache.SessionResult(request.session.session_key, dbfile, "getcplxaction",
+                                                   actionId, actionListId, actionDetailId, actionType, mediaType)
+        content = session_result.get()
+        if content is not None:
+            request_log.fields["cached"] = True
+            return request_log.done(resultcache.makeResponse(content), None)
+
+        response_data = cplx.getCplxActionTree(dbfile, 
                                                actionId, 
                                                actionListId,
                                                actionDetailId,
                                                actionType,
                                                mediaType)
         
-        logger.info("complex actions for actionId {}: {}".format(actionId, response_data))
-        
         # Send actions (as JSON) back
-        return JsonResponse(json.dumps(response_data), safe=False)
\ No newline at end of file
+        return request_log.done(makeSessionResponse(response_data, session_result), response_data)
+
+@cacheable.cacheable
+def dbcplxaction(request, digest, actionId):
+    ''' get the actions tree of the complex action in the url, from the database of the content hash in the url (cacheable) '''
+    if request.method == 'GET':
+        actionListId = request.GET.get("actionListId")
+        actionDetailId = request.GET.get("actionDetailId")
+        actionType = request.GET.get("actionType")
+        mediaType = request.GET.get("mediaType")
+
+        request_log = RequestLog(logger, "dbcplxaction", actionId=actionId)
+        dbfile = upload.findDbFile(digest)
+        if dbfile is None:
+            response_data = cacheable.unknownDatabase(digest)
+        else:
+            response_data = cplx.getCplxActionTree(dbfile, actionId, actionListId, actionDetailId, actionType, mediaType)
+
+        # Send actions (as JSON) back
+        return request_log.done(cacheable.makeResponse(response_data), response_data)
+
+@cacheable.cacheable
+def dbdiff(request, base, other):
+    ''' get the differences between the databases of the content hashes in the url (base, other version), cacheable '''
+    if request.method == 'GET':
+        # limit: number of changed train numbers compared subtree by subtree (see diff.DETAIL_LIMIT)
+        limit = request.GET.get("limit")
+
+        request_log = RequestLog(logger, "dbdiff", limit=limit)
+        baseFile = upload.findDbFile(base)
+        otherFile = upload.findDbFile(other)
+        if baseFile is None:
+            response_data = cacheable.unknownDatabase(base)
+        elif otherFile is None:
+            response_data = cacheable.unknownDatabase(other)
+        else:
+            response_data = diff.getDiff(baseFile, otherFile, limit)
+
+        # Send differences (as JSON) back
+        return request_log.done(cacheable.makeResponse(response_data), response_data)
+
+def getcplxactions(request):
+    ''' get the actions trees of all complex actions of the train number id contained in the request (batch) '''
+    if request.method == 'POST':
+        # Parse the JSON data from the request body
+        data = json.loads(request.body)
+
+        trainNumberId = data["trainNumberId"]
+
+        request_log = RequestLog(logger, "getcplxactions", trainNumberId=trainNumberId)
+        dbfile = request.session['dbfile']
+
+        # served before to this session: sent as cached
+        session_result = resultcache.SessionResult(request.session.session_key, dbfile, "getcplxactions", trainNumberId)
+        content = session_result.get()
+        if content is not None:
+            request_log.fields["cached"] = True
+            return request_log.done(resultcache.makeResponse(content), None)
+
+        response_data = cplx.getCplxActionTrees(dbfile, trainNumberId)
+
+        # Send actions (as JSON) back
+        return request_log.done(makeSessionResponse(response_data, session_result), response_data)
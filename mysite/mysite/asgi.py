@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+# the cab database endpoints are served by async views (see CAB_ASYNC_VIEWS)
+os.environ.setdefault('CAB_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first: the timing covers the other middleware
+    'cab.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -85,6 +88,38 @@ DATABASES = {
 }
 
 
+# Cache of the sessions and of the per-session results (see CAB_RESULT_CACHE_BYTES): in-process (LocMemCache) by default,
+# a cache shared by the processes of the server with CAB_CACHE_BACKEND and CAB_CACHE_LOCATION (e.g.
+# django.core.cache.backends.filebased.FileBasedCache and a directory). Two caches: results never evict sessions.
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+CAB_CACHE_BACKEND = os.environ.get("CAB_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache")
+CAB_CACHE_LOCATION = os.environ.get("CAB_CACHE_LOCATION", "cab")
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'sessions': {
+        'BACKEND': CAB_CACHE_BACKEND,
+        'LOCATION': os.path.join(CAB_CACHE_LOCATION, "sessions"),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    'results': {
+        'BACKEND': CAB_CACHE_BACKEND,
+        'LOCATION': os.path.join(CAB_CACHE_LOCATION, "results"),
+        # recently served results only
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+
+# the sessions (e.g. the uploaded database of each user) are read from the cache, not from the database
+# (cache sessions which release their uploaded database when they are flushed, see cab/sessions.py)
+SESSION_ENGINE = 'cab.sessions'
+SESSION_CACHE_ALIAS = 'sessions'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -158,8 +193,94 @@ LOGGING = {
         },
         "cab": {
             "handlers": ["file"],
-            "level": "DEBUG",
+            # requests are logged as summaries at INFO, DEBUG adds the (capped) response payloads
+            "level": "INFO",
             "propagate": True,
         },
     },
 }
+
+
+# CAB: Complex Action Browser settings
+
+# build an in-memory snapshot (index) of each uploaded database, all requests are then answered from memory
+CAB_SNAPSHOT_INDEX = False
+
+# maximum memory (bytes) used by the snapshots of all sessions, least recently used snapshots are evicted
+CAB_SNAPSHOT_MAX_BYTES = 256 * 1024 * 1024
+
+# pooled (read-only) database connections: idle connections are closed after this time (seconds)
+CAB_POOL_IDLE_TIMEOUT = 300
+
+# maximum number of idle connections kept per uploaded database
+CAB_POOL_MAX_IDLE = 4
+
+# run the queries against a working copy of each uploaded database, with the indexes of the lookups:
+# None (the upload as is), 'memory' (in-memory copy, as big as the database) or 'scratch' (copy in CAB_WORKING_COPY_DIR)
+CAB_WORKING_COPY = None
+
+# directory of the scratch working copies (None: 'cab-work' in the system temporary directory)
+CAB_WORKING_COPY_DIR = None
+
+# number of prepared statements cached per database connection
+CAB_CACHED_STATEMENTS = 1024
+
+# directory of the uploaded databases (None: 'cab-uploads' in the system temporary directory)
+CAB_UPLOAD_DIR = None
+
+# uploads are streamed into their file in chunks of this size (bytes)
+CAB_UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# the uploaded databases of expired sessions are removed at this interval (seconds), and on each upload, 0: on uploads only
+CAB_UPLOAD_SWEEP_INTERVAL = 600
+
+# number of threads processing the uploaded databases in the background (validation, train numbers), process-wide
+CAB_UPLOAD_WORKERS = 2
+
+# warm up the caches of an uploaded database in the background (train number search index)
+CAB_UPLOAD_WARMUP = True
+
+# encode the JSON responses with orjson (when installed), json otherwise
+CAB_JSON_ORJSON = True
+
+# stream the actions trees (getactions): serialized node by node while sent, instead of a dictionary encoded at once
+CAB_STREAM_JSON = True
+
+# maximum number of characters of a response payload logged (at DEBUG)
+CAB_LOG_PAYLOAD_MAX_CHARS = 4096
+
+# instrument the requests (statements, time in SQLite, building and serializing): Server-Timing header and a log line
+CAB_SERVER_TIMING = True
+
+# log the top statements of the requests slower than this (milliseconds), None: never
+CAB_SLOW_REQUEST_MS = None
+
+# number of statements logged for a slow request
+CAB_SLOW_REQUEST_STATEMENTS = 10
+
+# cache of the results (response bodies) recently served to each session: actions of a train number and complex action trees,
+# cache alias (see CACHES) and maximum bytes per session (least recently served results are evicted), 0: no result cache
+CAB_RESULT_CACHE_ALIAS = 'results'
+CAB_RESULT_CACHE_BYTES = 8 * 1024 * 1024
+
+# the responses of the cacheable endpoints (their url carries the content hash of the database) are cached this time (seconds)
+CAB_CACHE_MAX_AGE = 365 * 24 * 3600
+
+# number of train numbers returned per page by the train number search
+CAB_SEARCH_PAGE_SIZE = 50
+
+# maximum number of complex action subtrees memoized per uploaded database
+CAB_CPLX_MEMO_SIZE = 10000
+
+# number of threads resolving the complex actions of a train number (batch request), process-wide
+CAB_BATCH_WORKERS = 4
+
+# number of changed train numbers compared subtree by subtree by a diff of two databases (cab/diff, cabdiff command),
+# the others are only listed
+CAB_DIFF_DETAIL_LIMIT = 20
+
+# serve the database endpoints by async views (cab.asyncviews): set by mysite.asgi, the WSGI server keeps the sync views
+CAB_ASYNC_VIEWS = os.environ.get("CAB_ASYNC_VIEWS", "0") == "1"
+
+# number of threads running the database access of the async views, process-wide
+CAB_ASYNC_WORKERS = 8